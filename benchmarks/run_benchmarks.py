@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPO_PATH, 'etl'))
+sys.path.append(os.path.join(REPO_PATH, 'benchmarks'))
+
+import pandas as pd
+
+from instrumentation import peak_rss_mb
+from synthetic_data import generate
+
+# Etapas medidas, na ordem de execução. Cada uma roda em um processo próprio, para que o
+# pico de memória de uma não contamine a outra.
+STAGES = ['etl_full', 'etl_incremental', 'etl_unchanged', 'update_bd', 'bi_load_data', 'bi_table_page', 'bi_rollups', 'bi_correlation', 'bi_sqlite_query']
+
+def _last_year(timestamps):
+    if timestamps.dt.tz is not None:
+        timestamps = timestamps.dt.tz_localize(None)
+    end = timestamps.max().normalize()
+    return end - pd.DateOffset(years=1), end
+
+def _fingerprint_count(file_name):
+    # Os índices de impressões digitais guardam 8 bytes por linha
+    path = os.path.join(os.getcwd(), 'dados', file_name)
+    return os.path.getsize(path) // 8 if os.path.exists(path) else 0
+
+def _run_etl(streaming, chunk_size, workers):
+    from etl_2 import dados_path, etl_function, predata_validator, stream_predata_validator
+    from snapshot import publish_snapshot
+
+    file_path = dados_path('dados_iqarj.csv')
+    history_path = dados_path('dados_iqarj_historicos.csv')
+
+    if streaming:
+        stream_predata_validator(file_path, history_path, chunk_size, workers)
+    else:
+        predata_validator(file_path, history_path, lambda df: etl_function(df, workers), chunk_size)
+    publish_snapshot()
+
+def _run_update_bd(batch_size):
+    import update_bd
+    from prisma import Prisma
+
+    update_bd.db = Prisma(datasource={'url': _database_url()})
+    asyncio.run(update_bd.main(batch_size))
+
+def _database_url():
+    return 'file:' + os.path.join(os.getcwd(), 'database.db')
+
+def _create_database():
+    # Banco próprio do benchmark: cópia do schema do projeto apontando para o diretório de trabalho
+    with open(os.path.join(REPO_PATH, 'schema.prisma')) as schema_file:
+        schema = schema_file.read().replace('"file:database.db"', json.dumps(_database_url()))
+    schema_path = os.path.join(os.getcwd(), 'schema.prisma')
+    with open(schema_path, 'w') as schema_file:
+        schema_file.write(schema)
+
+    subprocess.run([sys.executable, '-m', 'prisma', 'db', 'push', '--skip-generate', '--schema', schema_path], check=True, capture_output=True)
+
+def _run_bi_load_data():
+    from snapshot import FactSnapshot, snapshot_version
+
+    # Mesma leitura do bi.py: snapshot mapeado e todas as estações no último ano
+    snapshot = FactSnapshot(snapshot_version())
+    last = snapshot.date_bounds(snapshot.stations)[1].tz_localize(None).normalize()
+    return len(snapshot.select(snapshot.stations, last - pd.DateOffset(years=1), last))
+
+def _run_bi_table_page():
+    from snapshot import FactSnapshot, snapshot_version
+
+    # Página da tabela do bi.py: todas as estações no último ano, ordenadas por um indicador
+    snapshot = FactSnapshot(snapshot_version())
+    last = snapshot.date_bounds(snapshot.stations)[1].tz_localize(None).normalize()
+    start = last - pd.DateOffset(years=1)
+    snapshot.select(snapshot.stations, start, last, order_by='pm10', ascending=False, offset=0, limit=100)
+    return snapshot.count(snapshot.stations, start, last)
+
+def _run_bi_rollups():
+    from aggregates import ROLLUP_KEYS, query_rollup
+    from parquet_store import read_dimension
+
+    start, end = _last_year(read_dimension('dtempo', columns=['timestamp'])['timestamp'])
+    return sum(len(query_rollup(granularity, None, start, end)) for granularity in ROLLUP_KEYS)
+
+def _run_bi_correlation():
+    from aggregates import correlation_matrix, query_moments
+    from parquet_store import read_dimension
+    from star_schema import MEDIDAS
+
+    # Matriz de todos os indicadores no último ano; as linhas são as horas cobertas
+    start, end = _last_year(read_dimension('dtempo', columns=['timestamp'])['timestamp'])
+    moments = query_moments(None, start, end)
+    correlation_matrix(moments, MEDIDAS)
+    return max(moments[f'{medida}__{medida}_count'] for medida in MEDIDAS)
+
+def _run_bi_sqlite_query():
+    from parquet_store import read_dimension
+    from warehouse import query_facts
+
+    start, end = _last_year(read_dimension('dtempo', columns=['timestamp'])['timestamp'])
+    return len(query_facts(read_dimension('destacao')['station_name'].tolist(), start, end))
+
+def run_stage(stage, options):
+    """
+    Run one benchmark stage in the current process, whose working directory holds the 'dados'
+    folder of the benchmark.
+
+    Args:
+        stage (str): One of STAGES.
+        options (dict): Command line options of the benchmark.
+
+    Returns:
+        dict: Wall time (s), peak RSS (MB) and number of rows processed by the stage.
+
+    """
+    run_etl = lambda: _run_etl(options['streaming'], options['chunk_size'], options['workers'])
+    stages = {
+        'etl_full': run_etl,
+        'etl_incremental': run_etl,
+        'etl_unchanged': run_etl,
+        'update_bd': lambda: _run_update_bd(options['batch_size']),
+        'bi_load_data': _run_bi_load_data,
+        'bi_table_page': _run_bi_table_page,
+        'bi_rollups': _run_bi_rollups,
+        'bi_correlation': _run_bi_correlation,
+        'bi_sqlite_query': _run_bi_sqlite_query,
+    }
+
+    if stage == 'update_bd':
+        _create_database()
+
+    # Linhas de entrada processadas pelo ETL, contadas fora da medição
+    history_rows = _fingerprint_count('dados_iqarj_historicos_manifest.bin')
+
+    start = time.perf_counter()
+    # As etapas do ETL imprimem as tabelas geradas: a saída é descartada
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        rows = stages[stage]()
+    wall_time = time.perf_counter() - start
+
+    if stage.startswith('etl_'):
+        rows = _fingerprint_count('dados_iqarj_historicos_manifest.bin') - history_rows
+    elif stage == 'update_bd':
+        rows = _fingerprint_count('df_fqualidadear_fingerprints.bin')
+
+    peak = peak_rss_mb()
+    return {'wall_time_s': round(wall_time, 4), 'peak_rss_mb': None if peak is None else round(peak, 1), 'rows': int(rows)}
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_size(n_rows, options):
+    """
+    Generate a synthetic input of 'n_rows' rows in a temporary directory and run every stage
+    on it, each one in a separate process.
+
+    Returns:
+        list: One result per stage; a stage that fails (e.g. Prisma not configured) is
+            reported with its error instead of stopping the benchmark.
+
+    """
+    results = []
+    workdir = tempfile.mkdtemp(prefix='bench_', dir=options['workdir'])
+    try:
+        os.makedirs(os.path.join(workdir, 'dados'))
+        input_path = os.path.join(workdir, 'dados', 'dados_iqarj.csv')
+        next_hour = generate(input_path, n_rows, seed=options['seed'])
+
+        for stage in STAGES:
+            if stage == 'etl_incremental':
+                # Novas horas acrescentadas ao final do arquivo, como numa atualização real
+                generate(input_path, max(1, int(n_rows * options['incremental_fraction'])), next_hour, options['seed'] + 1, append=True)
+            if stage == 'bi_sqlite_query' and not os.path.exists(os.path.join(workdir, 'database.db')):
+                result = {'rows_input': n_rows, 'stage': stage, 'skipped': 'sem banco de dados (update_bd falhou)'}
+            else:
+                result = _run_stage_process(stage, options, workdir, n_rows)
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False))
+    finally:
+        if not options['keep']:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+def _run_stage_process(stage, options, workdir, n_rows):
+    # Executa a etapa em um processo filho, que devolve o resultado na última linha da saída
+    command = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--options', json.dumps(options)]
+    process = subprocess.run(command, cwd=workdir, capture_output=True, text=True)
+    result = {'rows_input': n_rows, 'stage': stage}
+    if process.returncode == 0:
+        result.update(json.loads(process.stdout.strip().splitlines()[-1]))
+    else:
+        result['error'] = (process.stderr.strip().splitlines() or ['erro desconhecido'])[-1]
+    return result
+
+def main(options):
+    report = {
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'options': options,
+        'results': [],
+    }
+    for n_rows in options['rows']:
+        report['results'].extend(run_size(n_rows, options))
+
+    with open(options['report'], 'w') as report_file:
+        json.dump(report, report_file, indent=2, ensure_ascii=False)
+    print(f"Relatório gravado em {options['report']}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mede tempo e memória do ETL, da carga do banco e das consultas do dashboard com dados sintéticos.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000], help='Tamanhos de entrada, em linhas (padrão: 100000).')
+    parser.add_argument('--incremental-fraction', type=float, default=0.1, help='Linhas acrescentadas na execução incremental, como fração da entrada (padrão: 0.1).')
+    parser.add_argument('--streaming', action='store_true', help='Executa o ETL no modo streaming.')
+    parser.add_argument('--chunk-size', type=int, default=100_000, help='Linhas por bloco do ETL (padrão: 100000).')
+    parser.add_argument('--workers', type=int, default=1, help='Com mais de um, as dimensões são construídas em paralelo, como em etl_2.py (padrão: 1).')
+    parser.add_argument('--batch-size', type=int, default=50_000, help='Linhas por transação na carga do banco (padrão: 50000).')
+    parser.add_argument('--seed', type=int, default=0, help='Semente dos dados sintéticos (padrão: 0).')
+    parser.add_argument('--workdir', default=None, help='Diretório onde os dados temporários são criados.')
+    parser.add_argument('--keep', action='store_true', help='Mantém os dados gerados após o benchmark.')
+    parser.add_argument('--report', default='benchmark_report.json', help='Arquivo JSON do relatório (padrão: benchmark_report.json).')
+    parser.add_argument('--stage', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        # Execução de uma única etapa, no processo filho
+        print(json.dumps(run_stage(args.stage, json.loads(args.options))))
+    else:
+        options = {key: value for key, value in vars(args).items() if key not in ('stage', 'options')}
+        options['report'] = os.path.abspath(options['report'])
+        main(options)
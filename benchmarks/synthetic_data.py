@@ -0,0 +1,142 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+# Colunas do arquivo dados_iqarj.csv, na mesma ordem
+COLUMNS = ['data', 'codnum', 'estação', 'lat', 'lon', 'x_utm_sirgas2000', 'y_utm_sirgas2000',
+           'chuva', 'pres', 'rs', 'temp', 'ur', 'dir_vento', 'vel_vento', 'so2', 'no2', 'hcnm',
+           'hct', 'ch4', 'co', 'no', 'nox', 'o3', 'pm10', 'pm2_5']
+
+# Estações de monitoramento: código, sigla, latitude, longitude, x/y UTM (SIRGAS 2000)
+# e indicadores que a estação não mede (sempre vazios)
+STATIONS = [
+    (1, 'CA', -22.908344, -43.178152, 687370.0, 7465810.0, {'hcnm', 'hct', 'ch4', 'pm2_5'}),
+    (2, 'AV', -22.965004, -43.180482, 687064.0, 7459540.0, {'rs', 'hcnm', 'hct', 'ch4'}),
+    (3, 'SC', -22.897599, -43.221719, 682912.0, 7467050.0, {'so2', 'hcnm', 'hct', 'ch4', 'pm2_5'}),
+    (4, 'SP', -22.924467, -43.233231, 681720.0, 7464090.0, {'rs', 'pm2_5'}),
+    (5, 'IR', -22.831676, -43.326845, 672230.0, 7474390.0, {'so2'}),
+    (6, 'BG', -22.887977, -43.471172, 657450.0, 7468260.0, {'pm2_5'}),
+    (7, 'CG', -22.886183, -43.556765, 648660.0, 7468500.0, {'hcnm', 'hct', 'ch4'}),
+    (8, 'PG', -23.004468, -43.632945, 640890.0, 7455480.0, {'so2', 'pm2_5'}),
+]
+
+# Nível médio, amplitude do ciclo diário, hora do pico, desvio do ruído e limites de cada indicador
+MEASUREMENTS = {
+    'chuva':     (0.0, 0.0, 0, 0.0, 0.0, 80.0),
+    'pres':      (1012.0, 2.0, 10, 3.0, 980.0, 1040.0),
+    'rs':        (180.0, 260.0, 12, 60.0, 0.0, 1100.0),
+    'temp':      (24.0, 5.0, 14, 2.5, 8.0, 44.0),
+    'ur':        (75.0, -15.0, 14, 8.0, 15.0, 100.0),
+    'dir_vento': (180.0, 0.0, 0, 100.0, 0.0, 360.0),
+    'vel_vento': (1.8, 0.8, 15, 0.7, 0.0, 12.0),
+    'so2':       (4.0, 1.5, 10, 2.0, 0.0, 80.0),
+    'no2':       (35.0, 12.0, 19, 10.0, 0.0, 250.0),
+    'hcnm':      (0.25, 0.1, 8, 0.1, 0.0, 3.0),
+    'hct':       (2.1, 0.2, 8, 0.2, 1.0, 6.0),
+    'ch4':       (1.85, 0.1, 8, 0.1, 1.0, 4.0),
+    'co':        (0.45, 0.2, 8, 0.15, 0.0, 6.0),
+    'no':        (18.0, 15.0, 8, 10.0, 0.0, 400.0),
+    'nox':       (55.0, 25.0, 8, 18.0, 0.0, 600.0),
+    'o3':        (30.0, 25.0, 14, 10.0, 0.0, 250.0),
+    'pm10':      (32.0, 8.0, 10, 10.0, 0.0, 300.0),
+    'pm2_5':     (14.0, 4.0, 10, 5.0, 0.0, 150.0),
+}
+
+# Fração de medições ausentes por falhas pontuais dos sensores
+DEFAULT_NAN_RATE = 0.08
+
+# Horas geradas por bloco gravado no arquivo
+CHUNK_HOURS = 100_000
+
+def _measurement_values(rng, name, hours, n):
+    mean, amplitude, peak, noise, low, high = MEASUREMENTS[name]
+    if name == 'chuva':
+        # Sem chuva na maior parte das horas
+        values = np.where(rng.random(n) < 0.1, rng.exponential(2.0, n), 0.0)
+    else:
+        cycle = np.cos(2 * np.pi * (hours - peak) / 24)
+        values = mean + amplitude * cycle + rng.normal(0.0, noise, n)
+    return np.clip(values, low, high).round(2)
+
+def generate_chunk(rng, timestamps, stations=STATIONS, nan_rate=DEFAULT_NAN_RATE):
+    """
+    Generate the rows of the given hours for all stations, in the layout of dados_iqarj.csv.
+
+    Args:
+        rng (numpy.random.Generator): Random number generator.
+        timestamps (pandas.DatetimeIndex): Hours to generate.
+        stations (list): Stations, in the format of STATIONS.
+        nan_rate (float): Fraction of missing measurements, besides the indicators the
+            station does not measure.
+
+    Returns:
+        pandas.DataFrame: One row per hour and station, ordered by hour and station.
+
+    """
+    n_stations = len(stations)
+    n = len(timestamps) * n_stations
+
+    hours = np.repeat(timestamps.hour.to_numpy(), n_stations)
+    station_index = np.tile(np.arange(n_stations), len(timestamps))
+
+    df = pd.DataFrame({
+        'data': np.repeat(timestamps.strftime('%Y/%m/%d %H:%M:%S+00').to_numpy(), n_stations),
+        'codnum': np.array([station[0] for station in stations])[station_index],
+        'estação': np.array([station[1] for station in stations])[station_index],
+        'lat': np.array([station[2] for station in stations])[station_index],
+        'lon': np.array([station[3] for station in stations])[station_index],
+        'x_utm_sirgas2000': np.array([station[4] for station in stations])[station_index],
+        'y_utm_sirgas2000': np.array([station[5] for station in stations])[station_index],
+    })
+
+    for name in MEASUREMENTS:
+        values = _measurement_values(rng, name, hours, n)
+        not_measured = np.array([name in station[6] for station in stations])[station_index]
+        values[not_measured | (rng.random(n) < nan_rate)] = np.nan
+        df[name] = values
+
+    return df[COLUMNS]
+
+def generate(path, n_rows, start='2011-01-01', seed=0, nan_rate=DEFAULT_NAN_RATE, append=False):
+    """
+    Write a synthetic dados_iqarj.csv with about 'n_rows' rows (whole hours of all stations).
+
+    The file is written in blocks of CHUNK_HOURS hours, so memory use does not depend on
+    its size.
+
+    Args:
+        path (str): The path to the output CSV file.
+        n_rows (int): Number of rows to generate.
+        start (datetime-like): First hour of the data.
+        seed (int): Seed of the random number generator.
+        nan_rate (float): Fraction of missing measurements.
+        append (bool): Append to an existing file instead of creating a new one.
+
+    Returns:
+        pandas.Timestamp: The hour after the last one generated, to continue the series.
+
+    """
+    rng = np.random.default_rng(seed)
+    n_hours = max(1, n_rows // len(STATIONS))
+    start = pd.Timestamp(start)
+
+    for offset in range(0, n_hours, CHUNK_HOURS):
+        timestamps = pd.date_range(start + pd.Timedelta(hours=offset), periods=min(CHUNK_HOURS, n_hours - offset), freq='h')
+        df = generate_chunk(rng, timestamps, nan_rate=nan_rate)
+        first = offset == 0 and not append
+        df.to_csv(path, mode='w' if first else 'a', header=first, index=False)
+
+    return start + pd.Timedelta(hours=n_hours)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gera um arquivo sintético com o formato de dados_iqarj.csv.')
+    parser.add_argument('--rows', type=int, default=100_000, help='Número aproximado de linhas (padrão: 100000).')
+    parser.add_argument('--output', default='dados/dados_iqarj.csv', help='Arquivo gerado (padrão: dados/dados_iqarj.csv).')
+    parser.add_argument('--start', default='2011-01-01', help='Primeira hora dos dados (padrão: 2011-01-01).')
+    parser.add_argument('--seed', type=int, default=0, help='Semente do gerador aleatório (padrão: 0).')
+    parser.add_argument('--nan-rate', type=float, default=DEFAULT_NAN_RATE, help=f'Fração de medições ausentes (padrão: {DEFAULT_NAN_RATE}).')
+    parser.add_argument('--append', action='store_true', help='Acrescenta as linhas ao final do arquivo existente.')
+    args = parser.parse_args()
+
+    end = generate(args.output, args.rows, args.start, args.seed, args.nan_rate, args.append)
+    print(f'Dados gerados em {args.output} até {end}')
@@ -1,3 +1,6 @@
+import os
+import sys
+import time
 import streamlit as st
 import pandas as pd
 import pydeck as pdk
@@ -6,24 +9,87 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 import plotly.express as px
 
-st.set_page_config(layout="wide")
-
-# Carregar os dados
-df_qualidade_ar = pd.read_csv('dados/df_fqualidadear.csv')
-df_tempo = pd.read_csv('dados/df_dtempo.csv')
-df_estacao = pd.read_csv('dados/df_destacao.csv')
-df_localizacao = pd.read_csv('dados/df_dlocalizacao.csv')
-
-# Convertendo colunas de datas para datetime
-df_tempo['timestamp'] = pd.to_datetime(df_tempo['timestamp'])
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'etl'))
+from aggregates import correlation_matrix, query_moments, query_rollup
+from downsampling import minmax_indices
+from freshness import read_batches
+from instrumentation import instrumented, stage
+from parquet_store import dataset_version, read_dimension
+from snapshot import FactSnapshot, snapshot_version
+from warehouse import LEGACY_LAYOUT_MESSAGE, count_facts, database_version, date_bounds, has_database, has_legacy_layout, query_facts
 
-# Unir os dataframes
-df = df_qualidade_ar.merge(df_tempo, how='left', left_on='tempo_key', right_on='tempo_key')
-df = df.merge(df_estacao, how='left', left_on='estacao_key', right_on='estacao_key')
-df = df.merge(df_localizacao, how='left', left_on='localizacao_key', right_on='localizacao_key')
+st.set_page_config(layout="wide")
 
-# Renomear colunas para facilitar a leitura
-df.rename(columns={'timestamp': 'data', 'station_name': 'Estação', 'latitude': 'Latitude', 'longitude': 'Longitude'}, inplace=True)
+# Origem das linhas de fatos: 'parquet' (padrão) carrega o esquema estrela em memória;
+# 'sqlite' consulta o database.db carregado por update_bd.py, trazendo só a seleção.
+BI_BACKEND = os.environ.get('BI_BACKEND', 'parquet')
+
+# Máximo de pontos por série enviados ao navegador nos gráficos de tempo (ver downsample)
+# e tamanhos de página da tabela: o volume enviado não depende do período selecionado
+BI_CHART_POINTS = int(os.environ.get('BI_CHART_POINTS', 1000))
+PAGE_SIZES = [50, 100, 500, 1000]
+
+# Carregar os dados uma única vez por processo, compartilhados entre sessões e reexecuções.
+# O cache é indexado pela versão dos arquivos e é refeito quando o ETL ou a carga os altera.
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_dimensions(version):
+    return read_dimension('destacao'), read_dimension('dlocalizacao')
+
+@st.cache_resource(max_entries=1, show_spinner='Carregando dados...')
+@instrumented('bi_load_data')
+def load_snapshot(version):
+    # Snapshot publicado pelo ETL, já unido às dimensões e mapeado em memória: as páginas
+    # do arquivo são compartilhadas por todas as sessões e processos do dashboard
+    return FactSnapshot(version)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_date_bounds(version, estacoes):
+    if BI_BACKEND == 'sqlite':
+        return date_bounds(list(estacoes))
+    return load_snapshot(version).date_bounds(list(estacoes))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def count_database(version, estacoes, start_date, end_date):
+    return count_facts(list(estacoes), start_date, end_date)
+
+def count_rows(version, estacoes, start_date, end_date):
+    if BI_BACKEND == 'sqlite':
+        return count_database(version, estacoes, start_date, end_date)
+    return load_snapshot(version).count(list(estacoes), start_date, end_date)
+
+@st.cache_data(max_entries=64, show_spinner='Consultando dados...')
+def load_page(version, estacoes, start_date, end_date, poluentes, order_by, ascending, offset, limit):
+    # Ordenação e paginação feitas no snapshot ou no banco: só as linhas da página são lidas
+    columns = ['data', 'Estação', 'Latitude', 'Longitude'] + list(poluentes)
+    if BI_BACKEND == 'sqlite':
+        df = query_facts(list(estacoes), start_date, end_date, list(poluentes), 'timestamp' if order_by == 'data' else order_by, ascending, offset, limit)
+        df.rename(columns={'timestamp': 'data', 'station_name': 'Estação', 'latitude': 'Latitude', 'longitude': 'Longitude'}, inplace=True)
+        return df[columns]
+    return load_snapshot(version).select(list(estacoes), start_date, end_date, columns, order_by, ascending, offset, limit)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_rollup(version, granularity, estacao_keys, start_date, end_date, poluentes):
+    return query_rollup(granularity, list(estacao_keys), start_date, end_date, list(poluentes))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_correlation(version, estacao_keys, start_date, end_date, poluentes):
+    moments = query_moments(list(estacao_keys), start_date, end_date, list(poluentes))
+    return correlation_matrix(moments, list(poluentes))
+
+if BI_BACKEND == 'sqlite' and not has_database():
+    st.error('Banco de dados não encontrado: execute o update_bd.py ou use BI_BACKEND=parquet.')
+    st.stop()
+if BI_BACKEND == 'sqlite' and has_legacy_layout():
+    st.error(LEGACY_LAYOUT_MESSAGE)
+    st.stop()
+
+# Os dataframes em cache são compartilhados: não devem ser alterados no lugar
+data_version = dataset_version()
+facts_version = database_version() if BI_BACKEND == 'sqlite' else snapshot_version()
+if not facts_version:
+    st.error('Snapshot dos dados não encontrado: execute o ETL (etl/etl_2.py ou etl/pipeline.py).')
+    st.stop()
+df_estacao, df_localizacao = load_dimensions(data_version)
 
 st.title('Análise da Qualidade do Ar')
 
@@ -35,29 +101,54 @@ def human_format(num):
         num /= 1000.0
     return ('%.2f%s' % (num, ['', 'K', 'M', 'G', 'T', 'P'][magnitude])).replace('.00', '')
 
+def format_duration(seconds):
+    if seconds is None or np.isnan(seconds):
+        return 'N/A'
+    for unit, size in (('d', 86400), ('h', 3600), ('min', 60)):
+        if seconds >= size:
+            return f'{seconds / size:.1f} {unit}'
+    return f'{seconds:.1f} s'
+
+# Atualidade dos dados: hora mais recente disponível e lotes do daemon (ver etl/daemon.py)
+with stage('bi_freshness'):
+    _, newest = load_date_bounds(facts_version, tuple(df_estacao['station_name'].unique()))
+    batches = read_batches()
+    latencies = np.array([batch['latency_s'] for batch in batches], dtype=float)
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        data_age = None if pd.isna(newest) else (pd.Timestamp.now(tz=newest.tz) - newest).total_seconds()
+        st.metric('Idade dos dados', format_duration(data_age), help='Tempo desde a hora mais recente com medições.')
+    with col2:
+        last_load = f"há {format_duration(time.time() - batches[-1]['queryable'])}" if batches else 'N/A'
+        st.metric('Última carga', last_load, help='Tempo desde o último lote carregado pelo daemon.')
+    with col3:
+        p95 = format_duration(np.percentile(latencies, 95)) if len(latencies) else 'N/A'
+        st.metric('Latência da carga', format_duration(np.median(latencies)) if len(latencies) else 'N/A',
+                  help=f'Mediana, nos últimos {len(latencies)} lotes, do tempo entre a chegada dos dados e a disponibilidade para consulta (p95: {p95}).')
+
 # Filtros
-selectbox_estacao = st.sidebar.multiselect('Estações', df['Estação'].unique(), default=[df['Estação'].unique()[0]])
-df_filtered = df[df['Estação'].isin(selectbox_estacao)].copy()
+selectbox_estacao = st.sidebar.multiselect('Estações', df_estacao['station_name'].unique(), default=[df_estacao['station_name'].unique()[0]])
+if not selectbox_estacao:
+    st.info('Selecione ao menos uma estação.')
+    st.stop()
+first_date, last_date = load_date_bounds(facts_version, tuple(selectbox_estacao))
 
 # Seleção da granularidade do tempo
 granularity = st.sidebar.selectbox('Granularidade do Tempo', ['Ano', 'Mês', 'Dia', 'Hora'], index=2)
 
 if granularity == 'Ano':
-    df_filtered.loc[:, 'tempo'] = df_filtered['data'].dt.year
     order = None  # Não precisamos definir ordem específica para anos
 elif granularity == 'Mês':
-    df_filtered.loc[:, 'tempo'] = df_filtered['data'].dt.to_period('M').astype(str)
-    order = [f'{y}-{m:02}' for y in range(df_filtered['data'].dt.year.min(), df_filtered['data'].dt.year.max() + 1) for m in range(1, 13)]
+    order = [f'{y}-{m:02}' for y in range(first_date.year, last_date.year + 1) for m in range(1, 13)]
 elif granularity == 'Dia':
-    df_filtered.loc[:, 'tempo'] = df_filtered['data'].dt.date
     order = None  # A ordem será mantida naturalmente
 elif granularity == 'Hora':
-    df_filtered.loc[:, 'tempo'] = df_filtered['data'].dt.hour
     order = list(range(24))
 
 # Filtro de intervalo de datas
-min_date = df_filtered['data'].min().date()
-max_date = df_filtered['data'].max().date()
+min_date = first_date.date()
+max_date = last_date.date()
 start_date = max_date.replace(year=max_date.year - 1) if max_date.year > min_date.year else min_date
 end_date = max_date
 try:
@@ -65,18 +156,81 @@ try:
 except Exception:
     st.warning('Selecione um intervalo adequado.')
 
-df_filtered = df_filtered[(df_filtered['data'].dt.date >= start_date) & (df_filtered['data'].dt.date <= end_date)]
-
 # Seleção de múltiplos atributos
 poluentes = ['chuva', 'pres', 'rs', 'temp', 'ur', 'dir_vento', 'vel_vento', 'so2', 'no2', 'hcnm', 'hct', 'ch4', 'co', 'no', 'nox', 'o3', 'pm10', 'pm2_5']
 selectbox_poluentes = st.sidebar.multiselect('Indicadores', poluentes, default=poluentes[:3])
+if not selectbox_poluentes:
+    st.info('Selecione ao menos um indicador.')
+    st.stop()
+
+with stage('bi_load_facts', backend=BI_BACKEND) as record:
+    total_rows = count_rows(facts_version, tuple(selectbox_estacao), start_date, end_date)
+    record['rows_out'] = total_rows
+
+# Agregados pré-calculados pelo ETL para as estações e o período selecionados
+ROLLUP_GRANULARITY = {'Ano': 'ano', 'Mês': 'mes', 'Dia': 'dia', 'Hora': 'hora'}
+estacao_keys = df_estacao.loc[df_estacao['station_name'].isin(selectbox_estacao), 'estacao_key']
+with stage('bi_rollups', granularity=granularity) as record:
+    df_rollup = load_rollup(data_version, ROLLUP_GRANULARITY[granularity], tuple(estacao_keys), start_date, end_date, tuple(selectbox_poluentes))
+    df_rollup = df_rollup.merge(df_estacao[['estacao_key', 'station_name']], how='left', on='estacao_key')
+    df_rollup = df_rollup.merge(df_localizacao, how='left', on='localizacao_key')
+    record['rows_out'] = len(df_rollup)
+df_rollup.rename(columns={'station_name': 'Estação', 'latitude': 'Latitude', 'longitude': 'Longitude'}, inplace=True)
+
+# 'periodo' agrupa as métricas e barras; 'tempo' agrupa o heatmap e o gráfico de linhas
+if granularity == 'Ano':
+    df_rollup['periodo'] = df_rollup['tempo'] = df_rollup['ano']
+elif granularity == 'Mês':
+    df_rollup['periodo'] = df_rollup['mes']
+    df_rollup['tempo'] = df_rollup['ano'].astype(str) + '-' + df_rollup['mes'].map('{:02}'.format)
+elif granularity == 'Dia':
+    df_rollup['periodo'] = df_rollup['tempo'] = df_rollup['data'].dt.date
+elif granularity == 'Hora':
+    df_rollup['periodo'] = df_rollup['tempo'] = df_rollup['hora']
 
-# Normalizar valores dos indicadores
-df_normalized = df_filtered.copy()
+# Normalizar valores dos indicadores (a tabela normaliza as linhas de cada página)
+normalization = {}
 for poluente in selectbox_poluentes:
-    min_val = df_normalized[poluente].min()
-    max_val = df_normalized[poluente].max()
-    df_normalized[poluente] = (df_normalized[poluente] - min_val) / (max_val - min_val)
+    min_val = df_rollup[f'{poluente}_min'].min()
+    max_val = df_rollup[f'{poluente}_max'].max()
+    normalization[poluente] = (min_val, max_val)
+
+# Agregação única de todos os indicadores selecionados por estação e período: abas,
+# métricas e gráficos leem das tabelas derivadas dela, sem agrupar de novo por indicador.
+# 'Estação' é categórica: observed=True mantém só as estações presentes na seleção
+SUMMARY_STATS = ['count', 'sum', 'mean', 'max']
+df_base = df_rollup.groupby(['Estação', 'Latitude', 'Longitude', 'tempo', 'periodo'], observed=True).agg(
+    {f'{p}_{stat}': 'max' if stat == 'max' else 'sum' for p in selectbox_poluentes for stat in ('count', 'sum', 'max')}
+)
+min_vals = np.array([normalization[p][0] for p in selectbox_poluentes], dtype='float64')
+scales = np.array([normalization[p][1] for p in selectbox_poluentes], dtype='float64') - min_vals
+
+def summarize(by):
+    """
+    Count and normalized sum, mean and maximum of every selected indicator per group.
+
+    Returns:
+        pandas.DataFrame: One row per group and one (indicador, estatística) column per
+            indicator and statistic of SUMMARY_STATS.
+    """
+    df_grouped = df_base.groupby(level=by, observed=True).agg({col: 'max' if col.endswith('_max') else 'sum' for col in df_base.columns})
+    counts, sums, maxs = (df_grouped[[f'{p}_{stat}' for p in selectbox_poluentes]].to_numpy(dtype='float64') for stat in ('count', 'sum', 'max'))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats = {
+            'count': counts,
+            'sum': (sums - counts * min_vals) / scales,
+            'mean': (np.where(counts > 0, sums / counts, np.nan) - min_vals) / scales,
+            'max': (maxs - min_vals) / scales,
+        }
+
+    values = np.stack([stats[stat] for stat in SUMMARY_STATS], axis=2).reshape(len(df_grouped), len(selectbox_poluentes) * len(SUMMARY_STATS))
+    return pd.DataFrame(values, index=df_grouped.index, columns=pd.MultiIndex.from_product([selectbox_poluentes, SUMMARY_STATS]))
+
+with stage('bi_summary', rows_in=len(df_base)):
+    df_summary_estacao_periodo = summarize(['Estação', 'periodo'])
+    df_summary_periodo = summarize(['periodo'])
+    df_summary_estacao = summarize(['Estação'])
 
 # Ordenação
 selectbox_orderby = st.sidebar.selectbox(
@@ -95,7 +249,13 @@ elif '↑' in selectbox_orderby:
     orderby_column = selectbox_orderby.replace(' ↑', '')
     orderby_asc = True
 
-df_normalized.sort_values(by=[orderby_column], inplace=True, ascending=orderby_asc)
+def downsample(df):
+    """
+    Rows of a time series (or of several, one per column) to send to a chart: at most
+    BI_CHART_POINTS per series, keeping the minimum and maximum of each stretch of the
+    series (see minmax_indices).
+    """
+    return df.iloc[minmax_indices(df.to_numpy(dtype='float64'), BI_CHART_POINTS)]
 
 # Função para identificar o máximo de forma segura
 def safe_idxmax(series):
@@ -109,79 +269,101 @@ view_combined = st.sidebar.checkbox('Ver Médias Combinadas', value=True)
 tabs = st.tabs(["Todas"] + selectbox_estacao) if view_combined else st.tabs(selectbox_estacao)
 
 for tab, estacao in zip(tabs, ["Todas"] + selectbox_estacao if view_combined else selectbox_estacao):
-    with tab:
+    with tab, stage('bi_tab', estacao=estacao):
         if view_combined and estacao == "Todas":
             st.subheader("Todas as Estações")
-            df_estacao = df_normalized
+            tab_totals = df_summary_estacao.sum()
+            tab_periods = df_summary_periodo
         else:
             st.subheader(f'Estação: {estacao}')
-            df_estacao = df_normalized[df_normalized['Estação'] == estacao]
+            tab_totals = df_summary_estacao.reindex([estacao]).sum()
+            is_estacao = df_summary_estacao_periodo.index.get_level_values('Estação') == estacao
+            tab_periods = df_summary_estacao_periodo[is_estacao].droplevel('Estação')
 
         col1, col2 = st.columns(2)
-        col1.metric("Mediçōes", df_estacao[selectbox_poluentes].count().sum())
-        col2.metric("Concentração Total de Matéria", human_format(df_estacao[selectbox_poluentes].sum().sum()))
+        col1.metric("Mediçōes", int(tab_totals.xs('count', level=1).sum()))
+        col2.metric("Concentração Total de Matéria", human_format(tab_totals.xs('sum', level=1).sum()))
 
         for poluente in selectbox_poluentes:
             with st.expander(f"Indicador: {poluente}", expanded=True):
                 col1, col2, col3, col4 = st.columns(4)
                 with col1:
-                    st.metric(f"Mediçōes de {poluente}", df_estacao[poluente].count())
+                    st.metric(f"Mediçōes de {poluente}", int(tab_totals[(poluente, 'count')]))
                 with col2:
-                    st.metric(f"Concentração Total de {poluente}", human_format(df_estacao[poluente].sum()))
+                    st.metric(f"Concentração Total de {poluente}", human_format(tab_totals[(poluente, 'sum')]))
+
+                # Média do indicador por período
+                df_grouped = tab_periods[(poluente, 'mean')].rename(poluente).rename_axis(granularity)
+
                 with col3:
                     max_period_label = "N/A"
-                    if not df_estacao.empty:
-                        if granularity == 'Ano':
-                            max_period = safe_idxmax(df_estacao.groupby(df_estacao['data'].dt.year)[poluente].mean())
-                            max_period_label = f"Ano: {max_period}" if max_period is not None else "N/A"
-                        elif granularity == 'Mês':
-                            max_period = safe_idxmax(df_estacao.groupby(df_estacao['data'].dt.month)[poluente].mean())
-                            max_period_label = f"Mês: {max_period}" if max_period is not None else "N/A"
-                        elif granularity == 'Dia':
-                            max_period = safe_idxmax(df_estacao.groupby(df_estacao['data'].dt.date)[poluente].mean())
-                            max_period_label = f"Dia: {max_period}" if max_period is not None else "N/A"
-                        elif granularity == 'Hora':
-                            max_period = safe_idxmax(df_estacao.groupby(df_estacao['data'].dt.hour)[poluente].mean())
-                            max_period_label = f"Hora: {max_period}" if max_period is not None else "N/A"
+                    if not tab_periods.empty:
+                        max_period = safe_idxmax(df_grouped)
+                        max_period_label = f"{granularity}: {max_period}" if max_period is not None else "N/A"
 
                     col3.metric("Período com Média mais Alta", max_period_label)
                 if view_combined and estacao == "Todas":
                     with col4:
-                        max_station = safe_idxmax(df_normalized.groupby('Estação')[poluente].mean())
+                        max_station = safe_idxmax(df_summary_estacao[(poluente, 'mean')])
                         col4.metric(f"Estação com Média mais Alta de {poluente}", max_station if max_station is not None else "N/A")
 
                 # Gráfico de barras para o indicador
-                if granularity == 'Ano':
-                    df_grouped = df_estacao.groupby(df_estacao['data'].dt.year)[poluente].mean()
-                    df_grouped.index.name = 'Ano'
-                elif granularity == 'Mês':
-                    df_grouped = df_estacao.groupby(df_estacao['data'].dt.month)[poluente].mean()
-                    df_grouped.index.name = 'Mês'
-                elif granularity == 'Dia':
-                    df_grouped = df_estacao.groupby(df_estacao['data'].dt.date)[poluente].mean()
-                    df_grouped.index.name = 'Dia'
-                elif granularity == 'Hora':
-                    df_grouped = df_estacao.groupby(df_estacao['data'].dt.hour)[poluente].mean()
-                    df_grouped.index.name = 'Hora'
-                
-                st.bar_chart(df_grouped, height=300, use_container_width=True)
-                st.caption(f'Média do indicador {poluente} - {estacao}')
+                df_chart = downsample(df_grouped)
+                st.bar_chart(df_chart, height=300, use_container_width=True)
+                caption = f'Média do indicador {poluente} - {estacao}'
+                if len(df_chart) < len(df_grouped):
+                    caption += f' (mínimos e máximos locais: {len(df_chart)} de {len(df_grouped)} períodos)'
+                st.caption(caption)
+
+# Dados do mapa construídos uma vez por estado dos filtros e reutilizados por todas as abas
+@st.cache_data(max_entries=16, show_spinner=False)
+def build_map_data(df_means):
+    """
+    Columnar data of the map layers, from the normalized mean of each indicator per station.
+
+    For each indicator 'p', the columns 'tooltip_<p>' (tooltip text), '<p>_normalized'
+    (the means rescaled to [0, 1] across stations) and '<p>_r'/'<p>_b' (red and blue
+    components of the color) are built with vectorized operations; 'tooltip' lists all
+    indicators.
+
+    Args:
+        df_means (pandas.DataFrame): Means indexed by 'Estação', 'Latitude' and 'Longitude',
+            one column per indicator.
+
+    Returns:
+        pandas.DataFrame: One row per station.
+    """
+    df_map = df_means.index.to_frame(index=False)
+    for p in df_means.columns:
+        means = df_means[p].reset_index(drop=True)
+        df_map[f'tooltip_{p}'] = pd.Series(np.char.mod(f'{p}: %.2f', means.to_numpy())).where(means.notna(), f'{p}: --')
+
+        normalized = (means - means.min()) / (means.max() - means.min())
+        valid = normalized.notna()
+        df_map[f'{p}_normalized'] = normalized
+        df_map[f'{p}_r'] = np.where(valid, normalized * 255, 0).astype('int64')
+        df_map[f'{p}_b'] = np.where(valid, (1 - normalized) * 255, 0).astype('int64')
+
+    tooltips = [df_map[f'tooltip_{p}'] for p in df_means.columns]
+    df_map['tooltip'] = tooltips[0].str.cat(tooltips[1:], sep='\n') if tooltips else ''
+    return df_map
 
 # Gráfico geográfico
-with st.expander("Visão Geográfica"):
+with st.expander("Visão Geográfica"), stage('bi_map'):
+    df_map = build_map_data(summarize(['Estação', 'Latitude', 'Longitude']).xs('mean', axis=1, level=1))
+    view_state = pdk.ViewState(
+        latitude=df_localizacao['latitude'].mean(),
+        longitude=df_localizacao['longitude'].mean(),
+        zoom=10
+    )
+
     tabs_geo = st.tabs(["Todos"] + selectbox_poluentes)
     for tab, poluente in zip(tabs_geo, ["Todos"] + selectbox_poluentes):
         with tab:
             if poluente == "Todos":
-                df_station_means = df_normalized.groupby(['Estação', 'Latitude', 'Longitude'])[selectbox_poluentes].mean().reset_index()
-                # Criar string de indicadores para o tooltip
-                df_station_means['tooltip'] = df_station_means.apply(
-                    lambda row: '\n'.join([f"{p}: {row[p]:.2f}" if not pd.isna(row[p]) else f"{p}: --" for p in selectbox_poluentes]),
-                    axis=1
-                )
                 layer = pdk.Layer(
                     'ScatterplotLayer',
-                    df_station_means,
+                    df_map[['Estação', 'Latitude', 'Longitude', 'tooltip']],
                     get_position=['Longitude', 'Latitude'],
                     get_radius=500,
                     get_fill_color=[255, 255, 0, 150],  # Cor amarela
@@ -190,61 +372,50 @@ with st.expander("Visão Geográfica"):
                     get_tooltip='tooltip'
                 )
             else:
-                df_station_means = df_normalized.groupby(['Estação', 'Latitude', 'Longitude'])[poluente].mean().reset_index()
-                df_station_means['normalized'] = (df_station_means[poluente] - df_station_means[poluente].min()) / (df_station_means[poluente].max() - df_station_means[poluente].min())
-
-                try:
-                    df_station_means['color'] = df_station_means['normalized'].apply(lambda x: [int(x * 255), 0, int((1 - x) * 255), 150])
-                except ValueError:
-                    df_station_means.dropna(subset=['normalized'], inplace=True)
-                    df_station_means['color'] = df_station_means['normalized'].apply(lambda x: [int(x * 255), 0, int((1 - x) * 255), 150])
-
-                df_station_means['tooltip'] = df_station_means.apply(
-                    lambda row: f"{poluente}: {row[poluente]:.2f}" if not pd.isna(row[poluente]) else f"{poluente}: --",
-                    axis=1
-                )
+                # Estações sem média do indicador ficam fora do mapa
+                df_layer = df_map.loc[df_map[f'{poluente}_normalized'].notna(), ['Estação', 'Latitude', 'Longitude', f'{poluente}_r', f'{poluente}_b', f'tooltip_{poluente}']]
                 layer = pdk.Layer(
                     'ScatterplotLayer',
-                    df_station_means,
+                    df_layer.rename(columns={f'tooltip_{poluente}': 'tooltip'}),
                     get_position=['Longitude', 'Latitude'],
                     get_radius=500,
-                    get_fill_color='color',
+                    get_fill_color=f'[{poluente}_r, 0, {poluente}_b, 150]',
                     pickable=True,
                     auto_highlight=True,
                     get_tooltip='tooltip'
                 )
 
-            view_state = pdk.ViewState(
-                latitude=df['Latitude'].mean(),
-                longitude=df['Longitude'].mean(),
-                zoom=10
-            )
             r = pdk.Deck(layers=[layer], initial_view_state=view_state, tooltip={"text": "{Estação}\n{tooltip}"})
             st.pydeck_chart(r)
 
 # Gráfico de calor para evolução dos indicadores por estação
-with st.expander("Evolução dos Indicadores por Estação (Heatmap)"):
+with st.expander("Evolução dos Indicadores por Estação (Heatmap)"), stage('bi_heatmap'):
+    df_summary_estacao_tempo = summarize(['Estação', 'tempo'])
     for poluente in selectbox_poluentes:
-        df_heatmap = df_normalized.pivot_table(values=poluente, index='Estação', columns='tempo')
+        df_heatmap = df_summary_estacao_tempo[(poluente, 'mean')].unstack('tempo').dropna(axis=1, how='all')
         fig = px.imshow(df_heatmap, aspect='auto', color_continuous_scale='RdBu_r', title=f'Evolução do indicador {poluente} por Estação')
         st.plotly_chart(fig)
 
 # Gráfico de linhas para médias normalizadas
-with st.expander("Médias Normalizadas ao Longo do Tempo"):
-    df_line = df_normalized.groupby(['tempo'])[selectbox_poluentes].mean().reset_index()
+with st.expander("Médias Normalizadas ao Longo do Tempo"), stage('bi_line_chart'):
+    df_line = summarize(['tempo']).xs('mean', axis=1, level=1).reset_index()
     df_line_normalized = (df_line[selectbox_poluentes] - df_line[selectbox_poluentes].min()) / (df_line[selectbox_poluentes].max() - df_line[selectbox_poluentes].min())
     df_line_normalized['tempo'] = df_line['tempo'].astype(str)
 
     if order is not None:
         df_line_normalized['tempo'] = pd.Categorical(df_line_normalized['tempo'], categories=order, ordered=True)
 
-    df_line_normalized = df_line_normalized.sort_values('tempo')
-    st.line_chart(df_line_normalized.set_index('tempo'))
-
-# Matriz de correlação
-with st.expander("Matriz de Correlação"):
-    if not df_normalized[selectbox_poluentes].empty:
-        corr_matrix = df_normalized[selectbox_poluentes].corr()
+    df_line_normalized = df_line_normalized.sort_values('tempo').set_index('tempo')
+    df_chart = downsample(df_line_normalized)
+    st.line_chart(df_chart)
+    if len(df_chart) < len(df_line_normalized):
+        st.caption(f'Mínimos e máximos locais de cada indicador: {len(df_chart)} de {len(df_line_normalized)} períodos.')
+
+# Matriz de correlação, a partir dos momentos por estação e período calculados pelo ETL
+# (a normalização dos indicadores não altera a correlação)
+with st.expander("Matriz de Correlação"), stage('bi_correlation'):
+    if total_rows and selectbox_poluentes:
+        corr_matrix = load_correlation(data_version, tuple(estacao_keys), start_date, end_date, tuple(selectbox_poluentes))
         fig, ax = plt.subplots(figsize=(10, 3))
         sns.heatmap(corr_matrix, annot=True, cmap='coolwarm', ax=ax)
         st.pyplot(fig, use_container_width=False)
@@ -252,5 +423,19 @@ with st.expander("Matriz de Correlação"):
         st.write("Sem dados suficientes para calcular a matriz de correlação.")
 
 # Visualização dos dados
-with st.expander("Tabela"):
-    st.dataframe(df_normalized[['data', 'Estação', 'Latitude', 'Longitude'] + selectbox_poluentes])
+with st.expander("Tabela"), stage('bi_table') as record:
+    col1, col2 = st.columns(2)
+    page_size = col1.selectbox('Linhas por página', PAGE_SIZES, index=1)
+    n_pages = max(1, -(-total_rows // page_size))
+    page = col2.number_input('Página', min_value=1, max_value=n_pages, value=1, step=1)
+
+    offset = (page - 1) * page_size
+    df_page = load_page(facts_version, tuple(selectbox_estacao), start_date, end_date, tuple(selectbox_poluentes), orderby_column, orderby_asc, offset, page_size)
+    df_page.index = pd.RangeIndex(offset, offset + len(df_page))
+    for poluente in selectbox_poluentes:
+        min_val, max_val = normalization[poluente]
+        df_page[poluente] = (df_page[poluente] - min_val) / (max_val - min_val)
+    record['rows_out'] = len(df_page)
+
+    st.dataframe(df_page)
+    st.caption(f'Linhas {offset + 1 if len(df_page) else 0} a {offset + len(df_page)} de {total_rows}, página {page} de {n_pages}.')
@@ -0,0 +1,581 @@
+import glob
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from instrumentation import instrumented
+from parquet_store import PARTITIONING, fact_dataset_path, parquet_path, read_facts
+from star_schema import MEDIDAS
+from time_keys import tempo_timestamps
+
+STATS = ['count', 'sum', 'min', 'max']
+
+# Estatísticas suficientes da matriz de correlação, por estação e mês: para cada par de
+# indicadores, o número de horas em que os dois foram medidos e, nessas horas, suas somas,
+# somas dos quadrados e a soma dos produtos
+MOMENT_KEYS = ['estacao_key', 'ano', 'mes']
+
+# Chaves de período de cada agregado (além de 'estacao_key' e 'localizacao_key')
+ROLLUP_KEYS = {
+    'ano': ['ano'],
+    'mes': ['ano', 'mes'],
+    'dia': ['data'],
+    'hora': ['ano', 'mes', 'hora'],
+}
+
+# Tabelas agregadas: uma por granularidade e a dos momentos da correlação. Cada uma é uma
+# pasta com um arquivo por mês ('AAAA-MM.parquet'; por ano, 'AAAA.parquet', na tabela
+# anual), de modo que um lote lê e reescreve só os períodos que toca
+MOMENTS_TABLE = 'correlacao'
+ROLLUP_TABLES = list(ROLLUP_KEYS) + [MOMENTS_TABLE]
+
+# Tabelas com um arquivo por mês, somadas lote a lote; a anual é refeita dos seus meses
+MONTH_TABLES = ['dia', 'mes', 'hora', MOMENTS_TABLE]
+
+# Metadado dos arquivos mensais com o maior id de fato já somado a eles
+LAST_ID_KEY = b'last_fact_id'
+
+def rollup_dir(table, root='agregados'):
+    return parquet_path(root, table)
+
+def _partition_path(table, name, root='agregados'):
+    return os.path.join(rollup_dir(table, root), f'{name}.parquet')
+
+def _month_name(period):
+    return f'{period.year}-{period.month:02}'
+
+def stat_columns(medidas=MEDIDAS):
+    return [f'{medida}_{stat}' for medida in medidas for stat in STATS]
+
+def _ordered(medidas):
+    return [medida for medida in MEDIDAS if medida in medidas]
+
+def moment_columns(medidas=MEDIDAS):
+    """
+    Columns of the moment table for the given indicators. For each pair of indicators 'a'
+    and 'b' ('a' first in MEDIDAS, or the same indicator): '<a>__<b>_count' (hours where
+    both were measured), '<a>__<b>_sum' and '<a>__<b>_sumsq' (sum and sum of squares of 'a'
+    over those hours), the same two for 'b' ('<b>__<a>_...') and '<a>__<b>_prod' (sum of
+    the products).
+
+    Args:
+        medidas (list): Indicator columns.
+
+    Returns:
+        list: The column names.
+
+    """
+    ordered = _ordered(medidas)
+    columns = []
+    for i, a in enumerate(ordered):
+        for b in ordered[i:]:
+            columns += [f'{a}__{b}_count', f'{a}__{b}_sum', f'{a}__{b}_sumsq']
+            if a != b:
+                columns += [f'{b}__{a}_sum', f'{b}__{a}_sumsq', f'{a}__{b}_prod']
+    return columns
+
+def _combine_spec(medidas):
+    return {
+        f'{medida}_{stat}': 'sum' if stat in ('count', 'sum') else stat
+        for medida in medidas for stat in STATS
+    }
+
+def _period_columns(df):
+    timestamp = df['timestamp']
+    return pd.DataFrame({
+        'estacao_key': df['estacao_key'].to_numpy(),
+        'localizacao_key': df['localizacao_key'].to_numpy(),
+        'ano': timestamp.dt.year.to_numpy(),
+        'mes': timestamp.dt.month.to_numpy(),
+        'hora': timestamp.dt.hour.to_numpy(),
+        'data': timestamp.dt.tz_localize(None).dt.normalize().to_numpy() if timestamp.dt.tz else timestamp.dt.normalize().to_numpy(),
+    }, index=df.index)
+
+def aggregate(df, granularity, medidas=MEDIDAS):
+    """
+    Compute count/sum/min/max of every indicator per station, location and period.
+
+    Args:
+        df (pandas.DataFrame): Fact rows with 'estacao_key', 'localizacao_key', 'timestamp'
+            and the indicator columns.
+        granularity (str): One of the keys of ROLLUP_KEYS.
+        medidas (list): Indicator columns to aggregate.
+
+    Returns:
+        pandas.DataFrame: One row per group, with '<indicador>_<estatística>' columns.
+
+    """
+    keys = ['estacao_key', 'localizacao_key'] + ROLLUP_KEYS[granularity]
+    df_aux = pd.concat([_period_columns(df)[keys], df[medidas].astype('float64')], axis=1)
+
+    df_rollup = df_aux.groupby(keys)[medidas].agg(STATS)
+    df_rollup.columns = [f'{medida}_{stat}' for medida, stat in df_rollup.columns]
+
+    return df_rollup[stat_columns(medidas)].reset_index()
+
+def combine(frames, keys, medidas=MEDIDAS):
+    """
+    Merge partial aggregates of the same groups: counts and sums are added, minimums and
+    maximums are combined.
+
+    Args:
+        frames (list): Aggregate dataframes with the same columns.
+        keys (list): Group columns.
+        medidas (list): Indicator columns.
+
+    Returns:
+        pandas.DataFrame: The combined aggregate.
+
+    """
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=keys + stat_columns(medidas))
+
+    return pd.concat(frames, ignore_index=True).groupby(keys, as_index=False).agg(_combine_spec(medidas))
+
+def aggregate_moments(df, medidas=MEDIDAS):
+    """
+    Compute the moments of every pair of indicators per station and month.
+
+    Args:
+        df (pandas.DataFrame): Fact rows with 'estacao_key', 'localizacao_key', 'timestamp'
+            and the indicator columns.
+        medidas (list): Indicator columns.
+
+    Returns:
+        pandas.DataFrame: One row per station and month, with the columns of moment_columns.
+
+    """
+    if df.empty:
+        return pd.DataFrame(columns=MOMENT_KEYS + moment_columns(medidas))
+
+    ordered = _ordered(medidas)
+    periods = _period_columns(df)
+    stations = periods['estacao_key'].to_numpy()
+    values = df[ordered].to_numpy(dtype='float64')
+    present = ~np.isnan(values)
+
+    # Um mês por vez, com uma matriz (horas x indicadores) por estação e zero nas horas sem
+    # medição: os produtos dessas matrizes dão as somas de todos os pares de uma vez
+    keys, blocks = [], []
+    for (ano, mes), rows in periods.groupby(['ano', 'mes']).indices.items():
+        month_stations, group = np.unique(stations[rows], return_inverse=True)
+        position = pd.Series(group).groupby(group).cumcount().to_numpy()
+        shape = (len(month_stations), position.max() + 1, len(ordered))
+        x, measured = np.zeros(shape), np.zeros(shape)
+        x[group, position] = np.where(present[rows], values[rows], 0)
+        measured[group, position] = present[rows]
+
+        x_t = x.transpose(0, 2, 1)
+        # sums[g, i, j]: soma do indicador i nas horas em que j foi medido
+        blocks.append((measured.transpose(0, 2, 1) @ measured, x_t @ measured, (x_t * x_t) @ measured, x_t @ x))
+        keys.append(pd.DataFrame({'estacao_key': month_stations, 'ano': ano, 'mes': mes}))
+
+    counts, sums, sumsqs, prods = (np.concatenate(arrays) for arrays in zip(*blocks))
+    columns = {}
+    for i, a in enumerate(ordered):
+        for j in range(i, len(ordered)):
+            b = ordered[j]
+            columns[f'{a}__{b}_count'] = counts[:, i, j].astype('int64')
+            columns[f'{a}__{b}_sum'] = sums[:, i, j]
+            columns[f'{a}__{b}_sumsq'] = sumsqs[:, i, j]
+            if a != b:
+                columns[f'{b}__{a}_sum'] = sums[:, j, i]
+                columns[f'{b}__{a}_sumsq'] = sumsqs[:, j, i]
+                columns[f'{a}__{b}_prod'] = prods[:, i, j]
+
+    df_keys = pd.concat(keys, ignore_index=True)
+    return pd.concat([df_keys, pd.DataFrame(columns, index=df_keys.index)], axis=1)
+
+def combine_moments(frames, medidas=MEDIDAS):
+    """
+    Add up partial moments of the same stations and months.
+
+    Args:
+        frames (list): Moment dataframes with the same columns.
+        medidas (list): Indicator columns.
+
+    Returns:
+        pandas.DataFrame: The combined moments.
+
+    """
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=MOMENT_KEYS + moment_columns(medidas))
+
+    return pd.concat(frames, ignore_index=True).groupby(MOMENT_KEYS)[moment_columns(medidas)].sum().reset_index()
+
+def _split_partitions(df, table):
+    """
+    Split the rows of an aggregate table into its files.
+
+    Args:
+        df (pandas.DataFrame): Rows of the table.
+        table (str): One of ROLLUP_TABLES.
+
+    Yields:
+        tuple: Name of the file ('AAAA-MM', or 'AAAA' for the yearly table) and its rows.
+    """
+    if table == 'ano':
+        for ano, rows in df.groupby('ano'):
+            yield f'{ano}', rows
+        return
+
+    if table == 'dia':
+        periods = [df['data'].dt.year.rename('ano'), df['data'].dt.month.rename('mes')]
+    else:
+        periods = ['ano', 'mes']
+    for (ano, mes), rows in df.groupby(periods):
+        yield f'{ano}-{mes:02}', rows
+
+def _write_partition(df, table, name, root='agregados', last_id=None):
+    path = _partition_path(table, name, root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    arrow_table = pa.Table.from_pandas(df, preserve_index=False)
+    if last_id is not None:
+        arrow_table = arrow_table.replace_schema_metadata({**arrow_table.schema.metadata, LAST_ID_KEY: str(last_id).encode()})
+    tmp_path = path + '.tmp'
+    pq.write_table(arrow_table, tmp_path)
+    os.replace(tmp_path, path)
+
+def _partition_names(table):
+    return sorted(os.path.basename(path)[:-len('.parquet')] for path in glob.glob(os.path.join(rollup_dir(table), '*.parquet')))
+
+def _read_partition(table, name):
+    path = _partition_path(table, name)
+    return pd.read_parquet(path) if os.path.exists(path) else None
+
+def _partition_last_id(table, name):
+    # Arquivos sem o metadado (ou ainda inexistentes) não somaram nenhuma linha do lote
+    path = _partition_path(table, name)
+    if not os.path.exists(path):
+        return -1
+    metadata = pq.read_schema(path).metadata or {}
+    return int(metadata.get(LAST_ID_KEY, b'-1'))
+
+def has_rollups():
+    return all(os.path.isdir(rollup_dir(table)) for table in ROLLUP_TABLES)
+
+def read_rollup(granularity, columns=None, filters=None, months=None):
+    """
+    Read an aggregate table, or only its files of a range of months.
+
+    Args:
+        granularity (str): One of the keys of ROLLUP_KEYS, or MOMENTS_TABLE.
+        columns (list): Columns to read, all of them if None.
+        filters (list): Row filters, as in pandas.read_parquet.
+        months (tuple): First and last month (pandas.Period) to read, all of them if None.
+            The yearly table is read for the years of the range.
+
+    Returns:
+        pandas.DataFrame: The aggregate rows.
+
+    """
+    names = _partition_names(granularity)
+    if not names:
+        raise FileNotFoundError(f'Tabela agregada não encontrada: {rollup_dir(granularity)}')
+
+    selected = names
+    if months is not None:
+        first, last = months
+        if granularity == 'ano':
+            first, last = str(first.year), str(last.year)
+        else:
+            first, last = _month_name(first), _month_name(last)
+        selected = [name for name in names if first <= name <= last]
+
+    if not selected:
+        # Nenhum período no intervalo: tabela vazia, com os tipos das colunas gravadas
+        df = pq.read_schema(_partition_path(granularity, names[0])).empty_table().to_pandas()
+        return df[columns] if columns is not None else df
+
+    paths = [_partition_path(granularity, name) for name in selected]
+    return pq.ParquetDataset(paths, filters=filters).read(columns=columns, use_pandas_metadata=True).to_pandas()
+
+def _month_names(timestamps):
+    return timestamps.dt.strftime('%Y-%m').to_numpy()
+
+def _refresh_months(partitions, last_ids, months, medidas=MEDIDAS):
+    # Recalcula, a partir da tabela fato, os arquivos dos meses dados: mínimos e máximos
+    # não podem ser desfeitos quando uma linha é corrigida
+    frames = [
+        read_facts(columns=['id', 'estacao_key', 'localizacao_key', 'timestamp'] + medidas,
+                   start=month.start_time, end=month.end_time)
+        for month in months
+    ]
+    df = pd.concat(frames, ignore_index=True)
+
+    for granularity in ('dia', 'mes', 'hora'):
+        for name, rows in _split_partitions(aggregate(df, granularity, medidas), granularity):
+            partitions[(granularity, name)] = rows
+    for name, rows in _split_partitions(aggregate_moments(df, medidas), MOMENTS_TABLE):
+        partitions[(MOMENTS_TABLE, name)] = rows
+
+    # Os arquivos refeitos contêm todas as linhas do Parquet, até o seu maior id
+    for name, last_id in df.groupby(_month_names(df['timestamp']))['id'].max().items():
+        for table in MONTH_TABLES:
+            last_ids[(table, name)] = int(last_id)
+
+def _refresh_years(partitions, years, medidas=MEDIDAS):
+    # Os anos afetados são refeitos a partir dos seus meses, já atualizados
+    keys = ['estacao_key', 'localizacao_key'] + ROLLUP_KEYS['ano']
+    for year in years:
+        names = {name for name in _partition_names('mes') if name.startswith(f'{year}-')}
+        names |= {name for table, name in partitions if table == 'mes' and name.startswith(f'{year}-')}
+        df_mes = pd.concat([
+            partitions[('mes', name)] if ('mes', name) in partitions else _read_partition('mes', name)
+            for name in sorted(names)
+        ], ignore_index=True)
+        partitions[('ano', f'{year}')] = combine([df_mes.drop(columns=['mes'])], keys, medidas)
+
+@instrumented('update_rollups')
+def update_rollups(df_facts, df_updated=None):
+    """
+    Fold a batch of new fact rows into the aggregate tables.
+
+    Only the groups (station, location, period) present in the batch change: their counts
+    and sums are increased and their minimums/maximums updated, without reading the fact table.
+    Only the files of the months (and years) of the batch are read and rewritten.
+
+    The months of corrected rows are recomputed from the Parquet fact dataset, which must
+    already hold the corrections and not yet the new rows of the batch.
+
+    The moments of the correlation matrix (see aggregate_moments) are maintained the same way.
+
+    The update can be replayed: each monthly file records the highest fact id folded into
+    it, and the rows of the batch at or below it are skipped. A run interrupted before the
+    fact index was committed writes the same rows with the same ids again, which are then
+    not counted twice. The yearly files are rebuilt from their months.
+
+    Args:
+        df_facts (pandas.DataFrame): New fact rows, indexed by 'id'.
+        df_updated (pandas.DataFrame): Corrected fact rows.
+    """
+    has_updates = df_updated is not None and not df_updated.empty
+    if df_facts.empty and not has_updates:
+        return
+
+    # Arquivos (tabela, período) alterados pelo lote, gravados no final
+    partitions = {}
+    last_ids = {}
+    if has_updates and has_rollups():
+        timestamps = tempo_timestamps(df_updated['tempo_key']).tz_localize(None)
+        _refresh_months(partitions, last_ids, sorted(set(timestamps.to_period('M'))))
+
+    df = df_facts.reset_index()
+    df['timestamp'] = tempo_timestamps(df['tempo_key'])
+
+    for name, rows in df.groupby(_month_names(df['timestamp'])):
+        for table in MONTH_TABLES:
+            if (table, name) not in partitions:
+                partitions[(table, name)] = _read_partition(table, name)
+                last_ids[(table, name)] = _partition_last_id(table, name)
+            rows_new = rows[rows['id'] > last_ids[(table, name)]]
+            if rows_new.empty:
+                continue
+
+            df_old = partitions[(table, name)]
+            if table == MOMENTS_TABLE:
+                df_batch = aggregate_moments(rows_new)
+                partitions[(table, name)] = df_batch if df_old is None else combine_moments([df_old, df_batch])
+            else:
+                df_batch = aggregate(rows_new, table)
+                frames = [df_batch] if df_old is None else [df_old, df_batch]
+                partitions[(table, name)] = combine(frames, ['estacao_key', 'localizacao_key'] + ROLLUP_KEYS[table])
+            last_ids[(table, name)] = int(rows_new['id'].max())
+
+    _refresh_years(partitions, sorted({int(name[:4]) for _, name in partitions}))
+
+    for (table, name), df_partition in partitions.items():
+        if df_partition is not None:
+            _write_partition(df_partition, table, name, last_id=last_ids.get((table, name)))
+
+def backfill_rollups():
+    """
+    Build the aggregate tables from the whole Parquet fact dataset, one record batch at a time.
+    """
+    dataset = ds.dataset(fact_dataset_path(), format='parquet', partitioning=PARTITIONING)
+    columns = ['id', 'estacao_key', 'localizacao_key', 'timestamp'] + MEDIDAS
+
+    rollups = {granularity: [] for granularity in ROLLUP_KEYS}
+    moments = []
+    last_ids = pd.Series(dtype='int64')
+    for batch in dataset.to_batches(columns=columns):
+        df = batch.to_pandas()
+        last_ids = pd.concat([last_ids, df.groupby(_month_names(df['timestamp']))['id'].max()]).groupby(level=0).max()
+        for granularity, period_keys in ROLLUP_KEYS.items():
+            keys = ['estacao_key', 'localizacao_key'] + period_keys
+            rollups[granularity] = [combine(rollups[granularity] + [aggregate(df, granularity)], keys)]
+        moments = [combine_moments(moments + [aggregate_moments(df)])]
+
+    # Gravados em uma pasta temporária, que substitui a anterior (inclusive os arquivos
+    # únicos por tabela de versões anteriores) só quando completa
+    tables = {granularity: combine(rollups[granularity], ['estacao_key', 'localizacao_key'] + period_keys)
+              for granularity, period_keys in ROLLUP_KEYS.items()}
+    tables[MOMENTS_TABLE] = combine_moments(moments)
+
+    root = 'agregados.tmp'
+    shutil.rmtree(parquet_path(root), ignore_errors=True)
+    for table, df_table in tables.items():
+        os.makedirs(rollup_dir(table, root), exist_ok=True)
+        for name, rows in _split_partitions(df_table, table):
+            last_id = int(last_ids[name]) if table in MONTH_TABLES else None
+            _write_partition(rows, table, name, root, last_id)
+    shutil.rmtree(parquet_path('agregados'), ignore_errors=True)
+    os.replace(parquet_path(root), parquet_path('agregados'))
+
+def _month_bounds(start, end):
+    # Primeiro e último mês inteiramente contidos no intervalo [start, end]
+    first = start.to_period('M') if start.day == 1 else start.to_period('M') + 1
+    last = end.to_period('M') if end == end.to_period('M').end_time.normalize() else end.to_period('M') - 1
+    return first, last
+
+def query_rollup(granularity, estacao_keys=None, start=None, end=None, medidas=MEDIDAS):
+    """
+    Aggregates of the given stations over the closed date range [start, end].
+
+    The result is exact for any range of days: whole months come from the monthly (or
+    monthly hour-of-day) aggregate, and the days of the partial months at the edges of the
+    range come from the daily aggregate (or, for 'hora', from at most two months of facts).
+
+    Args:
+        granularity (str): One of the keys of ROLLUP_KEYS.
+        estacao_keys (list): Stations to include, all of them if None.
+        start (datetime-like): First day of the range. Give both 'start' and 'end', or neither
+            (None or NaT: the whole history).
+        end (datetime-like): Last day of the range.
+        medidas (list): Indicators to read.
+
+    Returns:
+        pandas.DataFrame: Aggregates per station, location and the period keys of 'granularity'.
+
+    """
+    keys = ['estacao_key', 'localizacao_key'] + ROLLUP_KEYS[granularity]
+    columns = keys + stat_columns(medidas)
+    filters = [('estacao_key', 'in', list(estacao_keys))] if estacao_keys is not None else []
+
+    if pd.isna(start) or pd.isna(end):
+        return read_rollup(granularity, columns, filters or None)
+
+    start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+
+    if granularity == 'dia':
+        return read_rollup('dia', columns, filters + [('data', '>=', start), ('data', '<=', end)],
+                           months=(start.to_period('M'), end.to_period('M')))
+
+    if granularity == 'ano':
+        df_mes = query_rollup('mes', estacao_keys, start, end, medidas)
+        return combine([df_mes.drop(columns=['mes'])], keys, medidas)
+
+    first, last = _month_bounds(start, end)
+    if first <= last:
+        df_full = read_rollup(granularity, columns, filters or None, months=(first, last))
+        edges = [(start, first.start_time - pd.Timedelta(days=1)), (last.end_time.normalize() + pd.Timedelta(days=1), end)]
+    else:
+        df_full = pd.DataFrame(columns=columns)
+        edges = [(start, end)]
+
+    # Dias dos meses parciais nas bordas do intervalo
+    frames = [df_full]
+    for edge_start, edge_end in edges:
+        if edge_start > edge_end:
+            continue
+        if granularity == 'mes':
+            df_dia = read_rollup('dia', ['estacao_key', 'localizacao_key', 'data'] + stat_columns(medidas),
+                                 filters + [('data', '>=', edge_start), ('data', '<=', edge_end)],
+                                 months=(edge_start.to_period('M'), edge_end.to_period('M')))
+            df_dia['ano'] = df_dia['data'].dt.year
+            df_dia['mes'] = df_dia['data'].dt.month
+            frames.append(combine([df_dia[columns]], keys, medidas))
+        else:
+            df_raw = read_facts(columns=['estacao_key', 'localizacao_key', 'timestamp'] + medidas, estacao_keys=estacao_keys,
+                                start=edge_start, end=edge_end + pd.Timedelta(days=1) - pd.Timedelta(microseconds=1))
+            frames.append(aggregate(df_raw, granularity, medidas))
+
+    return combine(frames, keys, medidas).reset_index(drop=True)
+
+def query_moments(estacao_keys=None, start=None, end=None, medidas=MEDIDAS):
+    """
+    Moments of every pair of the given indicators, summed over the given stations and the
+    closed date range [start, end].
+
+    Whole months come from the moment table, and the days of the partial months at the
+    edges of the range from at most two months of facts, so the cost does not grow with
+    the length of the range.
+
+    Args:
+        estacao_keys (list): Stations to include, all of them if None.
+        start (datetime-like): First day of the range. Give both 'start' and 'end', or neither
+            (None or NaT: the whole history).
+        end (datetime-like): Last day of the range.
+        medidas (list): Indicators to read.
+
+    Returns:
+        pandas.Series: The sums, indexed by the columns of moment_columns.
+
+    """
+    columns = moment_columns(medidas)
+    filters = [('estacao_key', 'in', list(estacao_keys))] if estacao_keys is not None else None
+
+    if pd.isna(start) or pd.isna(end):
+        return read_rollup(MOMENTS_TABLE, columns, filters).sum()
+
+    start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+    first, last = _month_bounds(start, end)
+    if first <= last:
+        frames = [read_rollup(MOMENTS_TABLE, columns, filters, months=(first, last))]
+        edges = [(start, first.start_time - pd.Timedelta(days=1)), (last.end_time.normalize() + pd.Timedelta(days=1), end)]
+    else:
+        frames = []
+        edges = [(start, end)]
+
+    # Dias dos meses parciais nas bordas do intervalo
+    for edge_start, edge_end in edges:
+        if edge_start > edge_end:
+            continue
+        df_raw = read_facts(columns=['estacao_key', 'localizacao_key', 'timestamp'] + _ordered(medidas), estacao_keys=estacao_keys,
+                            start=edge_start, end=edge_end + pd.Timedelta(days=1) - pd.Timedelta(microseconds=1))
+        if not df_raw.empty:
+            frames.append(aggregate_moments(df_raw, medidas)[columns])
+
+    return pd.concat(frames, ignore_index=True).sum() if frames else pd.Series(0.0, index=columns)
+
+def correlation_matrix(moments, medidas):
+    """
+    Pearson correlation of every pair of the given indicators, computed from their moments
+    as DataFrame.corr does from the rows: over the hours where both were measured, and NaN
+    when there are less than two of them or one of the indicators is constant over them.
+
+    Args:
+        moments (pandas.Series): Moments returned by query_moments.
+        medidas (list): Indicators, in the order of the rows and columns of the matrix.
+
+    Returns:
+        pandas.DataFrame: The correlation matrix.
+
+    """
+    position = {medida: i for i, medida in enumerate(MEDIDAS)}
+    matrix = pd.DataFrame(np.nan, index=list(medidas), columns=list(medidas))
+    for a in medidas:
+        for b in medidas:
+            first, second = sorted((a, b), key=position.get)
+            count = moments[f'{first}__{second}_count']
+            if count < 2:
+                continue
+
+            sum_a, sum_b = moments[f'{a}__{b}_sum'], moments[f'{b}__{a}_sum']
+            sumsq_a, sumsq_b = moments[f'{a}__{b}_sumsq'], moments[f'{b}__{a}_sumsq']
+            prod = sumsq_a if a == b else moments[f'{first}__{second}_prod']
+            var_a = sumsq_a - sum_a * sum_a / count
+            var_b = sumsq_b - sum_b * sum_b / count
+
+            # Variância nula a menos do erro de arredondamento das somas: indicador constante
+            if var_a <= 1e-12 * sumsq_a or var_b <= 1e-12 * sumsq_b:
+                continue
+            matrix.loc[a, b] = np.clip((prod - sum_a * sum_b / count) / np.sqrt(var_a * var_b), -1, 1)
+
+    return matrix
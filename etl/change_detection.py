@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from csv_reader import iter_typed_csv
+from hashing import FingerprintIndex, hash_rows
+from star_schema import RAW_DTYPES
+from time_keys import parse_data
+
+CHECKSUM_BLOCK_SIZE = 1 << 20
+
+def file_checksum(path, limit=None):
+    """
+    Compute the checksum of a file, or of its first 'limit' bytes.
+
+    Args:
+        path (str): The path to the file.
+        limit (int): Number of bytes to read, the whole file if None.
+
+    Returns:
+        str: Hex digest (BLAKE2b, 128 bits).
+
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    remaining = limit
+    with open(path, 'rb') as file:
+        while remaining is None or remaining > 0:
+            block = file.read(CHECKSUM_BLOCK_SIZE if remaining is None else min(CHECKSUM_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+
+    return digest.hexdigest()
+
+
+class ChangeDetector:
+    """
+    Find the rows of the source file that were not processed yet.
+
+    The detector keeps, next to the history file, a manifest with the hash of every row
+    already processed ('<history>_manifest.bin') and the state of the source file at the
+    end of the last run ('<history>_state.json'). Three levels are tried in order:
+
+    1. The file size/mtime or checksum matches the last run: nothing to do.
+    2. The file grew and its first bytes are exactly the file of the last run (append-only):
+       only the bytes after the last processed offset are parsed.
+    3. Otherwise the whole file is read in chunks.
+
+    In levels 2 and 3 the rows whose hash is already in the manifest are skipped, so only
+    new or corrected rows are returned.
+
+    Args:
+        file_path (str): The path to the input data file.
+        history_path (str): The path to the history file.
+        chunk_size (int): Number of rows read at a time.
+    """
+
+    def __init__(self, file_path, history_path, chunk_size=100_000):
+        self.file_path = file_path
+        self.history_path = history_path
+        self.chunk_size = chunk_size
+
+        base = os.path.splitext(history_path)[0]
+        self.state_path = base + '_state.json'
+        self.manifest_path = base + '_manifest.bin'
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as state_file:
+                self.state = json.load(state_file)
+        else:
+            self.state = {}
+
+        stat = os.stat(file_path)
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self._checksum = None
+        self._manifest = None
+
+    @property
+    def checksum(self):
+        # Checksum dos bytes existentes no início da execução
+        if self._checksum is None:
+            self._checksum = file_checksum(self.file_path, self.size)
+        return self._checksum
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            if not os.path.exists(self.manifest_path) and os.path.exists(self.history_path):
+                # Histórico criado antes do manifesto: reconstrói uma única vez
+                self._manifest = FingerprintIndex(self.manifest_path, self._history_hashes())
+            else:
+                self._manifest = FingerprintIndex(self.manifest_path)
+        return self._manifest
+
+    def _history_hashes(self):
+        hashes = [np.empty(0, dtype='<u8')]
+        for chunk in iter_typed_csv(self.history_path, RAW_DTYPES, self.chunk_size):
+            # O histórico é gravado pelo pandas, em ISO 8601
+            chunk['data'] = pd.to_datetime(chunk['data'], format='ISO8601', utc=True)
+            hashes.append(hash_rows(chunk))
+        return np.concatenate(hashes)
+
+    def is_unchanged(self):
+        """
+        Returns:
+            bool: True if the source file is the same as in the last run.
+        """
+        if not self.state or self.size != self.state['size']:
+            return False
+        return self.mtime_ns == self.state['mtime_ns'] or self.checksum == self.state['checksum']
+
+    def is_append_only(self):
+        """
+        Returns:
+            bool: True if the source file only had rows appended since the last run.
+        """
+        offset = self.state.get('offset')
+        if not offset or self.size <= offset:
+            return False
+        return file_checksum(self.file_path, offset) == self.state['checksum']
+
+    def _read_chunks(self):
+        if not self.is_append_only():
+            yield from iter_typed_csv(self.file_path, RAW_DTYPES, self.chunk_size)
+            return
+
+        columns = list(pd.read_csv(self.file_path, nrows=0).columns)
+        with open(self.file_path, 'rb') as file:
+            file.seek(self.state['offset'])
+            yield from iter_typed_csv(file, RAW_DTYPES, self.chunk_size, column_names=columns)
+
+    def iter_new_rows(self):
+        """
+        Read the source file and yield the rows not processed yet, chunk by chunk.
+
+        Yields:
+            pandas.DataFrame: New rows, with the 'data' column already converted to
+                datetime; this is the only place where it is parsed.
+        """
+        for chunk in self._read_chunks():
+            chunk['data'] = parse_data(chunk['data'])
+            mask = self.manifest.new_mask(hash_rows(chunk))
+            if mask.any():
+                yield chunk[mask]
+
+    def commit(self, df):
+        """
+        Mark the given rows as processed, appending them to the history file and to the manifest.
+
+        Args:
+            df (pandas.DataFrame): Rows returned by iter_new_rows and already processed.
+        """
+        hashes = hash_rows(df)
+        mask = self.manifest.new_mask(hashes)
+        df = df[mask]
+        if df.empty:
+            return
+
+        df.to_csv(self.history_path, mode='a', header=not os.path.exists(self.history_path), index=False)
+        self.manifest.add(hashes[mask])
+
+        watermark = df['data'].max().isoformat()
+        self.state['watermark'] = max(watermark, self.state.get('watermark') or watermark)
+
+    def save_state(self):
+        """
+        Record the current state of the source file as processed.
+        """
+        with open(self.file_path, 'rb') as file:
+            file.seek(max(self.size - 1, 0))
+            ends_with_newline = file.read(1) == b'\n'
+
+        self.state.update({
+            'size': self.size,
+            'mtime_ns': self.mtime_ns,
+            'checksum': self.checksum,
+            # O deslocamento só é válido se a última linha estiver completa
+            'offset': self.size if ends_with_newline else None,
+        })
+
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(self.state, state_file, indent=2)
+        os.replace(tmp_path, self.state_path)
@@ -0,0 +1,81 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+# Tipos do pyarrow de cada tipo do pandas usado nos esquemas de star_schema
+ARROW_TYPES = {
+    'str': pa.string(),
+    'category': pa.dictionary(pa.int32(), pa.string()),
+    'int8': pa.int8(),
+    'int16': pa.int16(),
+    'int32': pa.int32(),
+    'int64': pa.int64(),
+    'float32': pa.float32(),
+    'float64': pa.float64(),
+}
+
+# Bytes lidos de cada vez pelo leitor em blocos
+BLOCK_SIZE = 8 << 20
+
+def _convert_options(dtypes, columns):
+    return pa_csv.ConvertOptions(
+        column_types={col: ARROW_TYPES[dtype] for col, dtype in dtypes.items()},
+        include_columns=None if columns is None else list(columns),
+    )
+
+def _to_pandas(table, start=0):
+    df = table.to_pandas()
+    df.index = pd.RangeIndex(start, start + len(df))
+    return df
+
+def read_typed_csv(path, dtypes, columns=None):
+    """
+    Read a whole CSV file with the pyarrow parser and the given column types.
+
+    Args:
+        path (str): The path to the CSV file.
+        dtypes (dict): Type of each column (a key of ARROW_TYPES); other columns are inferred.
+        columns (list): Columns to read, all of them if None.
+
+    Returns:
+        pandas.DataFrame: The file contents.
+
+    """
+    return _to_pandas(pa_csv.read_csv(path, convert_options=_convert_options(dtypes, columns)))
+
+def iter_typed_csv(source, dtypes, chunk_size, columns=None, column_names=None, block_size=BLOCK_SIZE):
+    """
+    Read a CSV file in chunks of 'chunk_size' rows with the pyarrow streaming parser and
+    the given column types.
+
+    Args:
+        source (str or file): The path to the CSV file, or a binary file object positioned
+            where the reading starts.
+        dtypes (dict): Type of each column (a key of ARROW_TYPES); other columns are inferred.
+        chunk_size (int): Number of rows per chunk.
+        columns (list): Columns to read, all of them if None.
+        column_names (list): Names of the columns when the source has no header line.
+        block_size (int): Bytes parsed at a time; smaller than the default when only the
+            first rows are needed.
+
+    Yields:
+        pandas.DataFrame: The chunks, numbered from the first row of the source as in
+            pandas.read_csv.
+    """
+    reader = pa_csv.open_csv(
+        source,
+        read_options=pa_csv.ReadOptions(block_size=block_size, column_names=column_names),
+        convert_options=_convert_options(dtypes, columns),
+    )
+
+    start = 0
+    pending = pa.Table.from_batches([], schema=reader.schema)
+    for batch in reader:
+        pending = pa.concat_tables([pending, pa.Table.from_batches([batch])])
+        while pending.num_rows >= chunk_size:
+            yield _to_pandas(pending.slice(0, chunk_size), start)
+            pending = pending.slice(chunk_size)
+            start += chunk_size
+
+    if pending.num_rows:
+        yield _to_pandas(pending, start)
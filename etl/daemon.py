@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import os
+import threading
+import time
+import traceback
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+
+from etl_2 import DEFAULT_CHUNK_SIZE, dados_path, stream_predata_validator
+from freshness import record_batch
+from instrumentation import configure, stage
+from locking import etl_lock
+from parquet_store import DEFAULT_COMPACT_FILES, compact_facts
+from pipeline import DEFAULT_QUEUE_SIZE, pipeline
+from snapshot import publish_snapshot
+from update_bd import DEFAULT_BATCH_SIZE
+
+# Segundos sem novos eventos que encerram uma rajada de escritas no arquivo de entrada
+DEFAULT_SETTLE = 2.0
+
+# Segundos de espera antes de repetir um lote que falhou
+DEFAULT_RETRY = 30.0
+
+# Eventos que indicam uma escrita no arquivo; as aberturas e leituras (inclusive as do
+# próprio ETL) são ignoradas
+WRITE_EVENTS = {'created', 'modified', 'moved', 'closed'}
+
+
+class BurstCollector(FileSystemEventHandler):
+    """
+    Collect the file system events of the watched files and group them into bursts.
+
+    A copy or an append to the input file produces many events in a row; they are
+    coalesced into a single burst, which ends when no event arrives for 'settle' seconds,
+    so that each burst becomes a single micro-batch. Events that arrive while a batch is
+    running start the next burst.
+
+    Args:
+        file_names (list): Names of the watched files, in the watched folder.
+    """
+
+    def __init__(self, file_names):
+        super().__init__()
+        self.file_names = set(file_names)
+        self._condition = threading.Condition()
+        self._first = None
+        self._last = None
+        self._events = 0
+
+    def on_any_event(self, event):
+        paths = [event.src_path, getattr(event, 'dest_path', '')]
+        if event.event_type in WRITE_EVENTS and not event.is_directory and any(os.path.basename(path) in self.file_names for path in paths if path):
+            self.notify()
+
+    def notify(self, arrival=None):
+        """
+        Record an event.
+
+        Args:
+            arrival (float): Time (Unix seconds) the data arrived, the current time if None.
+        """
+        with self._condition:
+            now = time.time()
+            arrival = now if arrival is None else arrival
+            self._first = arrival if self._first is None else min(self._first, arrival)
+            self._last = now
+            self._events += 1
+            self._condition.notify_all()
+
+    def wait_burst(self, settle):
+        """
+        Wait for the next burst of events to end.
+
+        Args:
+            settle (float): Seconds without events that end a burst.
+
+        Returns:
+            tuple: Time (Unix seconds) of the first event of the burst and number of events.
+
+        """
+        with self._condition:
+            # Esperas curtas: o Ctrl+C é atendido mesmo sem eventos
+            while self._first is None or time.time() - self._last < settle:
+                timeout = 1.0 if self._first is None else settle - (time.time() - self._last)
+                self._condition.wait(min(max(timeout, 0.01), 1.0))
+            burst = (self._first, self._events)
+            self._first = self._last = None
+            self._events = 0
+            return burst
+
+def run_batch(file_path, history_path, options):
+    """
+    Run one micro-batch: the streaming ETL of the new rows of the input file, loaded into
+    the database as it goes (see pipeline.py) unless the database is disabled, the
+    compaction of the Parquet partitions left with too many files by the small batches,
+    and the publication of the dashboard snapshot. The ETL lock is held for the whole batch.
+
+    Args:
+        file_path (str): The path to the input data file.
+        history_path (str): The path to the history file.
+        options (dict): Command line options of the daemon.
+
+    Returns:
+        int: Number of fact rows written, new or corrected.
+
+    """
+    with etl_lock():
+        if options['database']:
+            facts = asyncio.run(pipeline(file_path, history_path, options['chunk_size'], options['batch_size'],
+                                         options['queue_size'], options['workers']))
+        else:
+            facts = stream_predata_validator(file_path, history_path, options['chunk_size'], options['workers'])
+        # Antes do snapshot, que refaz os segmentos dos meses compactados
+        compact_facts(options['compact_files'])
+        publish_snapshot()
+    return facts
+
+def process_burst(file_path, history_path, arrival, events, options):
+    """
+    Run the micro-batch of a burst of events and record its freshness: the latency from
+    the arrival of the data to the moment it can be queried (database loaded and snapshot
+    published) is appended to 'dados/freshness.jsonl' and logged as the 'micro_batch'
+    stage.
+
+    Args:
+        file_path (str): The path to the input data file.
+        history_path (str): The path to the history file.
+        arrival (float): Time (Unix seconds) of the first event of the burst.
+        events (int): Number of events of the burst.
+        options (dict): Command line options of the daemon.
+
+    Returns:
+        dict: The freshness record, None if the batch had no new rows.
+
+    """
+    with stage('micro_batch', events=events) as record:
+        started = time.time()
+        facts = run_batch(file_path, history_path, options)
+        queryable = time.time()
+        record['rows_out'] = facts
+        if not facts:
+            return None
+
+        record.update({
+            'arrival': arrival,
+            'started': started,
+            'queryable': queryable,
+            'latency_s': round(queryable - arrival, 3),
+            'run_s': round(queryable - started, 3),
+            'facts': facts,
+            'events': events,
+        })
+        record_batch({key: record[key] for key in ('arrival', 'started', 'queryable', 'latency_s', 'run_s', 'facts', 'events')})
+        return record
+
+def watch(file_path, history_path, options):
+    """
+    Watch the folder of the input file and run a micro-batch for each burst of changes,
+    until interrupted (Ctrl+C).
+
+    Changes made while the daemon was stopped are processed at startup, with the
+    modification time of the file as their arrival.
+
+    Args:
+        file_path (str): The path to the input data file.
+        history_path (str): The path to the history file.
+        options (dict): Command line options of the daemon.
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    collector = BurstCollector([os.path.basename(file_path)])
+    observer = PollingObserver(timeout=options['settle']) if options['polling'] else Observer()
+    observer.schedule(collector, os.path.dirname(file_path), recursive=False)
+    observer.start()
+    print(f"Observando {file_path} (Ctrl+C para encerrar).")
+
+    if os.path.exists(file_path):
+        collector.notify(os.path.getmtime(file_path))
+
+    try:
+        while True:
+            arrival, events = collector.wait_burst(options['settle'])
+            if not os.path.exists(file_path):
+                continue
+            try:
+                record = process_burst(file_path, history_path, arrival, events, options)
+            except Exception:
+                traceback.print_exc()
+                print(f"Falha no lote: nova tentativa em {options['retry']:.0f}s.")
+                time.sleep(options['retry'])
+                collector.notify(arrival)
+                continue
+            if record is not None:
+                print(f"Lote carregado: {record['facts']} registros disponíveis {record['latency_s']:.1f}s após a chegada dos dados "
+                      f"({record['run_s']:.1f}s de processamento).")
+    except KeyboardInterrupt:
+        print("Encerrando.")
+    finally:
+        observer.stop()
+        observer.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Observa a pasta dados e executa o ETL e a carga do banco em micro-lotes a cada mudança do arquivo de entrada.')
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE, help=f'Segundos sem novas escritas que encerram uma rajada de eventos (padrão: {DEFAULT_SETTLE}).')
+    parser.add_argument('--retry', type=float, default=DEFAULT_RETRY, help=f'Segundos de espera antes de repetir um lote que falhou (padrão: {DEFAULT_RETRY}).')
+    parser.add_argument('--no-database', dest='database', action='store_false', help='Executa só o ETL, sem carregar o banco (o dashboard lê o snapshot).')
+    parser.add_argument('--polling', action='store_true', help='Verifica o arquivo periodicamente em vez de usar os eventos do sistema (ex.: pastas de rede).')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help=f'Linhas de entrada por bloco (padrão: {DEFAULT_CHUNK_SIZE}).')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help=f'Linhas por transação (padrão: {DEFAULT_BATCH_SIZE}).')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help=f'Lotes transformados aguardando o banco (padrão: {DEFAULT_QUEUE_SIZE}).')
+    parser.add_argument('--workers', type=int, default=1, help='Com mais de um, as três dimensões são construídas em paralelo (0 = número de núcleos; padrão: 1, serial).')
+    parser.add_argument('--compact-files', type=int, default=DEFAULT_COMPACT_FILES, help=f'Arquivos Parquet de um mês acima dos quais ele é compactado em um só (padrão: {DEFAULT_COMPACT_FILES}).')
+    parser.add_argument('--metrics', help="Arquivo onde o tempo, a memória e as linhas de cada etapa são gravados em JSON lines ('-' para stderr).")
+    parser.add_argument('--profile', help='Pasta onde um relatório do cProfile é gravado para cada etapa.')
+    args = parser.parse_args()
+    configure(args.metrics, args.profile)
+
+    options = vars(args)
+    options['workers'] = args.workers or os.cpu_count()
+    watch(dados_path('dados_iqarj.csv'), dados_path('dados_iqarj_historicos.csv'), options)
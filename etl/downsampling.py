@@ -0,0 +1,44 @@
+import numpy as np
+
+
+def minmax_indices(values, max_points):
+    """
+    Rows to keep to draw the given series with at most 'max_points' points each, preserving
+    their shape (min/max bucketing).
+
+    The rows are split into buckets of consecutive rows, and the rows of the minimum and of
+    the maximum of every series in every bucket are kept, along with the first and last
+    rows: peaks and dips survive, unlike with plain sampling or averaging. The number of
+    buckets is shared by the series, so that the rows kept for all of them together are
+    at most 'max_points' and the series still share the x axis.
+
+    Args:
+        values (numpy.ndarray): The series in the order of the x axis, one column each (or a
+            single series as a 1-D array). Missing values are NaN.
+        max_points (int): Maximum number of rows to keep, at least 4.
+
+    Returns:
+        numpy.ndarray: Sorted positions of the rows to keep, all of them when there are at
+            most 'max_points'.
+
+    """
+    values = np.asarray(values, dtype='float64')
+    if values.ndim == 1:
+        values = values[:, None]
+    n_rows, n_series = values.shape
+    if n_rows <= max_points:
+        return np.arange(n_rows)
+
+    # Matriz (balde, posição no balde, série) completada com NaN: mínimos e máximos de
+    # todos os baldes e séries calculados de uma vez
+    buckets = max(1, (max_points - 2) // (2 * max(n_series, 1)))
+    bucket = np.arange(n_rows) * buckets // n_rows
+    starts = np.searchsorted(bucket, np.arange(buckets))
+    width = np.diff(np.append(starts, n_rows)).max()
+    padded = np.full((buckets, width, n_series), np.nan)
+    padded[bucket, np.arange(n_rows) - starts[bucket]] = values
+
+    missing = np.isnan(padded)
+    lows = starts[:, None] + np.where(missing, np.inf, padded).argmin(axis=1)
+    highs = starts[:, None] + np.where(missing, -np.inf, padded).argmax(axis=1)
+    return np.unique(np.concatenate([[0, n_rows - 1], lows.ravel(), highs.ravel()]))
@@ -1,6 +1,9 @@
 import pandas as pd
 import os
 
+from csv_reader import read_typed_csv
+from star_schema import RAW_DTYPES
+
 def create_df_dtempo(df):
     df_dtempo = pd.DataFrame()
     df_aux = df_dtempo.copy()
@@ -78,7 +81,7 @@ def create_df_fqualidadear(df, df_dtempo, df_dlocalizacao, df_destacao):
 
     return df_fqualidadear
 
-df = pd.read_csv(os.path.join(os.getcwd(), 'dados/dados_iqarj.csv'))
+df = read_typed_csv(os.path.join(os.getcwd(), 'dados/dados_iqarj.csv'), RAW_DTYPES)
 
 # Removendo colunas Sirgas
 df = df.drop(columns=['x_utm_sirgas2000', 'y_utm_sirgas2000'])
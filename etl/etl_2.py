@@ -1,140 +1,317 @@
+import argparse
+import numpy as np
 import pandas as pd
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from aggregates import backfill_rollups, has_rollups, update_rollups
+from change_detection import ChangeDetector
+from csv_reader import iter_typed_csv, read_typed_csv
+from fact_index import FactIndex, fact_index_paths
+from hashing import hash_rows
+from instrumentation import configure, instrumented, stage
+from key_registry import KeyRegistry
+from locking import etl_lock
+from parquet_store import append_facts, backfill_facts, fact_dataset_path, has_facts, parquet_path, update_facts, write_dimension
+from snapshot import publish_snapshot
+from star_schema import DIMENSION_DTYPES, FACT_COLUMNS, FACT_DTYPES, FACT_KEY, MEDIDAS
+from time_keys import dtempo_members, tempo_keys
+
+# Tamanho padrão dos blocos no modo streaming (linhas por bloco)
+DEFAULT_CHUNK_SIZE = 100_000
+
+def dados_path(file_name):
+    return os.path.join(os.getcwd(), 'dados', file_name)
+
+def migrate_tempo_keys():
+    """
+    Convert the time keys of data written when 'tempo_key' was a sequence number to the
+    keys derived from the hour (see time_keys).
 
-def create_df_dtempo(df, df_dtempo_existing):
+    The dimension and fact CSV files are rewritten with the new keys; the fact index
+    and the Parquet copy, which depend on the old keys, are removed and rebuilt from the CSV
+    files. The aggregate tables do not use the key and are kept.
+    """
+    dtempo_path = dados_path('df_dtempo.csv')
+    if not os.path.exists(dtempo_path):
+        return
+
+    df_dtempo = read_typed_csv(dtempo_path, DIMENSION_DTYPES['dtempo'])
+    new_keys = tempo_keys(pd.to_datetime(df_dtempo['timestamp'], format='ISO8601'))
+    if (new_keys == df_dtempo['tempo_key'].to_numpy()).all():
+        return
+
+    print("Convertendo as chaves da dimensão tempo para horas desde 1970-01-01 (UTC).")
+    key_map = pd.Series(new_keys, index=df_dtempo['tempo_key'].to_numpy())
+
+    fact_path = dados_path('df_fqualidadear.csv')
+    if os.path.exists(fact_path):
+        tmp_path = fact_path + '.tmp'
+        for i, chunk in enumerate(iter_typed_csv(fact_path, FACT_DTYPES, DEFAULT_CHUNK_SIZE)):
+            old_keys = chunk['tempo_key'].to_numpy()
+            # Chaves sem correspondência já foram convertidas (execução interrompida)
+            mapped = key_map.reindex(old_keys).to_numpy()
+            chunk['tempo_key'] = np.where(np.isnan(mapped), old_keys, mapped).astype('int64')
+            chunk.to_csv(tmp_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+        os.replace(tmp_path, fact_path)
+
+        # As impressões digitais incluem a chave de tempo
+        for name in ('fingerprints', 'keys'):
+            if os.path.exists(fact_index_paths(fact_path)[name]):
+                os.remove(fact_index_paths(fact_path)[name])
+
+    # Cópia em Parquet refeita por ensure_parquet_outputs
+    shutil.rmtree(fact_dataset_path(), ignore_errors=True)
+    if os.path.exists(parquet_path('dtempo.parquet')):
+        os.remove(parquet_path('dtempo.parquet'))
+
+    df_dtempo['tempo_key'] = new_keys
+    df_dtempo.to_csv(dtempo_path + '.tmp', index=False)
+    os.replace(dtempo_path + '.tmp', dtempo_path)
+
+    print("Chaves convertidas. Recrie o banco de dados (prisma db push --force-reset) e execute update_bd.py novamente.")
+
+def load_key_registries():
     """
-    Create a dataframe for the dimension table 'df_dtempo' based on the given input dataframe and existing 'df_dtempo' dataframe.
+    Load the surrogate key registries of the dimension tables, converting the time keys of
+    data written by older versions first.
+
+    Returns:
+        dict: The KeyRegistry of 'dtempo', 'dlocalizacao' and 'destacao'.
+
+    """
+    migrate_tempo_keys()
+    return {
+        'dtempo': KeyRegistry(dados_path('df_dtempo.csv'), 'tempo_key', ['timestamp'],
+                              columns=['timestamp', 'ano', 'mes', 'dia', 'hora', 'tempo_key'], parse_dates=['timestamp'],
+                              key_function=tempo_keys, dtypes=DIMENSION_DTYPES['dtempo']),
+        'dlocalizacao': KeyRegistry(dados_path('df_dlocalizacao.csv'), 'localizacao_key', ['latitude', 'longitude'],
+                                    columns=['latitude', 'longitude', 'localizacao_key'], dtypes=DIMENSION_DTYPES['dlocalizacao']),
+        'destacao': KeyRegistry(dados_path('df_destacao.csv'), 'estacao_key', ['station_id', 'station_name'],
+                                columns=['station_id', 'station_name', 'estacao_key'], dtypes=DIMENSION_DTYPES['destacao']),
+    }
+
+@instrumented('create_df_dtempo')
+def create_df_dtempo(df, dtempo_registry):
+    """
+    Register the new members of the dimension table 'df_dtempo' found in the given input dataframe.
+
+    The key of each hour is computed from the hour itself (see time_keys), so the members
+    are generated from the unique keys of the input, without lookups.
 
     Args:
-        df (pandas.DataFrame): Input dataframe containing the data.
-        df_dtempo_existing (pandas.DataFrame): Existing 'df_dtempo' dataframe.
+        df (pandas.DataFrame): Input dataframe containing the data, with 'data' already parsed.
+        dtempo_registry (KeyRegistry): Key registry of 'df_dtempo'.
 
     Returns:
         pandas.DataFrame: The updated 'df_dtempo' dataframe.
 
     """
-    df_aux = pd.DataFrame()
-    df_aux['timestamp'] = pd.to_datetime(df['data'])
-
     # Pegar apenas chaves únicas
-    df_dtempo_new = pd.DataFrame({'timestamp': df_aux['timestamp'].unique()})
-
-    df_dtempo_new['ano'] = df_dtempo_new['timestamp'].dt.year
-    df_dtempo_new['mes'] = df_dtempo_new['timestamp'].dt.month
-    df_dtempo_new['dia'] = df_dtempo_new['timestamp'].dt.day
-    df_dtempo_new['hora'] = df_dtempo_new['timestamp'].dt.hour
-
-    if not df_dtempo_existing.empty:
-        df_dtempo_existing['timestamp'] = pd.to_datetime(df_dtempo_existing['timestamp'])
-        df_dtempo_new = df_dtempo_new[~df_dtempo_new['timestamp'].isin(df_dtempo_existing['timestamp'])]
-        df_dtempo_new['tempo_key'] = df_dtempo_existing['tempo_key'].max() + 1 + df_dtempo_new.index
-        df_dtempo_export = pd.concat([df_dtempo_existing, df_dtempo_new])
-    else:
-        df_dtempo_new['tempo_key'] = df_dtempo_new.index + 1
-        df_dtempo_export = df_dtempo_new
+    df_dtempo_new = dtempo_members(np.unique(tempo_keys(df['data'])))
 
-    # df_dtempo_export[['tempo_key', 'ano', 'mes', 'dia', 'hora']].to_csv(os.path.join(os.getcwd(), 'dados/df_dtempo.csv'), index=False)
-    df_dtempo_export.to_csv(os.path.join(os.getcwd(), 'dados/df_dtempo.csv'), index=False)
+    if len(dtempo_registry.register(df_dtempo_new)):
+        write_dimension(dtempo_registry.table, 'dtempo')
+    dtempo_registry.save()
 
-    return df_dtempo_export
-
-def create_df_dlocalizacao(df, df_dlocalizacao_existing):
-    df_aux = df[~df.duplicated(subset=['lat', 'lon'])]
+    return dtempo_registry.table
 
+@instrumented('create_df_dlocalizacao')
+def create_df_dlocalizacao(df, dlocalizacao_registry):
     df_dlocalizacao_new = pd.DataFrame({
-        'latitude': df_aux['lat'],
-        'longitude': df_aux['lon']
+        'latitude': df['lat'],
+        'longitude': df['lon']
     })
 
-    df_dlocalizacao_new = df_dlocalizacao_new.reset_index(drop=True)
-    if not df_dlocalizacao_existing.empty:
-        df_dlocalizacao_new = df_dlocalizacao_new[~df_dlocalizacao_new.apply(lambda x: (x['latitude'], x['longitude']), axis=1).isin(
-            df_dlocalizacao_existing.apply(lambda x: (x['latitude'], x['longitude']), axis=1))]
-        df_dlocalizacao_new['localizacao_key'] = df_dlocalizacao_existing['localizacao_key'].max() + 1 + df_dlocalizacao_new.index
-        df_dlocalizacao_export = pd.concat([df_dlocalizacao_existing, df_dlocalizacao_new])
-    else:
-        df_dlocalizacao_new['localizacao_key'] = df_dlocalizacao_new.index + 1
-        df_dlocalizacao_export = df_dlocalizacao_new
-
-    df_dlocalizacao_export.to_csv(os.path.join(os.getcwd(), 'dados/df_dlocalizacao.csv'), index=False)
+    if len(dlocalizacao_registry.register(df_dlocalizacao_new)):
+        write_dimension(dlocalizacao_registry.table, 'dlocalizacao')
+    dlocalizacao_registry.save()
 
-    return df_dlocalizacao_export
-
-def create_df_destacao(df, df_destacao_existing):
-    df_aux = df[~df.duplicated(subset=['codnum', 'estação'])]
+    return dlocalizacao_registry.table
 
+@instrumented('create_df_destacao')
+def create_df_destacao(df, destacao_registry):
     df_destacao_new = pd.DataFrame({
-        'station_id': df_aux['codnum'],
-        'station_name': df_aux['estação']
+        'station_id': df['codnum'],
+        'station_name': df['estação']
     })
 
-    df_destacao_new = df_destacao_new.reset_index(drop=True)
-    if not df_destacao_existing.empty:
-        df_destacao_new = df_destacao_new[~df_destacao_new.apply(lambda x: (x['station_id'], x['station_name']), axis=1).isin(
-            df_destacao_existing.apply(lambda x: (x['station_id'], x['station_name']), axis=1))]
-        df_destacao_new['estacao_key'] = df_destacao_existing['estacao_key'].max() + 1 + df_destacao_new.index
-        df_destacao_export = pd.concat([df_destacao_existing, df_destacao_new])
-    else:
-        df_destacao_new['estacao_key'] = df_destacao_new.index + 1
-        df_destacao_export = df_destacao_new
+    if len(destacao_registry.register(df_destacao_new)):
+        write_dimension(destacao_registry.table, 'destacao')
+    destacao_registry.save()
 
-    df_destacao_export.to_csv(os.path.join(os.getcwd(), 'dados/df_destacao.csv'), index=False)
+    return destacao_registry.table
 
-    return df_destacao_export
+def create_dimensions(df, registries, parallel=False):
+    """
+    Register the new members of the three dimension tables found in the given input dataframe.
+
+    Each dimension has its own registry and files, so in parallel mode the three builds run
+    concurrently; the keys they assign are the same as in a serial run.
 
-def create_df_fqualidadear(df, df_dtempo, df_dlocalizacao, df_destacao, df_fqualidadear_existing):
+    Args:
+        df (pandas.DataFrame): Input dataframe containing the data.
+        registries (dict): The key registries returned by load_key_registries.
+        parallel (bool): Run the three builds in separate threads.
+    """
+    builds = [
+        (create_df_dtempo, registries['dtempo']),
+        (create_df_dlocalizacao, registries['dlocalizacao']),
+        (create_df_destacao, registries['destacao']),
+    ]
+
+    if not parallel:
+        for create, registry in builds:
+            create(df, registry)
+        return
+
+    with ThreadPoolExecutor(max_workers=len(builds)) as executor:
+        for future in [executor.submit(create, df, registry) for create, registry in builds]:
+            future.result()
+
+def resolve_fact_rows(df, registries):
     """
-    Create a new DataFrame for fqualidadear data by merging and processing the given input DataFrames.
+    Resolve the dimension keys of the given rows, keeping the index of the input dataframe.
 
     Args:
         df (pandas.DataFrame): The main DataFrame containing the data.
-        df_dtempo (pandas.DataFrame): The DataFrame containing time-related data.
-        df_dlocalizacao (pandas.DataFrame): The DataFrame containing location-related data.
-        df_destacao (pandas.DataFrame): The DataFrame containing station-related data.
-        df_fqualidadear_existing (pandas.DataFrame): The existing DataFrame for fqualidadear data.
+        registries (dict): The key registries returned by load_key_registries.
 
     Returns:
-        pandas.DataFrame: The resulting DataFrame for fqualidadear data.
+        pandas.DataFrame: The fact rows that have all their keys, with the columns listed in FACT_COLUMNS.
 
     """
-    df_aux = df.copy()
-    df_aux['timestamp'] = pd.to_datetime(df['data'])
+    df_keys = pd.DataFrame({
+        'tempo_key': tempo_keys(df['data']),
+        'estacao_key': registries['destacao'].lookup(df['codnum'], df['estação']),
+        'localizacao_key': registries['dlocalizacao'].lookup(df['lat'], df['lon']),
+    }, index=df.index)
 
-    df_dtempo['timestamp'] = pd.to_datetime(df_dtempo['timestamp'])
-    df_tempo_key = pd.merge(df_aux, df_dtempo, left_on=['timestamp'], right_on=['timestamp'], how='inner')
+    df_fqualidadear_new = pd.concat([df_keys, df[MEDIDAS]], axis=1).astype({col: FACT_DTYPES[col] for col in FACT_COLUMNS})
 
-    df_localizacao_key = pd.merge(df_tempo_key, df_dlocalizacao, left_on=['lat', 'lon'], right_on=['latitude', 'longitude'], how='inner')
-    df_estacao_key = pd.merge(df_localizacao_key, df_destacao, left_on=['codnum', 'estação'], right_on=['station_id', 'station_name'], how='inner')
+    # Linhas sem chave em alguma dimensão são descartadas
+    return df_fqualidadear_new[(df_keys != -1).all(axis=1)]
 
-    df_fqualidadear_new = df_estacao_key[['tempo_key', 'estacao_key', 'localizacao_key', 'chuva', 'pres', 'rs', 'temp',
-       'ur', 'dir_vento', 'vel_vento', 'so2', 'no2', 'hcnm', 'hct', 'ch4', 'co', 'no', 'nox', 'o3', 'pm10', 'pm2_5']]
+@instrumented('create_df_fqualidadear')
+def create_df_fqualidadear(df, registries, fact_index):
+    """
+    Create the new rows of the fact table 'df_fqualidadear' by resolving the dimension keys of the given input DataFrame.
 
-    if not df_fqualidadear_existing.empty:
-        df_fqualidadear_new = df_fqualidadear_new[~df_fqualidadear_new.apply(tuple, axis=1).isin(df_fqualidadear_existing.apply(tuple, axis=1))]
-        df_fqualidadear_export = pd.concat([df_fqualidadear_existing, df_fqualidadear_new])
-    else:
-        df_fqualidadear_export = df_fqualidadear_new
+    The rows are matched to the fact table by their natural key (time, station and
+    location) through its fact index. Rows of new keys are appended to 'df_fqualidadear.csv'
+    and to the Parquet dataset partitioned by year/month, and folded into the aggregate
+    tables used by the dashboard; rows that correct the values of a known key replace it,
+    keeping its 'id', in the CSV log, in their Parquet partition and in the aggregates of
+    their month. Rows identical to the stored ones are skipped.
+
+    Args:
+        df (pandas.DataFrame): The main DataFrame containing the data.
+        registries (dict): The key registries returned by load_key_registries.
+        fact_index (FactIndex): Index of the fact table.
 
-    # Remove duplicates based on specified columns
-    df_fqualidadear_export = df_fqualidadear_export.drop_duplicates(subset=['tempo_key', 'estacao_key', 'localizacao_key', 'chuva', 'pres', 'rs', 'temp', 'ur', 'dir_vento', 'vel_vento', 'so2', 'no2', 'hcnm', 'hct', 'ch4', 'co', 'no', 'nox', 'o3', 'pm10', 'pm2_5'])
+    Returns:
+        pandas.DataFrame: The fact rows added to or corrected in 'df_fqualidadear', indexed by 'id'.
 
-    # Remove 'id' columns if they exist
-    df_fqualidadear_export = df_fqualidadear_export.loc[:, ~df_fqualidadear_export.columns.str.startswith('id')]
+    """
+    # Busca vetorizada nos registros de chaves: dividi-la entre processos custa mais, em
+    # cópias dos registros, do que a própria busca
+    df_fqualidadear_new = resolve_fact_rows(df, registries).reset_index(drop=True)
+
+    # As correções são aplicadas ao Parquet antes do recálculo dos agregados dos seus meses,
+    # e as linhas novas só depois dele
+    return fact_index.upsert(df_fqualidadear_new, sinks=[
+        lambda df_new, df_updated: update_facts(df_updated, len(fact_index)),
+        update_rollups,
+        lambda df_new, df_updated: append_facts(df_new),
+    ])
+
+def migrate_fact_duplicates():
+    """
+    Merge the fact rows of the same natural key written when the fact table was
+    deduplicated on whole rows, and a correction of the source became a second row.
 
-    # Add a new 'id' column
-    df_fqualidadear_export.reset_index(drop=True, inplace=True)
-    df_fqualidadear_export.index.name = 'id'
-    
-    df_fqualidadear_export.to_csv(os.path.join(os.getcwd(), 'dados/df_fqualidadear.csv'), index=True)
+    Each natural key keeps the position of its first row and the values of its last one.
+    The ids are renumbered so that they stay contiguous, and the outputs derived from the
+    fact table (index, Parquet copy and aggregate tables) are rebuilt from it.
+    """
+    fact_path = dados_path('df_fqualidadear.csv')
+    paths = fact_index_paths(fact_path)
+    if not os.path.exists(fact_path) or os.path.exists(paths['keys']):
+        return
+
+    df_log = pd.concat([
+        pd.DataFrame({'id': chunk['id'].to_numpy(), 'key': hash_rows(chunk[FACT_KEY])})
+        for chunk in iter_typed_csv(fact_path, FACT_DTYPES, DEFAULT_CHUNK_SIZE, columns=['id'] + FACT_KEY)
+    ], ignore_index=True)
+    df_rows = df_log[~df_log['id'].duplicated(keep='last')]
+    if not df_rows['key'].duplicated().any():
+        return
+
+    print("Unindo linhas repetidas da tabela fato (mesma hora, estação e localização).")
+    by_key = df_rows.groupby('key')['id']
+    df_kept = df_rows[df_rows['id'] == by_key.transform('max')]
+    new_ids = by_key.transform('min')[df_kept.index].rank(method='first').astype('int64') - 1
+
+    new_id_of_line = np.full(len(df_log), -1, dtype='int64')
+    new_id_of_line[df_kept.index] = new_ids.to_numpy()
+
+    tmp_path = fact_path + '.tmp'
+    start = 0
+    for i, chunk in enumerate(iter_typed_csv(fact_path, FACT_DTYPES, DEFAULT_CHUNK_SIZE)):
+        chunk_ids = new_id_of_line[start:start + len(chunk)]
+        start += len(chunk)
+        chunk = chunk[chunk_ids >= 0].assign(id=chunk_ids[chunk_ids >= 0])
+        chunk.to_csv(tmp_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    os.replace(tmp_path, fact_path)
+
+    # Índice, cópia em Parquet e agregados refeitos a partir da tabela fato
+    for path in paths.values():
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(fact_dataset_path(), ignore_errors=True)
+    shutil.rmtree(parquet_path('agregados'), ignore_errors=True)
+
+    print(f"{len(df_rows) - len(df_kept)} linhas unidas. Recrie o banco de dados (prisma db push --force-reset) e execute update_bd.py novamente.")
+
+def load_fact_index():
+    """
+    Load the index of the fact table, merging the repeated rows of data written by older
+    versions first.
+
+    Returns:
+        FactIndex: The index of 'df_fqualidadear.csv'.
+
+    """
+    migrate_fact_duplicates()
+    return FactIndex(dados_path('df_fqualidadear.csv'), FACT_COLUMNS, FACT_KEY)
 
-    return df_fqualidadear_export
+def ensure_parquet_outputs(registries, fact_index):
+    """
+    Create the Parquet copies and the aggregate tables of data written before they existed.
 
-def etl_function(df):
+    Args:
+        registries (dict): The key registries returned by load_key_registries.
+        fact_index (FactIndex): Index of the fact table.
+    """
+    for name, registry in registries.items():
+        if len(registry) and not os.path.exists(parquet_path(f'{name}.parquet')):
+            write_dimension(registry.table, name)
+
+    if len(fact_index) and not has_facts():
+        backfill_facts(dados_path('df_fqualidadear.csv'))
+
+    if len(fact_index) and not has_rollups():
+        backfill_rollups()
+
+@instrumented('etl_function')
+def etl_function(df, workers=1):
     """
     Performs the ETL (Extract, Transform, Load) process on the given DataFrame.
 
     Parameters:
     - df (pandas.DataFrame): The input DataFrame containing the data to be processed.
+    - workers (int): With more than one, the three dimension tables are built concurrently.
 
     This function drops unnecessary columns from the input DataFrame and creates or updates
     several other DataFrames based on the extracted data. The resulting DataFrames are then
@@ -143,26 +320,106 @@ def etl_function(df):
     df = df.drop(columns=['x_utm_sirgas2000', 'y_utm_sirgas2000'])
 
     # Carregar os DataFrames existentes, se existirem
-    df_dtempo_existing = pd.read_csv(os.path.join(os.getcwd(), 'dados/df_dtempo.csv')) if os.path.exists(os.path.join(os.getcwd(), 'dados/df_dtempo.csv')) else pd.DataFrame(columns=['tempo_key', 'ano', 'mes', 'dia', 'hora', 'timestamp'])
-    df_dlocalizacao_existing = pd.read_csv(os.path.join(os.getcwd(), 'dados/df_dlocalizacao.csv')) if os.path.exists(os.path.join(os.getcwd(), 'dados/df_dlocalizacao.csv')) else pd.DataFrame(columns=['localizacao_key', 'latitude', 'longitude'])
-    df_destacao_existing = pd.read_csv(os.path.join(os.getcwd(), 'dados/df_destacao.csv')) if os.path.exists(os.path.join(os.getcwd(), 'dados/df_destacao.csv')) else pd.DataFrame(columns=['estacao_key', 'station_id', 'station_name'])
-    df_fqualidadear_existing = pd.read_csv(os.path.join(os.getcwd(), 'dados/df_fqualidadear.csv')) if os.path.exists(os.path.join(os.getcwd(), 'dados/df_fqualidadear.csv')) else pd.DataFrame(columns=['tempo_key', 'estacao_key', 'localizacao_key', 'chuva', 'pres', 'rs', 'temp', 'ur', 'dir_vento', 'vel_vento', 'so2', 'no2', 'hcnm', 'hct', 'ch4', 'co', 'no', 'nox', 'o3', 'pm10', 'pm2_5'])
-
-    df_dtempo = create_df_dtempo(df, df_dtempo_existing)
-    df_dlocalizacao = create_df_dlocalizacao(df, df_dlocalizacao_existing)
-    df_destacao = create_df_destacao(df, df_destacao_existing)
-    df_fqualidadear = create_df_fqualidadear(df, df_dtempo, df_dlocalizacao, df_destacao, df_fqualidadear_existing)
+    registries = load_key_registries()
+    fact_index = load_fact_index()
+    ensure_parquet_outputs(registries, fact_index)
+
+    create_dimensions(df, registries, parallel=workers > 1)
+    df_fqualidadear = create_df_fqualidadear(df, registries, fact_index)
     
     print(df_fqualidadear)
 
-def predata_validator(file_path, history_path, etl_function):
+@instrumented('etl_chunk')
+def etl_chunk(df, state):
+    """
+    Performs the ETL process on a single chunk, appending the new fact rows to 'df_fqualidadear.csv'.
+
+    Args:
+        df (pandas.DataFrame): The chunk of input data.
+        state (dict): Streaming state shared between chunks: the dimension key
+            registries ('registries'), the fact index ('fact_index') and the
+            number of workers ('workers'; with more than one, the dimension tables are
+            built concurrently).
+
+    Returns:
+        pandas.DataFrame: The fact rows appended or corrected, indexed by 'id'.
+
+    """
+    df = df.drop(columns=['x_utm_sirgas2000', 'y_utm_sirgas2000'])
+
+    registries = state['registries']
+    create_dimensions(df, registries, parallel=state['workers'] > 1)
+
+    return create_df_fqualidadear(df, registries, state['fact_index'])
+
+@instrumented('stream_predata_validator')
+def stream_predata_validator(file_path, history_path, chunk_size=DEFAULT_CHUNK_SIZE, workers=1):
+    """
+    Streaming version of predata_validator: processes the input file in chunks of
+    'chunk_size' rows so that peak memory does not depend on the size of the file.
+
+    Each chunk has the rows already present in the history removed, goes through the
+    dimension and fact builders and is appended to the history and fact files.
+
+    Args:
+        file_path (str): The path to the input data file.
+        history_path (str): The path to the history file.
+        chunk_size (int): Number of rows processed at a time.
+        workers (int): With more than one, the dimension tables of each chunk are built
+            concurrently.
+
+    Returns:
+        int: Number of fact rows written, new or corrected.
+
+    Raises:
+        FileNotFoundError: If the input data file does not exist.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"O arquivo {file_path} não foi encontrado.")
+
+    detector = ChangeDetector(file_path, history_path, chunk_size)
+    if detector.is_unchanged():
+        print("Nenhuma diferença encontrada. Processo de ETL não necessário.")
+        return 0
+
+    state = {
+        'registries': load_key_registries(),
+        'fact_index': load_fact_index(),
+        'workers': workers,
+    }
+    ensure_parquet_outputs(state['registries'], state['fact_index'])
+
+    total_rows = 0
+    total_facts = 0
+    for chunk in detector.iter_new_rows():
+        total_facts += len(etl_chunk(chunk, state))
+        total_rows += len(chunk)
+
+        # Atualiza o arquivo de histórico com as linhas do bloco
+        detector.commit(chunk)
+
+    detector.save_state()
+
+    if total_rows == 0:
+        print("Nenhuma diferença encontrada. Processo de ETL não necessário.")
+    else:
+        print(f"{total_rows} linhas novas processadas, {total_facts} registros adicionados ou corrigidos na tabela fato.")
+    return total_facts
+
+@instrumented('predata_validator')
+def predata_validator(file_path, history_path, etl_function, chunk_size=DEFAULT_CHUNK_SIZE):
     """
     Validates the input data file and performs the ETL process if necessary.
 
+    Changes are found by a ChangeDetector: an unchanged file is skipped by its checksum, an
+    append-only file is only read from the last processed offset, and in any case only the
+    rows missing from the history manifest are passed to the ETL function.
+
     Args:
         file_path (str): The path to the input data file.
         history_path (str): The path to the history file.
         etl_function (function): The function to be used for the ETL process.
+        chunk_size (int): Number of rows read at a time while looking for changes.
 
     Raises:
         FileNotFoundError: If the input data file does not exist.
@@ -170,38 +427,54 @@ def predata_validator(file_path, history_path, etl_function):
     # Verifica se os arquivos existem
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"O arquivo {file_path} não foi encontrado.")
-    
-    current_df = pd.read_csv(file_path)
-    current_df['data'] = pd.to_datetime(current_df['data'])
-    
-    if os.path.exists(history_path):
-        history_df = pd.read_csv(history_path)
-        history_df['data'] = pd.to_datetime(history_df['data'])
-        
-        # Verifica se os DataFrames são iguais
-        if current_df.equals(history_df):
-            print("Nenhuma diferença encontrada. Processo de ETL não necessário.")
-            return
-        
-        # Encontra as diferenças
-        differences = pd.concat([current_df, history_df]).drop_duplicates(keep=False)
-
-        if differences.empty:
-            print("Nenhuma diferença encontrada. Processo de ETL não necessário.")
-            return
-        
-        # Processa as diferenças usando a função ETL fornecida
-        etl_function(differences)
-        
-        # Atualiza o arquivo de histórico
-        history_df = pd.concat([history_df, differences]).drop_duplicates()
-        history_df.to_csv(history_path, index=False)
-    else:
-        print("Arquivo de histórico não encontrado. Processando todo o arquivo atual.")
-        etl_function(current_df)
-        current_df.to_csv(history_path, index=False)
-
-file_path = os.path.join(os.getcwd(), 'dados/dados_iqarj.csv')
-history_path = os.path.join(os.getcwd(), 'dados/dados_iqarj_historicos.csv')
 
-predata_validator(file_path, history_path, etl_function)
+    detector = ChangeDetector(file_path, history_path, chunk_size)
+
+    # Verifica se o arquivo mudou desde a última execução
+    if detector.is_unchanged():
+        print("Nenhuma diferença encontrada. Processo de ETL não necessário.")
+        return
+
+    # Encontra as diferenças
+    with stage('change_detection') as record:
+        differences = list(detector.iter_new_rows())
+        record['rows_out'] = sum(len(chunk) for chunk in differences)
+
+    if not differences:
+        print("Nenhuma diferença encontrada. Processo de ETL não necessário.")
+        detector.save_state()
+        return
+
+    differences = pd.concat(differences)
+
+    # Processa as diferenças usando a função ETL fornecida
+    etl_function(differences)
+
+    # Atualiza o arquivo de histórico
+    with stage('history_commit', rows_in=len(differences)):
+        detector.commit(differences)
+        detector.save_state()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Executa o ETL dos dados de qualidade do ar.')
+    parser.add_argument('--streaming', action='store_true', help='Processa o arquivo em blocos, com uso de memória limitado.')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help=f'Linhas por bloco no modo streaming (padrão: {DEFAULT_CHUNK_SIZE}).')
+    parser.add_argument('--workers', type=int, default=1, help='Com mais de um, as três dimensões são construídas em paralelo (0 = número de núcleos; padrão: 1, serial).')
+    parser.add_argument('--metrics', help="Arquivo onde o tempo, a memória e as linhas de cada etapa são gravados em JSON lines ('-' para stderr).")
+    parser.add_argument('--profile', help='Pasta onde um relatório do cProfile é gravado para cada etapa.')
+    args = parser.parse_args()
+    configure(args.metrics, args.profile)
+    workers = args.workers or os.cpu_count()
+
+    file_path = dados_path('dados_iqarj.csv')
+    history_path = dados_path('dados_iqarj_historicos.csv')
+
+    # Uma execução por vez, inclusive em relação ao daemon e à carga do banco
+    with etl_lock():
+        if args.streaming:
+            stream_predata_validator(file_path, history_path, args.chunk_size, workers)
+        else:
+            predata_validator(file_path, history_path, lambda df: etl_function(df, workers), args.chunk_size)
+
+        # Nova versão do snapshot lido pelo dashboard, se os dados mudaram
+        publish_snapshot()
@@ -0,0 +1,231 @@
+import os
+import numpy as np
+import pandas as pd
+
+from csv_reader import iter_typed_csv, read_typed_csv
+from hashing import hash_rows
+from instrumentation import instrumented
+from star_schema import FACT_DTYPES
+
+
+def fact_index_paths(fact_path):
+    """
+    Args:
+        fact_path (str): The path to the fact CSV file.
+
+    Returns:
+        dict: Paths of the binary files of the index: row fingerprints ('fingerprints'),
+            natural key fingerprints ('keys') and ids of corrected rows ('corrections').
+
+    """
+    base = os.path.splitext(fact_path)[0]
+    return {
+        'fingerprints': base + '_fingerprints.bin',
+        'keys': base + '_keys.bin',
+        'corrections': base + '_corrections.bin',
+    }
+
+def read_fact_log(fact_path, columns=None, chunk_size=100_000):
+    """
+    Read the fact CSV chunk by chunk, keeping only the current version of each row.
+
+    Corrections are appended to the fact CSV with the 'id' of the row they replace, so the
+    last line of each id is its current version.
+
+    Args:
+        fact_path (str): The path to the fact CSV file.
+        columns (list): Columns to read besides 'id', all of them if None.
+        chunk_size (int): Number of lines read at a time.
+
+    Yields:
+        pandas.DataFrame: The current rows of each chunk, with the 'id' column.
+    """
+    ids = read_typed_csv(fact_path, FACT_DTYPES, columns=['id'])['id']
+    current = ~ids.duplicated(keep='last').to_numpy()
+
+    usecols = None if columns is None else ['id'] + [col for col in columns if col != 'id']
+    start = 0
+    for chunk in iter_typed_csv(fact_path, FACT_DTYPES, chunk_size, columns=usecols):
+        mask = current[start:start + len(chunk)]
+        start += len(chunk)
+        yield chunk[mask]
+
+def read_correction_ids(fact_path, offset=0):
+    """
+    Args:
+        fact_path (str): The path to the fact CSV file.
+        offset (int): Number of entries of the corrections log to skip.
+
+    Returns:
+        numpy.ndarray: The ids corrected after the first 'offset' entries of the log.
+
+    """
+    path = fact_index_paths(fact_path)['corrections']
+    if not os.path.exists(path):
+        return np.empty(0, dtype='<i8')
+    return np.fromfile(path, dtype='<i8', offset=offset * 8)
+
+
+class FactIndex:
+    """
+    Persistent index of the rows of the fact table, keyed by their natural key.
+
+    Every fact row has an 'id', its position in the index, and two 64-bit fingerprints (see
+    hash_rows) stored at that position in binary files next to the fact CSV: one of its
+    natural key (time, station and location), which never changes, and one of the whole row.
+    A new batch is resolved against a hash index of the natural keys: rows with a new key are
+    appended with the next ids, rows of a known key with different values (corrections
+    published by the source) replace the row with that id, and identical rows are skipped.
+    The fact table thus keeps one row per station-hour, and an incremental run never reads
+    or rewrites the existing fact table.
+
+    The ids of the corrected rows are also appended to a corrections log, which the
+    database load uses to find the rows it has to update.
+
+    Args:
+        fact_path (str): The path to the fact CSV file.
+        columns (list): The fact columns that make up the row fingerprint.
+        key_columns (list): The fact columns that make up the natural key.
+        chunk_size (int): Rows read at a time when the index has to be rebuilt.
+    """
+
+    def __init__(self, fact_path, columns, key_columns, chunk_size=100_000):
+        self.fact_path = fact_path
+        self.columns = list(columns)
+        self.key_columns = list(key_columns)
+        self.paths = fact_index_paths(fact_path)
+
+        keys, fingerprints = (self._read(name) for name in ('keys', 'fingerprints'))
+        if os.path.exists(fact_path) and (keys is None or fingerprints is None or len(keys) != len(fingerprints)):
+            # Índice ausente, criado antes das chaves naturais ou interrompido entre as
+            # escritas dos dois arquivos: reconstrói a partir da tabela fato
+            keys, fingerprints = self._rebuild(chunk_size)
+            keys.tofile(self.paths['keys'])
+            fingerprints.tofile(self.paths['fingerprints'])
+        elif keys is None or fingerprints is None:
+            keys = fingerprints = np.empty(0, dtype='<u8')
+
+        self._fingerprints = fingerprints.copy()
+        self._base_count = len(keys)
+        self._key_index = pd.Index(keys)
+        self._added_keys = []
+        self._added_index = pd.Index(np.empty(0, dtype='<u8'))
+
+    def _read(self, name):
+        path = self.paths[name]
+        return np.fromfile(path, dtype='<u8') if os.path.exists(path) else None
+
+    def _rebuild(self, chunk_size):
+        frames = [pd.DataFrame({'id': np.empty(0, dtype='int64'), 'key': np.empty(0, dtype='<u8'), 'fingerprint': np.empty(0, dtype='<u8')})]
+        for chunk in read_fact_log(self.fact_path, self.columns, chunk_size):
+            frames.append(pd.DataFrame({
+                'id': chunk['id'].to_numpy(),
+                'key': hash_rows(chunk[self.key_columns]),
+                'fingerprint': hash_rows(chunk[self.columns]),
+            }))
+
+        df = pd.concat(frames, ignore_index=True).sort_values('id')
+        if not np.array_equal(df['id'].to_numpy(), np.arange(len(df))):
+            raise ValueError(f'Os ids de {self.fact_path} não são contíguos.')
+        if df['key'].duplicated().any():
+            raise ValueError(f'{self.fact_path} tem mais de uma linha por chave natural.')
+
+        return df['key'].to_numpy(dtype='<u8'), df['fingerprint'].to_numpy(dtype='<u8')
+
+    def __len__(self):
+        return self._base_count + len(self._added_index)
+
+    @property
+    def corrections(self):
+        """
+        Returns:
+            int: Number of entries of the corrections log.
+        """
+        path = self.paths['corrections']
+        return os.path.getsize(path) // 8 if os.path.exists(path) else 0
+
+    def lookup(self, keys):
+        """
+        Args:
+            keys (numpy.ndarray): Natural key fingerprints.
+
+        Returns:
+            numpy.ndarray: The id of the row of each key, -1 where the key is not indexed.
+
+        """
+        ids = self._key_index.get_indexer(keys)
+        if len(self._added_index):
+            missing = ids == -1
+            added = self._added_index.get_indexer(keys[missing])
+            ids[missing] = np.where(added >= 0, added + self._base_count, -1)
+        return ids
+
+    @instrumented('fact_index_upsert')
+    def upsert(self, df, sinks=()):
+        """
+        Write the rows of the given dataframe that are new or changed.
+
+        Args:
+            df (pandas.DataFrame): Fact rows, with the fingerprint columns, in the order of
+                the source: when a natural key appears more than once, its last row wins.
+            sinks (iterable): Extra outputs, callables that receive the new rows and the
+                corrected rows (both indexed by 'id') before the index is committed. A run
+                interrupted before the commit calls them again with the same rows and ids,
+                so they must be idempotent: replace what they wrote, never add to it.
+
+        Returns:
+            pandas.DataFrame: The rows written, new and corrected, indexed by 'id'.
+
+        """
+        keys = hash_rows(df[self.key_columns])
+        fingerprints = hash_rows(df[self.columns])
+
+        latest = ~pd.Series(keys).duplicated(keep='last').to_numpy()
+        ids = self.lookup(keys)
+        new_mask = latest & (ids == -1)
+        changed_mask = latest & (ids >= 0)
+        changed_mask[changed_mask] = self._fingerprints[ids[changed_mask]] != fingerprints[changed_mask]
+
+        next_id = len(self)
+        df_new = df[new_mask]
+        df_new.index = pd.RangeIndex(next_id, next_id + len(df_new), name='id')
+        df_updated = df[changed_mask]
+        df_updated.index = pd.Index(ids[changed_mask], name='id')
+
+        df_written = pd.concat([df_new, df_updated]) if len(df_updated) else df_new
+        if df_written.empty:
+            return df_written
+
+        # A tabela fato é gravada antes do índice, e as correções entram no log antes de
+        # suas impressões digitais: uma falha no meio do caminho faz a próxima execução
+        # gravar de novo as mesmas linhas, com os mesmos ids. O log da tabela fato guarda a
+        # última versão de cada id, mas as saídas extras só podem ser repetidas se não
+        # somarem de novo o que já gravaram (veja update_rollups)
+        df_written.to_csv(self.fact_path, mode='a', header=not os.path.exists(self.fact_path), index=True)
+        for sink in sinks:
+            sink(df_new, df_updated)
+        self._commit(keys[new_mask], fingerprints[new_mask], df_updated.index.to_numpy(), fingerprints[changed_mask])
+
+        return df_written
+
+    def _commit(self, new_keys, new_fingerprints, updated_ids, updated_fingerprints):
+        if len(updated_ids):
+            with open(self.paths['corrections'], 'ab') as log_file:
+                updated_ids.astype('<i8').tofile(log_file)
+
+            stored = np.memmap(self.paths['fingerprints'], dtype='<u8', mode='r+')
+            stored[updated_ids] = updated_fingerprints
+            stored.flush()
+            del stored
+            self._fingerprints[updated_ids] = updated_fingerprints
+
+        if len(new_keys):
+            with open(self.paths['fingerprints'], 'ab') as index_file:
+                new_fingerprints.astype('<u8').tofile(index_file)
+            # O arquivo de chaves é o último: seu tamanho define o próximo id
+            with open(self.paths['keys'], 'ab') as index_file:
+                new_keys.astype('<u8').tofile(index_file)
+
+            self._fingerprints = np.concatenate([self._fingerprints, new_fingerprints])
+            self._added_keys.append(new_keys)
+            self._added_index = pd.Index(np.concatenate(self._added_keys))
@@ -0,0 +1,47 @@
+import json
+import os
+
+# Uma linha JSON por lote processado pelo daemon (ver daemon.py)
+FRESHNESS_FILE = 'freshness.jsonl'
+
+# Bytes lidos do final do arquivo: o suficiente para algumas centenas de lotes
+TAIL_BYTES = 1 << 16
+
+def freshness_path():
+    return os.path.join(os.getcwd(), 'dados', FRESHNESS_FILE)
+
+def record_batch(record):
+    """
+    Append the freshness record of a micro-batch to 'dados/freshness.jsonl'.
+
+    Args:
+        record (dict): Times (Unix seconds) of arrival of the data and of the end of the
+            load, latency and number of rows of the batch.
+    """
+    with open(freshness_path(), 'a', encoding='utf-8') as freshness_file:
+        freshness_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def read_batches(limit=100):
+    """
+    Read the last freshness records, without reading the whole file.
+
+    Args:
+        limit (int): Maximum number of records.
+
+    Returns:
+        list: The records (dict), oldest first; empty if no batch was recorded.
+
+    """
+    path = freshness_path()
+    if not os.path.exists(path):
+        return []
+
+    with open(path, 'rb') as freshness_file:
+        size = freshness_file.seek(0, os.SEEK_END)
+        freshness_file.seek(max(0, size - TAIL_BYTES))
+        lines = freshness_file.read().splitlines()
+    if size > TAIL_BYTES:
+        # A primeira linha lida pode estar cortada
+        lines = lines[1:]
+
+    return [json.loads(line) for line in lines if line.strip()][-limit:]
@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+def _normalize(values):
+    if pd.api.types.is_float_dtype(values):
+        values = values.astype('float32')
+    return values.astype('float64')
+
+def hash_rows(df):
+    """
+    Compute a 64-bit hash for every row of the given dataframe.
+
+    Numeric columns are cast to float64 before hashing so that the same row hashes
+    identically whether it was read as int or float (e.g. a chunk without NaNs). Float
+    columns are rounded to float32 first, the type of the measurements (see star_schema),
+    so that a row also hashes identically whether it was read as float32 or float64.
+
+    Args:
+        df (pandas.DataFrame): Dataframe whose rows should be hashed.
+
+    Returns:
+        numpy.ndarray: Array of uint64 hashes, one per row.
+
+    """
+    normalized = pd.DataFrame({
+        col: _normalize(df[col]) if pd.api.types.is_numeric_dtype(df[col]) else df[col]
+        for col in df.columns
+    })
+    return pd.util.hash_pandas_object(normalized, index=False).to_numpy()
+
+
+class FingerprintIndex:
+    """
+    Append-only binary file of 64-bit fingerprints with an in-memory hash index.
+
+    Args:
+        path (str): The path to the fingerprint file.
+        fingerprints (numpy.ndarray): Initial fingerprints, written to 'path' when given
+            (used to build the file from existing data); otherwise the file is loaded.
+    """
+
+    def __init__(self, path, fingerprints=None):
+        self.path = path
+
+        if fingerprints is not None:
+            fingerprints = np.asarray(fingerprints, dtype='<u8')
+            fingerprints.tofile(path)
+        elif os.path.exists(path):
+            fingerprints = np.fromfile(path, dtype='<u8')
+        else:
+            fingerprints = np.empty(0, dtype='<u8')
+
+        self._count = len(fingerprints)
+        self._index = pd.Index(pd.unique(fingerprints))
+        self._added = []
+        self._added_index = pd.Index(np.empty(0, dtype='<u8'))
+
+    def __len__(self):
+        return self._count
+
+    def contains(self, fingerprints):
+        """
+        Args:
+            fingerprints (numpy.ndarray): Fingerprints to look up.
+
+        Returns:
+            numpy.ndarray: Boolean mask, True where the fingerprint is already indexed.
+
+        """
+        found = self._index.get_indexer(fingerprints) >= 0
+        if len(self._added_index):
+            found |= self._added_index.get_indexer(fingerprints) >= 0
+        return found
+
+    def new_mask(self, fingerprints):
+        """
+        Args:
+            fingerprints (numpy.ndarray): Fingerprints to look up.
+
+        Returns:
+            numpy.ndarray: Boolean mask, True for the first occurrence of each fingerprint
+                that is not indexed yet.
+
+        """
+        return ~self.contains(fingerprints) & ~pd.Series(fingerprints).duplicated().to_numpy()
+
+    def add(self, fingerprints):
+        """
+        Append the given fingerprints to the file and to the index.
+
+        Args:
+            fingerprints (numpy.ndarray): Fingerprints to add.
+        """
+        fingerprints = np.asarray(fingerprints, dtype='<u8')
+        if not len(fingerprints):
+            return
+
+        with open(self.path, 'ab') as index_file:
+            fingerprints.tofile(index_file)
+
+        self._count += len(fingerprints)
+        self._added.append(fingerprints)
+        self._added_index = pd.Index(np.concatenate(self._added))
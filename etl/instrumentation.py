@@ -0,0 +1,171 @@
+import cProfile
+import functools
+import io
+import itertools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Windows: sem o pico de memória nas medições
+    resource = None
+
+# Configuração lida do ambiente, para valer também em processos que não recebem argumentos
+# (ex.: o dashboard): arquivo JSON lines das medições ('-' para stderr) e pasta dos perfis
+LOG_ENV = 'INSTRUMENTATION_LOG'
+PROFILE_ENV = 'INSTRUMENTATION_PROFILE'
+
+# Número de linhas listadas no relatório de texto de cada perfil
+PROFILE_REPORT_LINES = 40
+
+# Pilha de perfis ativos de cada thread
+_local = threading.local()
+_sequence = itertools.count(1)
+
+def configure(log_path=None, profile_dir=None):
+    """
+    Enable the instrumentation of this process and of the processes it starts.
+
+    Args:
+        log_path (str): File where one JSON line is appended per stage, '-' for stderr.
+        profile_dir (str): Folder where a cProfile dump and report are written per stage.
+    """
+    if log_path:
+        os.environ[LOG_ENV] = log_path
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        os.environ[PROFILE_ENV] = profile_dir
+
+def is_enabled():
+    return bool(os.environ.get(LOG_ENV) or os.environ.get(PROFILE_ENV))
+
+def peak_rss_mb():
+    # ru_maxrss é dado em KB no Linux e em bytes no macOS; None onde não há o módulo resource
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def emit(record):
+    """
+    Write a measurement as one JSON line to the configured log (stderr if the log is '-'),
+    if a log is configured.
+
+    Args:
+        record (dict): The measurement.
+    """
+    log_path = os.environ.get(LOG_ENV)
+    if not log_path:
+        return
+
+    line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+    if log_path == '-':
+        sys.stderr.write(line)
+    else:
+        with open(log_path, 'a', encoding='utf-8') as log_file:
+            log_file.write(line)
+
+def _dump_profile(profiler, name):
+    profile_dir = os.environ[PROFILE_ENV]
+    base = os.path.join(profile_dir, f'{name}-{os.getpid()}-{next(_sequence):04d}')
+    profiler.dump_stats(base + '.prof')
+
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+    with open(base + '.txt', 'w', encoding='utf-8') as report_file:
+        report_file.write(report.getvalue())
+
+@contextmanager
+def stage(name, **fields):
+    """
+    Measure a stage of the pipeline: wall time, peak RSS of the process at the end of the
+    stage and any field the caller adds to the yielded record (e.g. row counts).
+
+    In profiler mode each stage also gets its own cProfile dump ('.prof') and report
+    ('.txt'). Only one profiler runs at a time in each thread: a nested stage pauses the
+    profiler of the enclosing stage, so each dump only has the time spent outside its
+    nested stages.
+
+    Args:
+        name (str): Name of the stage.
+        **fields: Fields added to the record.
+
+    Yields:
+        dict: The record that will be written when the stage ends.
+    """
+    record = {'stage': name, **fields}
+    if not is_enabled():
+        yield record
+        return
+
+    profilers = _local.__dict__.setdefault('profilers', [])
+    profiler = None
+    if os.environ.get(PROFILE_ENV):
+        if profilers:
+            profilers[-1].disable()
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            profilers.append(profiler)
+        except ValueError:
+            # Outro perfil já ativo no interpretador (ex.: em outra thread): etapa sem perfil
+            profiler = None
+            if profilers:
+                profilers[-1].enable()
+
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        wall_time = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profilers.pop()
+            _dump_profile(profiler, name)
+            if profilers:
+                profilers[-1].enable()
+
+        peak = peak_rss_mb()
+        record.update({
+            'wall_time_s': round(wall_time, 6),
+            'peak_rss_mb': None if peak is None else round(peak, 1),
+            'pid': os.getpid(),
+            'at': time.time(),
+        })
+        emit(record)
+
+def instrumented(name):
+    """
+    Decorator that measures every call of a function as a stage.
+
+    The record has 'rows_in' (rows of the first DataFrame argument) and 'rows_out' (rows of
+    the returned DataFrame, or the returned integer).
+
+    Args:
+        name (str): Name of the stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name) as record:
+                df = next((arg for arg in itertools.chain(args, kwargs.values()) if isinstance(arg, pd.DataFrame)), None)
+                if df is not None:
+                    record['rows_in'] = len(df)
+
+                result = function(*args, **kwargs)
+
+                if isinstance(result, pd.DataFrame):
+                    record['rows_out'] = len(result)
+                elif isinstance(result, int):
+                    record['rows_out'] = result
+                return result
+        return wrapper
+    return decorator
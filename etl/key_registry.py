@@ -0,0 +1,136 @@
+import os
+import numpy as np
+import pandas as pd
+
+from csv_reader import read_typed_csv
+
+
+class KeyRegistry:
+    """
+    Persistent mapping from the natural key of a dimension to its surrogate key.
+
+    The registry is backed by the dimension CSV itself: it is loaded once, kept in memory
+    behind a hash index (pandas Index/MultiIndex) and new members are appended to the file.
+    A whole batch of natural keys is resolved with a single vectorized lookup.
+
+    Args:
+        path (str): The path to the dimension CSV file.
+        key_column (str): Name of the surrogate key column.
+        natural_key (list): Columns that make up the natural key.
+        columns (list): Column order used when the file does not exist yet.
+        parse_dates (iterable): Columns converted with pd.to_datetime when loading, in the
+            ISO 8601 format written by pandas.
+        key_function (callable): Derives the surrogate keys from the natural key columns of
+            new members (same arguments as 'lookup'); keys are sequential when None.
+        dtypes (dict): Column types (see star_schema), used to read the file and kept by
+            the new members; the 'parse_dates' columns are only read with them.
+    """
+
+    def __init__(self, path, key_column, natural_key, columns, parse_dates=(), key_function=None, dtypes=None):
+        self.path = path
+        self.key_column = key_column
+        self.natural_key = list(natural_key)
+        self.key_function = key_function
+        self.dtypes = {col: dtype for col, dtype in (dtypes or {}).items() if col not in parse_dates}
+
+        if os.path.exists(path):
+            self.table = read_typed_csv(path, dtypes or {})
+            for col in parse_dates:
+                self.table[col] = pd.to_datetime(self.table[col], format='ISO8601')
+        else:
+            self.table = pd.DataFrame(columns=columns).astype(self.dtypes)
+
+        self.columns = list(self.table.columns)
+        self._pending = []
+        self._rebuild_index()
+
+    def _make_index(self, arrays):
+        if len(arrays) == 1:
+            return pd.Index(arrays[0])
+        return pd.MultiIndex.from_arrays(arrays)
+
+    def _rebuild_index(self):
+        self._index = self._make_index([self.table[col] for col in self.natural_key])
+        self._keys = self.table[self.key_column].to_numpy(dtype='int64')
+        self._key_index = pd.Index(self._keys)
+
+    def __len__(self):
+        return len(self.table)
+
+    def next_key(self):
+        """
+        Returns:
+            int: The surrogate key that will be given to the next new member.
+        """
+        return int(self._keys.max()) + 1 if len(self._keys) else 1
+
+    def lookup(self, *columns):
+        """
+        Resolve a batch of natural keys to surrogate keys.
+
+        Args:
+            *columns: One Series/array per natural key column, in the order of 'natural_key'.
+
+        Returns:
+            numpy.ndarray: The surrogate keys, -1 where the natural key is not registered.
+
+        """
+        positions = self._index.get_indexer(self._make_index(list(columns)))
+        keys = np.full(len(positions), -1, dtype='int64')
+        found = positions >= 0
+        keys[found] = self._keys[positions[found]]
+        return keys
+
+    def members(self, keys):
+        """
+        Args:
+            keys (array-like): Surrogate keys, all registered.
+
+        Returns:
+            pandas.DataFrame: The dimension rows of the given keys, in the same order.
+
+        """
+        return self.table.iloc[self._key_index.get_indexer(keys)].reset_index(drop=True)
+
+    def register(self, df_members):
+        """
+        Add the members of the given dataframe that are not registered yet.
+
+        Args:
+            df_members (pandas.DataFrame): Candidate members, with the natural key and
+                attribute columns of the dimension (without the surrogate key).
+
+        Returns:
+            pandas.DataFrame: The new members, with their surrogate keys.
+
+        """
+        candidates = df_members.drop_duplicates(subset=self.natural_key)
+        candidates = candidates[self.lookup(*[candidates[col] for col in self.natural_key]) == -1]
+
+        df_new = candidates.reset_index(drop=True)
+        if self.key_function is not None:
+            df_new[self.key_column] = self.key_function(*[df_new[col] for col in self.natural_key])
+        else:
+            start = self.next_key()
+            df_new[self.key_column] = np.arange(start, start + len(df_new), dtype='int64')
+        df_new = df_new[self.columns].astype(self.dtypes)
+        if df_new.empty:
+            return df_new
+
+        # As categorias dos novos membros são unidas às da tabela
+        self.table = df_new if self.table.empty else pd.concat([self.table, df_new], ignore_index=True).astype(self.dtypes)
+        self._pending.append(df_new)
+        self._rebuild_index()
+
+        return df_new
+
+    def save(self):
+        """
+        Append the members registered since the last save to the dimension CSV file.
+        """
+        if not self._pending:
+            return
+
+        df_new = pd.concat(self._pending)
+        df_new.to_csv(self.path, mode='a', header=not os.path.exists(self.path), index=False)
+        self._pending = []
@@ -0,0 +1,58 @@
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: trava de um byte do arquivo com o msvcrt
+    fcntl = None
+    import msvcrt
+
+# Arquivo travado durante cada execução que escreve os dados (ETL, carga do banco, daemon)
+LOCK_FILE = 'etl.lock'
+
+def lock_path():
+    return os.path.join(os.getcwd(), 'dados', LOCK_FILE)
+
+def _try_lock(lock_file):
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+@contextmanager
+def etl_lock(poll_interval=1.0):
+    """
+    Hold the lock of the data folder, so that runs of the ETL, of the database load and of
+    the daemon never overlap, even in different processes.
+
+    The lock is an OS lock on 'dados/etl.lock': it is released when the process ends, even
+    if it is killed, so a crash never leaves a stale lock behind.
+
+    Args:
+        poll_interval (float): Seconds between attempts while another run holds the lock.
+
+    Yields:
+        None
+    """
+    path = lock_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a+') as lock_file:
+        if not _try_lock(lock_file):
+            print('Aguardando o fim de outra execução do ETL...')
+            while not _try_lock(lock_file):
+                time.sleep(poll_interval)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
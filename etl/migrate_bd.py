@@ -0,0 +1,118 @@
+import os
+import sys
+import argparse
+import sqlite3
+import subprocess
+from contextlib import closing
+
+from locking import etl_lock
+from star_schema import MEDIDAS
+from time_keys import HOUR_NS
+from warehouse import database_path, has_database, has_legacy_layout
+
+# Cópia do banco no layout anterior, mantida após a migração
+BACKUP_SUFFIX = '.v1'
+
+# Cópia de cada tabela do banco anterior ('antigo') para o novo: as chaves de texto viram
+# inteiros e DTempo ganha o timestamp (ms desde a época), derivado da chave em horas
+MIGRATIONS = {
+    'DTempo': (
+        'tempo_key, timestamp, ano, mes, dia, hora',
+        f'CAST(tempo_key AS INTEGER), CAST(tempo_key AS INTEGER) * {HOUR_NS // 10**6}, ano, mes, dia, hora',
+    ),
+    'DLocalizacao': (
+        'localizacao_key, latitude, longitude',
+        'CAST(localizacao_key AS INTEGER), latitude, longitude',
+    ),
+    'DEstacao': (
+        'estacao_key, station_id, station_name',
+        'CAST(estacao_key AS INTEGER), station_id, station_name',
+    ),
+    'FQualidadeAr': (
+        'id, tempo_key, estacao_key, localizacao_key, ' + ', '.join(MEDIDAS),
+        'CAST(id AS INTEGER), CAST(tempo_key AS INTEGER), CAST(estacao_key AS INTEGER), CAST(localizacao_key AS INTEGER), ' + ', '.join(MEDIDAS),
+    ),
+    'LoadState': ('table_name, last_key', 'table_name, last_key'),
+}
+
+# Horas de DTempo cuja chave não é o número de horas desde a época (chaves sequenciais,
+# anteriores à versão do ETL que deriva a chave da hora)
+MISMATCHED_KEYS_QUERY = (
+    'SELECT COUNT(*) FROM antigo.DTempo '
+    "WHERE CAST(tempo_key AS INTEGER) * 3600 != CAST(strftime('%s', printf('%04d-%02d-%02d %02d:00:00', ano, mes, dia, hora)) AS INTEGER)"
+)
+
+def create_database(schema_path):
+    # O layout atual é o do schema.prisma, criado pelo próprio Prisma
+    subprocess.run([sys.executable, '-m', 'prisma', 'db', 'push', '--skip-generate', '--schema', schema_path], check=True)
+
+def migrate(schema_path):
+    """
+    Migrate 'database.db' from the text (cuid) keys of the previous layout of schema.prisma
+    to the integer keys of the current one.
+
+    SQLite cannot change the type of a column in place, so the database is renamed to a
+    backup, an empty database is created with the current schema and every table is copied
+    from the backup in a single transaction, converting the keys and filling
+    'DTempo.timestamp'. The load watermarks of 'LoadState' are kept, so update_bd.py goes
+    on from where it stopped.
+
+    Args:
+        schema_path (str): The path to schema.prisma.
+
+    Returns:
+        dict: Number of rows copied per table, empty if there was nothing to migrate.
+
+    """
+    path = database_path()
+    if not has_database() or not has_legacy_layout():
+        return {}
+
+    backup_path = path + BACKUP_SUFFIX
+    if os.path.exists(backup_path):
+        raise RuntimeError(f'{backup_path} já existe: remova-o antes de migrar novamente.')
+
+    # Grava o WAL no arquivo principal antes de renomeá-lo
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('PRAGMA journal_mode = DELETE')
+    os.replace(path, backup_path)
+
+    try:
+        create_database(schema_path)
+        counts = {}
+        with closing(sqlite3.connect(path, isolation_level=None)) as conn:
+            conn.execute('ATTACH DATABASE ? AS antigo', (backup_path,))
+            if conn.execute(MISMATCHED_KEYS_QUERY).fetchone()[0]:
+                raise RuntimeError('As chaves de DTempo no banco não correspondem às do ETL (geradas por uma versão anterior). '
+                                   'Recrie o banco com `prisma db push --force-reset` e execute a carga novamente.')
+
+            conn.execute('BEGIN')
+            for table, (columns, values) in MIGRATIONS.items():
+                conn.execute(f'INSERT INTO {table} ({columns}) SELECT {values} FROM antigo.{table}')
+                counts[table] = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                if counts[table] != conn.execute(f'SELECT COUNT(*) FROM antigo.{table}').fetchone()[0]:
+                    raise RuntimeError(f'A cópia da tabela {table} está incompleta.')
+            conn.execute('COMMIT')
+    except BaseException:
+        # Devolve o banco original
+        if os.path.exists(path):
+            os.remove(path)
+        os.replace(backup_path, path)
+        raise
+
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migra o database.db para as chaves inteiras do schema.prisma atual.')
+    parser.add_argument('--schema', default='schema.prisma', help='Caminho do schema.prisma (padrão: schema.prisma).')
+    args = parser.parse_args()
+
+    with etl_lock():
+        counts = migrate(args.schema)
+    if not counts:
+        print('Nada a migrar: o banco não existe ou já usa as chaves inteiras.')
+    else:
+        for table, count in counts.items():
+            print(f'{count} registros migrados na tabela {table}')
+        print(f'O banco anterior foi mantido em {database_path() + BACKUP_SUFFIX}.')
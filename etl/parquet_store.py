@@ -0,0 +1,283 @@
+import glob
+import hashlib
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from fact_index import read_fact_log
+from instrumentation import instrumented
+from star_schema import FACT_DTYPES
+from time_keys import tempo_timestamps
+
+PARTITIONING = ds.partitioning(pa.schema([('ano', pa.int16()), ('mes', pa.int8())]), flavor='hive')
+
+# Arquivos de uma partição acima dos quais ela é compactada em um só
+DEFAULT_COMPACT_FILES = 16
+
+def parquet_path(*parts):
+    return os.path.join(os.getcwd(), 'dados', 'parquet', *parts)
+
+def fact_dataset_path():
+    return parquet_path('fqualidadear')
+
+def has_facts():
+    return os.path.isdir(fact_dataset_path())
+
+def dataset_version():
+    """
+    Signature of every Parquet file written by the ETL.
+
+    Files are only ever added or replaced atomically, so the (path, size, mtime) of each of
+    them changes whenever the data changes; readers use this to invalidate their caches.
+
+    Returns:
+        str: Hex digest of the file list, empty if there is no Parquet output yet.
+
+    """
+    root = parquet_path()
+    digest = hashlib.blake2b(digest_size=16)
+    found = False
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith('.parquet'):
+                continue
+            stat = os.stat(os.path.join(dirpath, filename))
+            relpath = os.path.relpath(os.path.join(dirpath, filename), root)
+            digest.update(f'{relpath}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+            found = True
+
+    return digest.hexdigest() if found else ''
+
+def partition_versions():
+    """
+    Signature of the files of each 'ano=YYYY/mes=M' partition of the Parquet fact dataset,
+    as in dataset_version: it changes whenever rows are added to or corrected in the
+    partition.
+
+    Returns:
+        dict: Hex digest per (ano, mes), for the partitions with files.
+
+    """
+    versions = {}
+    for directory in sorted(glob.glob(os.path.join(fact_dataset_path(), 'ano=*', 'mes=*'))):
+        paths = sorted(glob.glob(os.path.join(directory, '*.parquet')))
+        if not paths:
+            continue
+        digest = hashlib.blake2b(digest_size=16)
+        for path in paths:
+            stat = os.stat(path)
+            digest.update(f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+        ano = int(os.path.basename(os.path.dirname(directory)).split('=')[1])
+        mes = int(os.path.basename(directory).split('=')[1])
+        versions[(ano, mes)] = digest.hexdigest()
+
+    return versions
+
+def write_dimension(df, name):
+    """
+    Write a dimension table as a single Parquet file, replacing the previous one atomically.
+
+    Args:
+        df (pandas.DataFrame): The dimension table.
+        name (str): Name of the dimension ('dtempo', 'dlocalizacao' or 'destacao').
+    """
+    os.makedirs(parquet_path(), exist_ok=True)
+    path = parquet_path(f'{name}.parquet')
+    tmp_path = path + '.tmp'
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+def _partitioned_rows(df_facts):
+    # Linhas no formato do dataset: 'id' como coluna, hora, ano e mês derivados da chave de tempo
+    df = df_facts.reset_index()
+    timestamps = tempo_timestamps(df['tempo_key'])
+    df['timestamp'] = timestamps
+    df['ano'] = timestamps.year.astype('int16')
+    df['mes'] = timestamps.month.astype('int8')
+    df = df.astype(FACT_DTYPES)
+    return df.sort_values(['estacao_key', 'timestamp'])
+
+def partition_path(ano, mes):
+    return os.path.join(fact_dataset_path(), f'ano={ano}', f'mes={mes}')
+
+def _replace_partition(directory, df_partition, file_name, old_files):
+    # Arquivos iniciados por '.' são ignorados pelos leitores do dataset
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, file_name)
+    tmp_path = os.path.join(directory, '.' + file_name + '.tmp')
+    df_partition.sort_values(['estacao_key', 'timestamp']).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    for old_path in old_files:
+        if old_path != path:
+            os.remove(old_path)
+
+@instrumented('parquet_append_facts')
+def append_facts(df_facts):
+    """
+    Append a batch of fact rows to the Parquet dataset partitioned by year/month.
+
+    Each batch becomes new files inside its 'ano=YYYY/mes=M' partitions, named after the
+    first 'id' of the batch, so existing files are never rewritten and writing the same
+    batch again (e.g. after a crash) replaces its own files instead of duplicating rows.
+    Rows are sorted by station and timestamp so that the row group statistics allow
+    predicate pushdown on both.
+
+    Args:
+        df_facts (pandas.DataFrame): New fact rows, indexed by 'id'.
+    """
+    if df_facts.empty:
+        return
+
+    df = _partitioned_rows(df_facts)
+
+    ds.write_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        fact_dataset_path(),
+        format='parquet',
+        partitioning=PARTITIONING,
+        basename_template=f"part-{int(df['id'].min()):012d}-{{i}}.parquet",
+        existing_data_behavior='overwrite_or_ignore',
+    )
+
+@instrumented('parquet_update_facts')
+def update_facts(df_facts, next_id):
+    """
+    Replace rows of the Parquet fact dataset in place, by 'id'.
+
+    A corrected row keeps its natural key, so it stays in the same 'ano=YYYY/mes=M'
+    partition: only the partitions of the given rows are rewritten, each one into a single
+    file that replaces all of its previous files. Rows with an id of 'next_id' or above
+    (left by an interrupted run, and written again by append_facts) are dropped.
+
+    Args:
+        df_facts (pandas.DataFrame): Corrected fact rows, indexed by 'id'.
+        next_id (int): The first id not committed to the fact index.
+    """
+    if df_facts.empty:
+        return
+
+    df = _partitioned_rows(df_facts)
+    for (ano, mes), df_partition in df.groupby(['ano', 'mes']):
+        directory = partition_path(ano, mes)
+        old_files = sorted(glob.glob(os.path.join(directory, '*.parquet')))
+
+        df_partition = df_partition.drop(columns=['ano', 'mes'])
+        frames = [pd.read_parquet(path) for path in old_files]
+        if frames:
+            df_old = pd.concat(frames, ignore_index=True).drop_duplicates('id', keep='last')
+            df_old = df_old[(df_old['id'] < next_id) & ~df_old['id'].isin(df_partition['id'])]
+            df_partition = pd.concat([df_old[df_partition.columns], df_partition], ignore_index=True)
+
+        _replace_partition(directory, df_partition, f"part-{int(df_partition['id'].min()):012d}-r{next_id}.parquet", old_files)
+
+@instrumented('parquet_compact_facts')
+def compact_facts(max_files=DEFAULT_COMPACT_FILES):
+    """
+    Rewrite each partition of the Parquet fact dataset that has more than 'max_files'
+    files into a single file, as update_facts does.
+
+    Every append_facts call adds files to the partitions of its batch, so a long run of
+    small batches (e.g. the micro-batches of the daemon) would leave hundreds of files per
+    month, all of them listed by dataset_version and opened by every reader.
+
+    Args:
+        max_files (int): Number of files above which a partition is compacted.
+
+    Returns:
+        int: Number of partitions compacted.
+
+    """
+    compacted = 0
+    for directory in sorted(glob.glob(os.path.join(fact_dataset_path(), 'ano=*', 'mes=*'))):
+        old_files = sorted(glob.glob(os.path.join(directory, '*.parquet')))
+        if len(old_files) <= max_files:
+            continue
+
+        # Uma compactação interrompida antes de remover os arquivos antigos deixa linhas repetidas
+        df_partition = pd.concat([pd.read_parquet(path) for path in old_files], ignore_index=True).drop_duplicates('id', keep='last')
+        file_name = f"part-{int(df_partition['id'].min()):012d}-c{int(df_partition['id'].max()):012d}.parquet"
+        _replace_partition(directory, df_partition, file_name, old_files)
+        compacted += 1
+
+    return compacted
+
+def backfill_facts(fact_path, chunk_size=100_000):
+    """
+    Create the Parquet fact dataset from an existing 'df_fqualidadear.csv', with the
+    current version of each row.
+
+    Args:
+        fact_path (str): The path to the fact CSV file.
+        chunk_size (int): Number of rows converted at a time.
+    """
+    for chunk in read_fact_log(fact_path, chunk_size=chunk_size):
+        append_facts(chunk.set_index('id'))
+
+def read_dimension(name, columns=None):
+    """
+    Args:
+        name (str): Name of the dimension ('dtempo', 'dlocalizacao' or 'destacao').
+        columns (list): Columns to read, all of them if None.
+
+    Returns:
+        pandas.DataFrame: The dimension table.
+
+    """
+    return pd.read_parquet(parquet_path(f'{name}.parquet'), columns=columns)
+
+def _bound_filter(timestamp, timestamp_type, lower):
+    # A condição sobre 'ano'/'mes' permite descartar partições inteiras
+    ano, mes = ds.field('ano'), ds.field('mes')
+    bound = pa.scalar(timestamp, timestamp_type)
+    if lower:
+        period = (ano > timestamp.year) | ((ano == timestamp.year) & (mes >= timestamp.month))
+        return period & (ds.field('timestamp') >= bound)
+    period = (ano < timestamp.year) | ((ano == timestamp.year) & (mes <= timestamp.month))
+    return period & (ds.field('timestamp') <= bound)
+
+def read_facts(columns=None, estacao_keys=None, start=None, end=None, after_id=None, ids=None):
+    """
+    Read the fact table from the Parquet dataset, loading only what is needed.
+
+    The date range prunes the 'ano'/'mes' partitions that are out of range, and both the
+    station and date filters are pushed down to the Parquet row groups.
+
+    Args:
+        columns (list): Columns to read, all of them (except the partition columns) if None.
+        estacao_keys (list): Only read the facts of these stations.
+        start (datetime-like): Only read facts with timestamp >= start.
+        end (datetime-like): Only read facts with timestamp <= end.
+        after_id (int): Only read facts with id > after_id.
+        ids (list): Only read the facts with these ids.
+
+    Returns:
+        pandas.DataFrame: The fact rows.
+
+    """
+    dataset = ds.dataset(fact_dataset_path(), format='parquet', partitioning=PARTITIONING)
+    timestamp_type = dataset.schema.field('timestamp').type
+
+    conditions = []
+    if after_id is not None:
+        conditions.append(ds.field('id') > after_id)
+    if ids is not None:
+        conditions.append(ds.field('id').isin(list(ids)))
+    if estacao_keys is not None:
+        conditions.append(ds.field('estacao_key').isin(list(estacao_keys)))
+    for bound, lower in ((start, True), (end, False)):
+        if bound is not None:
+            bound = pd.Timestamp(bound)
+            if getattr(timestamp_type, 'tz', None) and bound.tzinfo is None:
+                bound = bound.tz_localize(timestamp_type.tz)
+            conditions.append(_bound_filter(bound, timestamp_type, lower))
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name not in ('ano', 'mes')]
+
+    return dataset.to_table(columns=list(columns), filter=expression).to_pandas()
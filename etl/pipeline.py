@@ -0,0 +1,184 @@
+import argparse
+import asyncio
+import os
+import time
+
+from change_detection import ChangeDetector
+from etl_2 import DEFAULT_CHUNK_SIZE, dados_path, ensure_parquet_outputs, etl_chunk, load_fact_index, load_key_registries
+from instrumentation import configure, stage
+from locking import etl_lock
+from snapshot import publish_snapshot
+from update_bd import CORRECTIONS_STATE, DEFAULT_BATCH_SIZE, bulk_upsert, close_database, load_pending, open_database, set_watermark
+
+# Lotes transformados que podem aguardar a escrita no banco: com a fila cheia, a
+# transformação espera o banco (back-pressure) e o uso de memória fica limitado
+DEFAULT_QUEUE_SIZE = 4
+
+def transform_next(chunks, detector, state):
+    """
+    Run the ETL on the next chunk of new input rows and commit the chunk to the history.
+
+    Args:
+        chunks (iterator): The chunks of new rows, from ChangeDetector.iter_new_rows.
+        detector (ChangeDetector): The change detector of the input file.
+        state (dict): Streaming state, as in etl_2.etl_chunk.
+
+    Returns:
+        tuple: Number of input rows of the chunk and the batches to load, a list of
+            (table, DataFrame) with the new dimension members before the new fact rows;
+            None when there are no chunks left.
+
+    """
+    chunk = next(chunks, None)
+    if chunk is None:
+        return None
+
+    registries = state['registries']
+    sizes = {name: len(registry) for name, registry in registries.items()}
+    df_facts = etl_chunk(chunk, state)
+    detector.commit(chunk)
+
+    # Os novos membros são acrescentados ao final da tabela de cada registro
+    batches = [
+        (name, registry.table.iloc[sizes[name]:])
+        for name, registry in registries.items() if len(registry) > sizes[name]
+    ]
+    if len(df_facts):
+        batches.append(('fqualidadear', df_facts.reset_index()))
+
+    return len(chunk), batches
+
+async def write_batches(queue, batch_size, totals):
+    """
+    Database writer task: upserts the batches received through the queue, in order, until
+    it receives None.
+
+    Args:
+        queue (asyncio.Queue): Batches (table, DataFrame) to load.
+        batch_size (int): Number of rows per transaction.
+        totals (dict): Rows written per table, updated by the task.
+    """
+    while True:
+        item = await queue.get()
+        try:
+            if item is None:
+                return
+            table, df = item
+            with stage('bulk_upsert', table=table, rows_in=len(df)) as record:
+                record['rows_out'] = await bulk_upsert(df, table, batch_size)
+            totals[table] = totals.get(table, 0) + record['rows_out']
+        finally:
+            queue.task_done()
+
+async def _put(queue, item, writer):
+    # Espera por espaço na fila, mas para se a tarefa de escrita falhar
+    put = asyncio.ensure_future(queue.put(item))
+    await asyncio.wait({put, writer}, return_when=asyncio.FIRST_COMPLETED)
+    if not put.done():
+        put.cancel()
+        writer.result()
+        raise RuntimeError('A tarefa de escrita no banco terminou antes do fim da carga.')
+
+async def pipeline(file_path, history_path, chunk_size=DEFAULT_CHUNK_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                   queue_size=DEFAULT_QUEUE_SIZE, workers=1):
+    """
+    Streaming ETL that loads the database as it goes.
+
+    Each chunk of new input rows is transformed in a worker thread and its new dimension
+    members and fact rows (new and corrected) go through a bounded queue straight to a
+    database writer task, without re-reading the star schema files. While batch N is being
+    inserted, chunk N+1 is being transformed; when the writer falls 'queue_size' batches
+    behind, the transformation waits.
+
+    The ETL files are still written as in the streaming mode of etl_2.py, and rows they hold
+    that are missing from the database (e.g. after an interrupted run) are loaded first, by
+    the load watermarks.
+
+    Args:
+        file_path (str): The path to the input data file.
+        history_path (str): The path to the history file.
+        chunk_size (int): Number of input rows transformed at a time.
+        batch_size (int): Number of rows per transaction.
+        queue_size (int): Maximum number of transformed batches waiting to be written.
+        workers (int): With more than one, the dimension tables of each chunk are built
+            concurrently.
+
+    Returns:
+        int: Number of fact rows written, new or corrected.
+
+    Raises:
+        FileNotFoundError: If the input data file does not exist.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"O arquivo {file_path} não foi encontrado.")
+
+    await open_database()
+    try:
+        await load_pending(batch_size)
+
+        detector = ChangeDetector(file_path, history_path, chunk_size)
+        if detector.is_unchanged():
+            print("Nenhuma diferença encontrada. Processo de ETL não necessário.")
+            return 0
+
+        state = {
+            'registries': load_key_registries(),
+            'fact_index': load_fact_index(),
+            'workers': workers,
+        }
+        ensure_parquet_outputs(state['registries'], state['fact_index'])
+
+        queue = asyncio.Queue(maxsize=queue_size)
+        totals = {}
+        writer = asyncio.create_task(write_batches(queue, batch_size, totals))
+        chunks = detector.iter_new_rows()
+        total_rows = 0
+        start = time.perf_counter()
+        try:
+            while True:
+                result = await asyncio.to_thread(transform_next, chunks, detector, state)
+                if result is None:
+                    break
+                rows, batches = result
+                total_rows += rows
+                for batch in batches:
+                    await _put(queue, batch, writer)
+
+            await _put(queue, None, writer)
+            await writer
+            # As correções seguiram pela fila junto com as linhas novas
+            if state['fact_index'].corrections:
+                await set_watermark(CORRECTIONS_STATE, state['fact_index'].corrections)
+        finally:
+            if not writer.done():
+                writer.cancel()
+
+        detector.save_state()
+    finally:
+        await close_database()
+
+    elapsed = time.perf_counter() - start
+    total_facts = totals.get('fqualidadear', 0)
+    if total_rows == 0:
+        print("Nenhuma diferença encontrada. Processo de ETL não necessário.")
+    else:
+        print(f"{total_rows} linhas novas processadas, {total_facts} registros gravados na tabela fato em {elapsed:.2f}s.")
+    return total_facts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Executa o ETL e carrega o banco de dados em paralelo, bloco a bloco.')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help=f'Linhas de entrada por bloco (padrão: {DEFAULT_CHUNK_SIZE}).')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help=f'Linhas por transação (padrão: {DEFAULT_BATCH_SIZE}).')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help=f'Lotes transformados aguardando o banco (padrão: {DEFAULT_QUEUE_SIZE}).')
+    parser.add_argument('--workers', type=int, default=1, help='Com mais de um, as três dimensões são construídas em paralelo (0 = número de núcleos; padrão: 1, serial).')
+    parser.add_argument('--metrics', help="Arquivo onde o tempo, a memória e as linhas de cada etapa são gravados em JSON lines ('-' para stderr).")
+    parser.add_argument('--profile', help='Pasta onde um relatório do cProfile é gravado para cada etapa.')
+    args = parser.parse_args()
+    configure(args.metrics, args.profile)
+
+    with etl_lock():
+        asyncio.run(pipeline(dados_path('dados_iqarj.csv'), dados_path('dados_iqarj_historicos.csv'),
+                             args.chunk_size, args.batch_size, args.queue_size, args.workers or os.cpu_count()))
+
+        # Nova versão do snapshot lido pelo dashboard, se os dados mudaram
+        publish_snapshot()
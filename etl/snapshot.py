@@ -0,0 +1,319 @@
+import glob
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from instrumentation import instrumented
+from parquet_store import dataset_version, has_facts, partition_path, partition_versions, read_dimension
+from star_schema import MEDIDAS
+
+# Arquivo com o nome do manifesto atual, trocado atomicamente a cada publicação
+CURRENT_FILE = 'CURRENT'
+
+# Colunas do snapshot: as do dashboard, já unidas às dimensões
+SNAPSHOT_COLUMNS = ['data', 'estacao_key', 'Estação', 'Latitude', 'Longitude'] + MEDIDAS
+
+def snapshot_dir():
+    return os.path.join(os.getcwd(), 'dados', 'snapshot')
+
+def segment_dir():
+    return os.path.join(snapshot_dir(), 'segmentos')
+
+def snapshot_version():
+    """
+    Returns:
+        str: File name of the manifest of the current snapshot, empty if none was
+            published (or the current one has the single-file layout of earlier versions).
+    """
+    path = os.path.join(snapshot_dir(), CURRENT_FILE)
+    if not os.path.exists(path):
+        return ''
+    with open(path) as current_file:
+        name = current_file.read().strip()
+    return name if name.startswith('manifest-') else ''
+
+def read_manifest(name):
+    """
+    Args:
+        name (str): File name of the manifest, as returned by snapshot_version.
+
+    Returns:
+        dict: 'partitions', the version (see partition_versions) of each month ('AAAA-MM')
+            the segments were built from, and 'segments', one entry per station and month
+            with its 'estacao_key', 'station', 'mes', 'file' and 'rows', ordered by station
+            key and month.
+
+    """
+    with open(os.path.join(snapshot_dir(), name), encoding='utf-8') as manifest_file:
+        return json.load(manifest_file)
+
+def _station_batch(df_facts, df_estacao, df_localizacao, stations):
+    df = df_facts.merge(df_localizacao, how='left', on='localizacao_key').sort_values('timestamp', kind='stable')
+    codes = pd.Categorical(df['estacao_key'].map(df_estacao.set_index('estacao_key')['station_name']), categories=stations).codes
+
+    # Indicadores como arrays numpy (NaN, e não nulos do Arrow) e nomes com o mesmo
+    # dicionário em todos os segmentos: as fatias do arquivo viram DataFrames sem cópia
+    arrays = [
+        pa.array(df['timestamp']),
+        pa.array(df['estacao_key'].to_numpy()),
+        pa.DictionaryArray.from_arrays(pa.array(codes.astype('int32')), stations),
+        pa.array(df['latitude'].to_numpy()),
+        pa.array(df['longitude'].to_numpy()),
+    ] + [pa.array(df[medida].to_numpy()) for medida in MEDIDAS]
+    return pa.RecordBatch.from_arrays(arrays, names=SNAPSHOT_COLUMNS)
+
+def _write_segment(batch, name):
+    path = os.path.join(segment_dir(), name)
+    if os.path.exists(path):
+        # Mesma versão da partição: o segmento já foi gravado
+        return
+    tmp_path = os.path.join(segment_dir(), '.' + name + '.tmp')
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, batch.schema) as writer:
+            writer.write_batch(batch)
+    os.replace(tmp_path, path)
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            # No Windows, um arquivo ainda mapeado por um leitor não pode ser removido
+            pass
+
+@instrumented('publish_snapshot')
+def publish_snapshot():
+    """
+    Publish the denormalized fact table as immutable Arrow IPC segments, one per station
+    and month, which dashboard processes memory-map read-only.
+
+    Each segment holds the rows of a station in a month, sorted by timestamp, and is built
+    from the 'ano=YYYY/mes=M' partition of the Parquet fact dataset. Only the months whose
+    partition changed since the previous snapshot (new or corrected rows, see
+    partition_versions) are read and written again, so the cost of a publication follows
+    the batch and not the history. A manifest, named after the version of the Parquet
+    outputs, lists the segments; it becomes current by an atomic replace of the CURRENT
+    file. The previous manifest and its segments are kept for the readers that have just
+    read the old CURRENT, and older ones are removed.
+
+    Returns:
+        str: File name of the current manifest, empty if there are no facts yet.
+
+    """
+    if not has_facts():
+        return ''
+
+    name = f'manifest-{dataset_version()}.json'
+    previous = snapshot_version()
+    if name == previous:
+        return name
+
+    manifest = read_manifest(previous) if previous else {'partitions': {}, 'segments': []}
+    versions = {f'{ano}-{mes:02}': version for (ano, mes), version in partition_versions().items()}
+    changed = [month for month, version in versions.items() if manifest['partitions'].get(month) != version]
+    segments = {
+        (segment['estacao_key'], segment['mes']): segment
+        for segment in manifest['segments'] if segment['mes'] in versions and segment['mes'] not in changed
+    }
+
+    os.makedirs(segment_dir(), exist_ok=True)
+    if changed:
+        df_estacao = read_dimension('destacao')
+        df_localizacao = read_dimension('dlocalizacao')
+        # Nome de cada chave de estação; o dicionário da coluna 'Estação' tem um item por
+        # nome, e as chaves de um mesmo nome ficam em segmentos separados (veja FactSnapshot)
+        names = df_estacao.set_index('estacao_key')['station_name'].astype(str)
+        stations = pa.array(names.drop_duplicates().tolist())
+
+    # Um mês por vez: a memória usada não depende do tamanho da tabela fato
+    for month in changed:
+        ano, mes = (int(part) for part in month.split('-'))
+        df_month = pd.read_parquet(partition_path(ano, mes), columns=['timestamp', 'estacao_key', 'localizacao_key'] + MEDIDAS)
+        for estacao_key, df_facts in df_month.groupby('estacao_key'):
+            segment_name = f'{estacao_key}-{month}-{versions[month][:12]}.arrow'
+            _write_segment(_station_batch(df_facts, df_estacao, df_localizacao, stations), segment_name)
+            segments[(int(estacao_key), month)] = {
+                'estacao_key': int(estacao_key),
+                'station': names[estacao_key],
+                'mes': month,
+                'file': segment_name,
+                'rows': len(df_facts),
+            }
+
+    directory = snapshot_dir()
+    manifest_path = os.path.join(directory, name)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as manifest_file:
+        json.dump({'partitions': versions, 'segments': [segments[key] for key in sorted(segments)]}, manifest_file, ensure_ascii=False)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    current_path = os.path.join(directory, CURRENT_FILE)
+    with open(current_path + '.tmp', 'w') as current_file:
+        current_file.write(name)
+    os.replace(current_path + '.tmp', current_path)
+
+    # Snapshots anteriores ao atual e ao anterior (e os arquivos únicos de versões antigas)
+    kept = {segment['file'] for segment in segments.values()} | {segment['file'] for segment in manifest['segments']}
+    _remove(path for path in glob.glob(os.path.join(segment_dir(), '*.arrow')) if os.path.basename(path) not in kept)
+    _remove(path for path in glob.glob(os.path.join(directory, 'manifest-*.json')) if os.path.basename(path) not in (name, previous))
+    _remove(glob.glob(os.path.join(directory, 'fatos-*.arrow')))
+
+    return name
+
+def _bound(day, dtype):
+    # Início do dia (UTC) na unidade da coluna de datas, para a busca binária
+    return pd.Timestamp(day).normalize().tz_localize(None).to_datetime64().astype(dtype)
+
+
+class FactSnapshot:
+    """
+    Read-only view of a published snapshot, memory-mapped.
+
+    The pages of the segment files are shared by every process that maps them, and the
+    selections are slices of their record batches: for the rows of one station in one
+    month, the numeric columns of the DataFrame point into the mapped file, without any
+    copy, and only the date and station name columns are converted (a selection spanning
+    several segments copies the selected rows). The mapped arrays are read-only, so they
+    cannot be changed in place.
+
+    Args:
+        name (str): File name of the manifest, as returned by snapshot_version.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        segments = read_manifest(name)['segments']
+
+        tables = []
+        for segment in segments:
+            # O mapeamento continua válido depois de fechado, enquanto houver referências aos buffers
+            with pa.memory_map(os.path.join(segment_dir(), segment['file'])) as source:
+                tables.append(pa.ipc.open_file(source).read_all())
+        if tables:
+            self.table = pa.concat_tables(tables)
+        else:
+            self.table = pa.table({column: pa.array([]) for column in SNAPSHOT_COLUMNS})
+
+        # Linhas de cada chave de estação, contíguas e ordenadas pela data (os segmentos estão
+        # em ordem de mês), e as datas de cada segmento, com a posição do seu início dentro
+        # da estação. Um nome pode ter mais de uma chave (o código da estação faz parte da
+        # chave natural): a seleção por nome inclui todas elas
+        self._keys = {}
+        self._ranges = {}
+        self._segments = {}
+        start = 0
+        for segment, table in zip(segments, tables):
+            if not table.num_rows:
+                continue
+            estacao_key = segment['estacao_key']
+            if estacao_key not in self._ranges:
+                self._keys.setdefault(segment['station'], []).append(estacao_key)
+            first, _ = self._ranges.get(estacao_key, (start, start))
+            self._ranges[estacao_key] = (first, start + table.num_rows)
+            self._segments.setdefault(estacao_key, []).append((start - first, table.column(0).chunk(0).to_numpy()))
+            start += table.num_rows
+        self._firsts = {
+            estacao_key: np.array([timestamps[0] for _, timestamps in key_segments])
+            for estacao_key, key_segments in self._segments.items()
+        }
+
+    def __len__(self):
+        return self.table.num_rows
+
+    @property
+    def stations(self):
+        """
+        Returns:
+            list: Names of the stations with facts, in the order of the manifest.
+        """
+        return list(self._keys)
+
+    def _station_keys(self, stations):
+        return [estacao_key for station in stations for estacao_key in self._keys.get(station, [])]
+
+    def _position(self, estacao_key, day):
+        # Busca binária do segmento pela primeira data de cada um, e então dentro dele
+        firsts = self._firsts[estacao_key]
+        bound = _bound(day, firsts.dtype)
+        index = max(np.searchsorted(firsts, bound, side='right') - 1, 0)
+        offset, timestamps = self._segments[estacao_key][index]
+        return offset + np.searchsorted(timestamps, bound)
+
+    def _slices(self, stations, start, end):
+        for estacao_key in self._station_keys(stations):
+            first, last = self._ranges[estacao_key]
+            if start is not None:
+                lower = self._position(estacao_key, start)
+                upper = self._position(estacao_key, pd.Timestamp(end) + pd.Timedelta(days=1))
+                first, last = first + lower, first + upper
+            yield first, last
+
+    def date_bounds(self, stations):
+        """
+        Args:
+            stations (list): Names of the stations.
+
+        Returns:
+            tuple: First and last timestamp (pandas.Timestamp) with facts of the given
+                stations, NaT if there are none.
+
+        """
+        bounds = [
+            (self._segments[estacao_key][0][1][0], self._segments[estacao_key][-1][1][-1])
+            for estacao_key in self._station_keys(stations)
+        ]
+        if not bounds:
+            return pd.NaT, pd.NaT
+        return tuple(pd.Timestamp(value).tz_localize('UTC') for value in (min(first for first, _ in bounds), max(last for _, last in bounds)))
+
+    def count(self, stations, start=None, end=None):
+        """
+        Args:
+            stations (list): Names of the stations.
+            start (datetime-like): First day of the range. Give both 'start' and 'end', or neither.
+            end (datetime-like): Last day of the range.
+
+        Returns:
+            int: Number of rows that select would return, without reading them.
+
+        """
+        return sum(max(last - first, 0) for first, last in self._slices(stations, start, end))
+
+    def select(self, stations, start=None, end=None, columns=None, order_by=None, ascending=True, offset=0, limit=None):
+        """
+        Rows of the given stations over the closed date range [start, end] (UTC days).
+
+        With 'order_by', the selection is sorted in Arrow (a stable sort, with missing values
+        last in both directions) and only the rows of the requested page are converted to
+        pandas, so a page of a large selection costs the sort of one column plus the page.
+
+        Args:
+            stations (list): Names of the stations.
+            start (datetime-like): First day of the range. Give both 'start' and 'end', or neither.
+            end (datetime-like): Last day of the range.
+            columns (list): Columns to read, all of them if None.
+            order_by (str): Column to sort by, the order of the stations and then of the
+                date if None.
+            ascending (bool): Direction of the sort.
+            offset (int): Number of rows to skip.
+            limit (int): Maximum number of rows to return, all of them if None.
+
+        Returns:
+            pandas.DataFrame: The rows.
+
+        """
+        slices = [self.table.slice(first, last - first) for first, last in self._slices(stations, start, end) if last > first]
+        table = pa.concat_tables(slices) if slices else self.table.slice(0, 0)
+        stop = table.num_rows if limit is None else min(offset + limit, table.num_rows)
+
+        if order_by is not None:
+            indices = pc.sort_indices(table.select([order_by]), sort_keys=[(order_by, 'ascending' if ascending else 'descending')])
+            table = table.take(indices[offset:stop])
+        elif offset or stop < table.num_rows:
+            table = table.slice(offset, max(stop - offset, 0))
+
+        if columns is not None:
+            table = table.select(list(columns))
+        return table.to_pandas(split_blocks=True)
@@ -0,0 +1,35 @@
+MEDIDAS = ['chuva', 'pres', 'rs', 'temp', 'ur', 'dir_vento', 'vel_vento', 'so2', 'no2', 'hcnm', 'hct', 'ch4', 'co', 'no', 'nox', 'o3', 'pm10', 'pm2_5']
+FACT_COLUMNS = ['tempo_key', 'estacao_key', 'localizacao_key'] + MEDIDAS
+
+# Chave natural da tabela fato: uma linha por hora, estação e localização
+FACT_KEY = ['tempo_key', 'estacao_key', 'localizacao_key']
+
+# Tipos das colunas de cada arquivo, usados por todas as leituras (ver csv_reader):
+# indicadores em float32, chaves em inteiros pequenos e nomes de estação categóricos.
+# Coordenadas continuam em float64, pois identificam os membros de DLocalizacao.
+MEDIDAS_DTYPES = {medida: 'float32' for medida in MEDIDAS}
+
+RAW_DTYPES = {
+    'data': 'str',
+    'codnum': 'int16',
+    'estação': 'category',
+    'lat': 'float64',
+    'lon': 'float64',
+    'x_utm_sirgas2000': 'float64',
+    'y_utm_sirgas2000': 'float64',
+    **MEDIDAS_DTYPES,
+}
+
+DIMENSION_DTYPES = {
+    'dtempo': {'timestamp': 'str', 'ano': 'int16', 'mes': 'int8', 'dia': 'int8', 'hora': 'int8', 'tempo_key': 'int32'},
+    'dlocalizacao': {'latitude': 'float64', 'longitude': 'float64', 'localizacao_key': 'int32'},
+    'destacao': {'station_id': 'int16', 'station_name': 'category', 'estacao_key': 'int16'},
+}
+
+FACT_DTYPES = {
+    'id': 'int64',
+    'tempo_key': 'int32',
+    'estacao_key': 'int16',
+    'localizacao_key': 'int32',
+    **MEDIDAS_DTYPES,
+}
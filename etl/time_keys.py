@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+# Formato da coluna 'data' do arquivo de entrada (ex.: '2011/01/01 00:00:00+00')
+DATA_FORMAT = '%Y/%m/%d %H:%M:%S%z'
+
+# A chave da dimensão tempo é o número de horas desde a época Unix (1970-01-01 00:00 UTC)
+HOUR_NS = 3_600 * 10**9
+
+def parse_data(values):
+    """
+    Parse the 'data' column of the input file, using its explicit format instead of
+    inferring it.
+
+    Args:
+        values (pandas.Series): The strings of the 'data' column.
+
+    Returns:
+        pandas.Series: The timestamps, in UTC.
+
+    """
+    try:
+        return pd.to_datetime(values, format=DATA_FORMAT, utc=True)
+    except ValueError:
+        # Arquivo em outro formato: volta à inferência do pandas
+        return pd.to_datetime(values, utc=True)
+
+def tempo_keys(timestamps):
+    """
+    Compute the 'tempo_key' of the given timestamps: the number of whole hours since the
+    Unix epoch. Naive timestamps are taken as UTC.
+
+    Args:
+        timestamps (array-like): The timestamps.
+
+    Returns:
+        numpy.ndarray: The keys, as int64.
+
+    """
+    index = pd.DatetimeIndex(timestamps).as_unit('ns')
+    return index.asi8 // HOUR_NS
+
+def tempo_timestamps(keys):
+    """
+    Args:
+        keys (array-like): Values of 'tempo_key'.
+
+    Returns:
+        pandas.DatetimeIndex: The hour (UTC) of each key.
+
+    """
+    return pd.to_datetime(np.asarray(keys, dtype='int64') * HOUR_NS, utc=True)
+
+def dtempo_members(keys):
+    """
+    Build the rows of the dimension table 'df_dtempo' for the given keys, without any
+    lookup: every attribute is derived from the key.
+
+    Args:
+        keys (array-like): Values of 'tempo_key'.
+
+    Returns:
+        pandas.DataFrame: Columns 'timestamp', 'ano', 'mes', 'dia', 'hora' and 'tempo_key'.
+
+    """
+    keys = np.asarray(keys, dtype='int64')
+    timestamps = tempo_timestamps(keys)
+    return pd.DataFrame({
+        'timestamp': timestamps,
+        'ano': timestamps.year,
+        'mes': timestamps.month,
+        'dia': timestamps.day,
+        'hora': timestamps.hour,
+        'tempo_key': keys,
+    })
@@ -1,55 +1,375 @@
 import os
+import time
+import argparse
 import asyncio
+from datetime import timedelta
+import numpy as np
 import pandas as pd
 
 from prisma import Prisma
 
+from csv_reader import iter_typed_csv
+from fact_index import read_correction_ids, read_fact_log
+from instrumentation import configure, stage
+from locking import etl_lock
+from parquet_store import has_facts, read_dimension, read_facts
+from star_schema import DIMENSION_DTYPES, FACT_KEY
+from time_keys import HOUR_NS
+from warehouse import KEY_TYPE_QUERY, LEGACY_LAYOUT_MESSAGE
+
+# Linhas inseridas por transação
+DEFAULT_BATCH_SIZE = 50_000
+
+# Chave usada como marca d'água de carga de cada tabela
+TABLE_KEYS = {
+    'dtempo': 'tempo_key',
+    'dlocalizacao': 'localizacao_key',
+    'destacao': 'estacao_key',
+    'fqualidadear': 'id',
+}
+
+# Colunas dos conflitos tratados como atualização: a tabela fato é identificada pela
+# chave natural (índice único do schema.prisma), as dimensões pela chave substituta
+CONFLICT_KEYS = {
+    'fqualidadear': FACT_KEY,
+}
+
+# Entrada da LoadState com o número de correções da tabela fato já carregadas
+CORRECTIONS_STATE = 'fqualidadear_corrections'
+
+# Limite de parâmetros por comando do SQLite (SQLITE_MAX_VARIABLE_NUMBER a partir da versão 3.32)
+SQLITE_MAX_VARIABLES = 32766
+
 db = Prisma()
 
-async def raw_sql_insert(df: pd.DataFrame, table_name: str):
+# Modo de journal do banco antes da carga, restaurado ao final (o modo fica gravado no arquivo)
+_journal_mode = None
+
+def float32_to_decimal(values):
+    """
+    Converts float32 values to the float64 of their shortest decimal representation.
+
+    The float32 nearest to 63.7 is 63.70000076293945: widening it as is would store that
+    value in the database. Each value is rounded to the fewest significant digits, from 6
+    to 9 (always enough for a float32), that round-trip to the same float32, which gives
+    back the value of the source file.
+
+    Args:
+        values (array-like): The float32 values.
+
+    Returns:
+        numpy.ndarray: The float64 values.
+    """
+    values = np.asarray(values, dtype='float32')
+    result = values.astype('float64')
+    pending = np.isfinite(result) & (result != 0)
+    exponent = np.floor(np.log10(np.abs(result, where=pending, out=np.ones_like(result))))
+
+    for digits in (6, 7, 8, 9):
+        # Potências de dez exatas: multiplica ou divide pelo fator inteiro
+        places = digits - 1 - exponent
+        scale = 10.0 ** np.abs(places)
+        rounded = np.where(places >= 0, np.round(result * scale) / scale, np.round(result / scale) * scale)
+        done = pending & (rounded.astype('float32') == values)
+        result[done] = rounded[done]
+        pending &= ~done
+        if not pending.any():
+            break
+
+    return result
+
+def to_sql_values(df: pd.DataFrame):
+    """
+    Converts a DataFrame into rows of native Python values ready to be bound as query parameters.
+
+    Integer columns become int, float columns become float and NaN/NaT become None (NULL).
+    float32 columns are converted with float32_to_decimal, so the database gets the value
+    of the source file and not its float32 approximation.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to be converted.
+
+    Returns:
+        list: One tuple of values per row.
+    """
+    float32_columns = df.select_dtypes('float32').columns
+    if len(float32_columns):
+        df = df.assign(**{col: float32_to_decimal(df[col]) for col in float32_columns})
+    values = df.astype(object).where(df.notna(), None)
+    return list(values.itertuples(index=False, name=None))
+
+async def set_load_pragmas(loading: bool):
     """
-    Inserts a pandas DataFrame into a SQL table using raw SQL query with Prisma.
+    Tunes SQLite for bulk loading: WAL journal and no fsync while loading.
+
+    The journal mode is stored in the database file, so the mode it had before the load is
+    restored afterwards. 'synchronous' only applies to the connection, which is closed
+    after the load.
+
+    Args:
+        loading (bool): True before the load, False after it.
+    """
+    global _journal_mode
+    if loading:
+        rows = await db.query_raw('PRAGMA journal_mode')
+        _journal_mode = rows[0]['journal_mode']
+        await db.query_raw('PRAGMA journal_mode = WAL')
+        await db.execute_raw('PRAGMA synchronous = OFF')
+    elif _journal_mode is not None:
+        # Sair do WAL grava o conteúdo do arquivo -wal no banco e o remove
+        await db.query_raw(f'PRAGMA journal_mode = {_journal_mode}')
+        _journal_mode = None
+
+async def get_watermark(table_name: str):
+    """
+    Returns the highest key of the given table already loaded, or -1 if nothing was loaded yet.
 
     Args:
-        df (pd.DataFrame): The DataFrame to be inserted.
         table_name (str): The name of the SQL table.
     """
-    # Converte o DataFrame em uma lista de dicionários
-    records = df.to_dict(orient='records')
+    rows = await db.query_raw('SELECT last_key FROM LoadState WHERE table_name = ?', table_name)
+    return int(rows[0]['last_key']) if rows else -1
 
-    # Constrói a consulta SQL de inserção em massa
-    # Esta é uma abordagem genérica e pode precisar de ajustes para casos específicos
-    columns = ', '.join([col for col in records[0].keys() if col != 'timestamp'])
-    values = ', '.join(['(' + ', '.join([f"'{v}'" for k, v in record.items() if k != 'timestamp']) + ')' for record in records])
-    sql_query = f"INSERT INTO {table_name} ({columns}) VALUES {values};"
+async def set_watermark(table_name: str, value: int):
+    """
+    Stores the load watermark of the given entry of 'LoadState'.
 
-    # Executa a consulta SQL bruta
-    await db.execute_raw(sql_query)
-    
-async def main():
+    Args:
+        table_name (str): The name of the entry.
+        value (int): The new watermark.
     """
-    This function updates the database with data from CSV files.
+    await db.execute_raw(
+        "INSERT INTO LoadState (table_name, last_key) VALUES (?, ?) "
+        "ON CONFLICT(table_name) DO UPDATE SET last_key = excluded.last_key;",
+        table_name, int(value)
+    )
 
-    It connects to the database, reads data from CSV files, inserts the data into the corresponding tables,
-    and then disconnects from the database.
+async def get_loaded_keys(table_name: str):
     """
-    await db.connect()
+    Returns the keys of the given table already in the database.
+
+    Args:
+        table_name (str): The name of the SQL table.
+    """
+    key = TABLE_KEYS[table_name]
+    rows = await db.query_raw(f'SELECT {key} FROM {table_name}')
+    return pd.Index([int(row[key]) for row in rows], dtype='int64')
+
+def read_new_rows(model: str, file_name: str, watermark: int, chunk_size: int = DEFAULT_BATCH_SIZE):
+    """
+    Reads the rows of a star schema table whose key is greater than the load watermark.
+
+    Args:
+        model (str): The name of the table.
+        file_name (str): The path to the table CSV file, used when there is no Parquet copy.
+        watermark (int): The highest key already loaded.
+        chunk_size (int): Rows read at a time from the CSV file.
+
+    Returns:
+        pd.DataFrame: The new rows, sorted by key.
+    """
+    key = TABLE_KEYS[model]
+
+    # Lê a cópia em Parquet quando disponível, evitando reprocessar o CSV
+    if has_facts():
+        if model == 'fqualidadear':
+            df = read_facts(after_id=watermark)
+        else:
+            df = read_dimension(model)
+            df = df[df[key] > watermark]
+    elif os.path.exists(file_name):
+        chunks = read_fact_log(file_name, chunk_size=chunk_size) if model == 'fqualidadear' else iter_typed_csv(file_name, DIMENSION_DTYPES[model], chunk_size)
+        df = pd.concat([chunk[chunk[key] > watermark] for chunk in chunks])
+    else:
+        # Tabela ainda não gerada pelo ETL
+        df = pd.DataFrame(columns=[key])
+
+    return df.sort_values(key)
 
-    models_files = {
+def read_fact_rows(file_name: str, ids, chunk_size: int = DEFAULT_BATCH_SIZE):
+    """
+    Reads the current version of the given fact rows.
+
+    Args:
+        file_name (str): The path to the fact CSV file, used when there is no Parquet copy.
+        ids (array-like): The ids of the rows.
+        chunk_size (int): Rows read at a time from the CSV file.
+
+    Returns:
+        pd.DataFrame: The rows, sorted by id.
+    """
+    if has_facts():
+        df = read_facts(ids=ids)
+    else:
+        df = pd.concat([chunk[chunk['id'].isin(ids)] for chunk in read_fact_log(file_name, chunk_size=chunk_size)])
+
+    return df.sort_values('id')
+
+async def bulk_upsert(df: pd.DataFrame, table_name: str, batch_size: int = DEFAULT_BATCH_SIZE):
+    """
+    Upserts a pandas DataFrame into a SQL table using batched, parameterized statements.
+
+    Each batch of 'batch_size' rows is written inside its own transaction, split into
+    multi-row statements that stay under the SQLite limit of bound parameters. Rows whose
+    key (for the fact table, its natural key) already exists are updated instead of
+    failing, so a corrected fact replaces its row in place, and the load watermark of the table
+    is advanced in the same transaction, so re-running a load interrupted by a crash only
+    rewrites the batch that was in progress.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to be written, sorted by key.
+        table_name (str): The name of the SQL table.
+        batch_size (int): Number of rows per transaction.
+
+    Returns:
+        int: Number of rows written.
+    """
+    if df.empty:
+        return 0
+    if table_name == 'dtempo':
+        # DTempo.timestamp (DateTime) em milissegundos desde a época, derivado da chave
+        df = df.assign(timestamp=df['tempo_key'].to_numpy(dtype='int64') * (HOUR_NS // 10**6))
+    else:
+        df = df.drop(columns=['timestamp'], errors='ignore')
+
+    key = TABLE_KEYS[table_name]
+    conflict_keys = CONFLICT_KEYS.get(table_name, [key])
+    columns = ', '.join(df.columns)
+    updates = ', '.join(f'{col} = excluded.{col}' for col in df.columns if col not in conflict_keys)
+    rows_per_statement = max(1, min(batch_size, SQLITE_MAX_VARIABLES // len(df.columns)))
+    row_placeholder = '(' + ', '.join(['?'] * len(df.columns)) + ')'
+
+    for start in range(0, len(df), batch_size):
+        df_batch = df.iloc[start:start + batch_size]
+        records = to_sql_values(df_batch)
+
+        async with db.tx(timeout=timedelta(minutes=10)) as tx:
+            for offset in range(0, len(records), rows_per_statement):
+                statement_records = records[offset:offset + rows_per_statement]
+                placeholders = ', '.join([row_placeholder] * len(statement_records))
+                params = [value for record in statement_records for value in record]
+                await tx.execute_raw(
+                    f"INSERT INTO {table_name} ({columns}) VALUES {placeholders} "
+                    f"ON CONFLICT({', '.join(conflict_keys)}) DO UPDATE SET {updates};",
+                    *params
+                )
+
+            await tx.execute_raw(
+                "INSERT INTO LoadState (table_name, last_key) VALUES (?, ?) "
+                "ON CONFLICT(table_name) DO UPDATE SET last_key = MAX(last_key, excluded.last_key);",
+                table_name, int(df_batch[key].max())
+            )
+
+    return len(df)
+
+def models_files():
+    return {
         'dtempo': os.path.join(os.getcwd(), 'dados/df_dtempo.csv'),
         'dlocalizacao': os.path.join(os.getcwd(), 'dados/df_dlocalizacao.csv'),
         'destacao': os.path.join(os.getcwd(), 'dados/df_destacao.csv'),
         'fqualidadear': os.path.join(os.getcwd(), 'dados/df_fqualidadear.csv'),
     }
 
-    for model, file_name in models_files.items():
-        df = pd.read_csv(file_name)
-        records = df.to_dict(orient='records')
-
-        print(f'Inserindo {len(records)} registros na tabela {model}')
-        await raw_sql_insert(df, model)
+async def open_database():
+    await db.connect()
+    rows = await db.query_raw(KEY_TYPE_QUERY)
+    if rows and rows[0]['type'].upper() == 'TEXT':
+        await db.disconnect()
+        raise RuntimeError(LEGACY_LAYOUT_MESSAGE)
+    await set_load_pragmas(True)
 
+async def close_database():
+    await set_load_pragmas(False)
     await db.disconnect()
 
-# Execute a função principal
-asyncio.run(main())
+async def load_pending(batch_size: int = DEFAULT_BATCH_SIZE):
+    """
+    For each table, reads only the rows added since the last load (according to the
+    watermark stored in 'LoadState' or, for 'dtempo', to the keys already in the database)
+    and upserts them into the corresponding table.
+
+    Args:
+        batch_size (int): Number of rows per transaction.
+    """
+    for model, file_name in models_files().items():
+        if model == 'dtempo':
+            # A chave de tempo é derivada da hora: horas anteriores às já carregadas têm chave
+            # menor que a marca d'água, então as novas são encontradas pelas chaves do banco
+            loaded_keys = await get_loaded_keys(model)
+            with stage('read_new_rows', table=model) as record:
+                df = read_new_rows(model, file_name, -1)
+                if not loaded_keys.isin(df[TABLE_KEYS[model]]).all():
+                    raise RuntimeError('As chaves de DTempo no banco não correspondem às do ETL (geradas por uma versão anterior). '
+                                       'Recrie o banco com `prisma db push --force-reset` e execute a carga novamente.')
+                df = df[~df[TABLE_KEYS[model]].isin(loaded_keys)]
+                record['rows_out'] = len(df)
+        else:
+            watermark = await get_watermark(model)
+            with stage('read_new_rows', table=model) as record:
+                df = read_new_rows(model, file_name, watermark)
+                record['rows_out'] = len(df)
+        if df.empty:
+            print(f'Nenhum registro novo para a tabela {model}')
+            continue
+
+        print(f'Inserindo {len(df)} registros na tabela {model}')
+        start = time.perf_counter()
+        with stage('bulk_upsert', table=model, rows_in=len(df)) as record:
+            inserted = await bulk_upsert(df, model, batch_size)
+            record['rows_out'] = inserted
+        elapsed = time.perf_counter() - start
+        print(f'{inserted} registros inseridos em {elapsed:.2f}s ({inserted / elapsed if elapsed else 0:,.0f} registros/s)')
+
+    await load_corrections(models_files()['fqualidadear'], batch_size)
+
+async def load_corrections(file_name: str, batch_size: int = DEFAULT_BATCH_SIZE):
+    """
+    Updates the fact rows corrected by the ETL since the last load: the ids after the
+    corrections watermark in the corrections log of the fact index are read again and
+    upserted on their natural key.
+
+    Args:
+        file_name (str): The path to the fact CSV file.
+        batch_size (int): Number of rows per transaction.
+    """
+    loaded = max(0, await get_watermark(CORRECTIONS_STATE))
+    ids = read_correction_ids(file_name, loaded)
+    if len(ids) == 0:
+        return
+
+    with stage('read_new_rows', table='fqualidadear_corrections') as record:
+        df = read_fact_rows(file_name, np.unique(ids))
+        record['rows_out'] = len(df)
+
+    print(f'Atualizando {len(df)} registros corrigidos na tabela fqualidadear')
+    with stage('bulk_upsert', table='fqualidadear', rows_in=len(df)) as record:
+        record['rows_out'] = await bulk_upsert(df, 'fqualidadear', batch_size)
+    await set_watermark(CORRECTIONS_STATE, loaded + len(ids))
+
+async def main(batch_size: int = DEFAULT_BATCH_SIZE):
+    """
+    This function updates the database with data from CSV files.
+
+    It connects to the database, loads the rows added to each table since the last load
+    and then disconnects from the database.
+
+    Args:
+        batch_size (int): Number of rows per transaction.
+    """
+    await open_database()
+    try:
+        await load_pending(batch_size)
+    finally:
+        await close_database()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Carrega o esquema estrela no banco de dados.')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help=f'Linhas por transação (padrão: {DEFAULT_BATCH_SIZE}).')
+    parser.add_argument('--metrics', help="Arquivo onde o tempo, a memória e as linhas de cada etapa são gravados em JSON lines ('-' para stderr).")
+    parser.add_argument('--profile', help='Pasta onde um relatório do cProfile é gravado para cada etapa.')
+    args = parser.parse_args()
+    configure(args.metrics, args.profile)
+
+    # Execute a função principal
+    with etl_lock():
+        asyncio.run(main(args.batch_size))
@@ -0,0 +1,188 @@
+import os
+import sqlite3
+from contextlib import closing
+import pandas as pd
+
+from star_schema import MEDIDAS, MEDIDAS_DTYPES
+from time_keys import tempo_keys, tempo_timestamps
+
+# Banco SQLite populado por update_bd.py (url 'file:database.db' do schema.prisma)
+DATABASE_FILE = 'database.db'
+
+def database_path():
+    return os.path.join(os.getcwd(), DATABASE_FILE)
+
+def has_database():
+    return os.path.exists(database_path())
+
+def database_version():
+    """
+    Signature of the database files: changes whenever a load writes to the database,
+    including writes still in the WAL file.
+
+    Returns:
+        str: Size and mtime of 'database.db' and of its WAL file.
+
+    """
+    parts = []
+    for path in (database_path(), database_path() + '-wal'):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f'{stat.st_size}:{stat.st_mtime_ns}')
+    return '|'.join(parts)
+
+# Tipo declarado da chave de DTempo: 'TEXT' no layout anterior às chaves inteiras
+KEY_TYPE_QUERY = "SELECT type FROM pragma_table_info('DTempo') WHERE name = 'tempo_key'"
+
+LEGACY_LAYOUT_MESSAGE = 'O banco de dados usa o layout anterior às chaves inteiras: execute `python etl/migrate_bd.py`.'
+
+def connect():
+    """
+    Returns:
+        sqlite3.Connection: A read-only connection to the database.
+    """
+    return sqlite3.connect(f'file:{database_path()}?mode=ro', uri=True)
+
+def _station_filter(station_names):
+    placeholders = ', '.join(['?'] * len(station_names))
+    return f'e.station_name IN ({placeholders})', list(station_names)
+
+def has_legacy_layout():
+    """
+    Returns:
+        bool: Whether the database still has the text (cuid) keys of the previous layout
+            of schema.prisma, and must be migrated with migrate_bd.py.
+    """
+    with closing(connect()) as conn:
+        row = conn.execute(KEY_TYPE_QUERY).fetchone()
+    return row is not None and row[0].upper() == 'TEXT'
+
+def _day_filter(start, end):
+    # tempo_key é o número de horas desde a época: o período vira um intervalo de chaves,
+    # lido no índice (estacao_key, tempo_key) da tabela fato, sem unir a DTempo
+    first, last = tempo_keys([pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize() + pd.Timedelta(days=1)])
+    return 'f.tempo_key BETWEEN ? AND ?', [int(first), int(last) - 1]
+
+def date_bounds(station_names):
+    """
+    Args:
+        station_names (list): Names of the stations.
+
+    Returns:
+        tuple: First and last timestamp (pandas.Timestamp) with facts of the given stations,
+            (None, None) if there are none.
+
+    """
+    if not len(station_names):
+        return None, None
+
+    # Primeira e última chave de cada estação: uma busca no índice por estação
+    where, params = _station_filter(station_names)
+    query = (
+        'SELECT MIN((SELECT MIN(f.tempo_key) FROM FQualidadeAr f WHERE f.estacao_key = e.estacao_key)), '
+        'MAX((SELECT MAX(f.tempo_key) FROM FQualidadeAr f WHERE f.estacao_key = e.estacao_key)) '
+        f'FROM DEstacao e WHERE {where}'
+    )
+    with closing(connect()) as conn:
+        first, last = conn.execute(query, params).fetchone()
+
+    if first is None:
+        return None, None
+    return tuple(tempo_timestamps([first, last]))
+
+def _facts_filter(station_names, start, end):
+    where, params = _station_filter(station_names)
+    if start is not None and end is not None:
+        day_where, day_params = _day_filter(start, end)
+        where, params = f'{where} AND {day_where}', params + day_params
+    elif start is not None or end is not None:
+        raise ValueError('Informe o início e o fim do período, ou nenhum dos dois.')
+    return where, params
+
+def _order_clause(order_by, ascending):
+    # Indicadores ausentes por último nas duas direções, como no pandas; o rowid
+    # desempata, para que as páginas de LIMIT/OFFSET não repitam nem pulem linhas
+    direction = 'ASC' if ascending else 'DESC'
+    if order_by == 'timestamp':
+        return f' ORDER BY f.tempo_key {direction}, f.rowid'
+    if order_by not in MEDIDAS:
+        raise ValueError(f'Coluna de ordenação desconhecida: {order_by}')
+    return f' ORDER BY f.{order_by} IS NULL, f.{order_by} {direction}, f.rowid'
+
+def count_facts(station_names, start=None, end=None):
+    """
+    Args:
+        station_names (list): Names of the stations.
+        start (datetime-like): First day of the range. Give both 'start' and 'end', or neither.
+        end (datetime-like): Last day of the range.
+
+    Returns:
+        int: Number of facts of the given stations and days.
+
+    """
+    if not len(station_names):
+        return 0
+
+    where, params = _facts_filter(station_names, start, end)
+    query = (
+        'SELECT COUNT(*) FROM FQualidadeAr f '
+        'JOIN DEstacao e ON e.estacao_key = f.estacao_key '
+        f'WHERE {where}'
+    )
+    with closing(connect()) as conn:
+        return conn.execute(query, params).fetchone()[0]
+
+def query_facts(station_names, start=None, end=None, medidas=MEDIDAS, order_by=None, ascending=True, offset=0, limit=None):
+    """
+    Read the denormalized facts of the given stations and days, filtering in the database.
+
+    The station, date and indicator filters become the WHERE clause and column list of a
+    single query, so only the selected rows and columns leave SQLite. The indexes on the
+    station/time keys of 'FQualidadeAr' (see schema.prisma) keep the query proportional
+    to the selection instead of the size of the table: as 'tempo_key' counts the hours
+    since the epoch, the date range is a range of keys and 'DTempo' is not joined. A page
+    of a sorted selection ('order_by' with 'limit' and 'offset') is also cut in the database.
+
+    Args:
+        station_names (list): Names of the stations.
+        start (datetime-like): First day of the range. Give both 'start' and 'end', or neither.
+        end (datetime-like): Last day of the range.
+        medidas (list): Indicator columns to read.
+        order_by (str): 'timestamp' or an indicator to sort by, no particular order if None.
+        ascending (bool): Direction of the sort.
+        offset (int): Number of rows to skip.
+        limit (int): Maximum number of rows to return, all of them if None.
+
+    Returns:
+        pandas.DataFrame: Columns 'timestamp', 'station_name', 'latitude', 'longitude'
+            and the indicators.
+
+    """
+    unknown = set(medidas) - set(MEDIDAS)
+    if unknown:
+        raise ValueError(f'Indicadores desconhecidos: {sorted(unknown)}')
+
+    columns = ['timestamp', 'station_name', 'latitude', 'longitude'] + list(medidas)
+    if not len(station_names):
+        return pd.DataFrame(columns=columns)
+
+    where, params = _facts_filter(station_names, start, end)
+    query = (
+        'SELECT f.tempo_key, e.station_name, l.latitude, l.longitude'
+        + ''.join(f', f.{medida}' for medida in medidas) + ' FROM FQualidadeAr f '
+        'JOIN DEstacao e ON e.estacao_key = f.estacao_key '
+        'JOIN DLocalizacao l ON l.localizacao_key = f.localizacao_key '
+        f'WHERE {where}'
+    )
+    if order_by is not None:
+        query += _order_clause(order_by, ascending)
+    if limit is not None or offset:
+        query += ' LIMIT ? OFFSET ?'
+        params = params + [-1 if limit is None else limit, offset]
+
+    with closing(connect()) as conn:
+        df = pd.read_sql_query(query, conn, params=params)
+
+    df['timestamp'] = tempo_timestamps(df['tempo_key'])
+    df = df.astype({medida: MEDIDAS_DTYPES[medida] for medida in medidas})
+    return df[columns]